@@ -0,0 +1,111 @@
+# access_log.py
+# Asynchronous, buffered JSON-lines log writer shared by the book and order servers.
+#
+# Request threads only put a record on a bounded queue. A background thread
+# writes the records in batches (every BATCH_SIZE records or FLUSH_INTERVAL
+# seconds, whichever comes first) to a file it keeps open, and rotates the file
+# once it grows past MAX_BYTES. When the queue is full, records are dropped and
+# counted instead of blocking the request.
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+
+class AsyncLogWriter:
+    """Background writer of structured log records as JSON lines."""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT,
+                 queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._thread = threading.Thread(
+            target=self._run, name='access-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """Queue a record (a JSON-serializable dict) without blocking."""
+        record.setdefault('ts', datetime.now().isoformat())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+        }
+
+    def close(self):
+        """Flush every queued record and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        batch = []
+        flush_at = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                record = self._queue.get(
+                    timeout=max(flush_at - time.monotonic(), 0))
+            except queue.Empty:
+                record = False
+
+            if record is None:
+                self._flush(batch)
+                if self._file:
+                    self._file.close()
+                return
+
+            if record:
+                batch.append(record)
+            if len(batch) >= self.batch_size or time.monotonic() >= flush_at:
+                self._flush(batch)
+                batch = []
+                flush_at = time.monotonic() + self.flush_interval
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(''.join(json.dumps(record, default=str) + '\n'
+                                 for record in batch))
+        self._file.flush()
+        self.written += len(batch)
+
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        # log.txt -> log.txt.1 -> log.txt.2 ... the oldest backup is removed
+        self._file.close()
+        self._file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backup_count:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
@@ -1,12 +1,23 @@
 # Import necessary modules
 import os
-from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify
+import re
+import io
+import csv
+import json
+import hashlib
+import base64
+from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, Response
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, relationship
-from sqlalchemy import Float, Integer, String, ForeignKey, or_
+from sqlalchemy import Float, Integer, String, ForeignKey, Index, or_, text, select, func, tuple_, JSON, DATETIME
 from sqlalchemy.orm import Mapped, mapped_column
-from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timedelta
 from flask_socketio import SocketIO
+from storage import EpochMillis, SQLiteStorage
+from access_log import AsyncLogWriter
+from response_cache import ResponseCache
+from service_client import enforce_deadline
 
 
 # Define a base class for SQLAlchemy models
@@ -26,32 +37,452 @@ app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + \
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
+# WAL mode, pooled read connections and a single writer thread
+storage = SQLiteStorage(db)
+storage.init_app(app)
+
+# Answer 504 to requests whose caller has already given up
+enforce_deadline(app)
+
 # Define SQLAlchemy models for Catalog and Book
 
 
 class Catalog(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String)
+    # Bumped on every write, used as the ETag of the row
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default='1')
 
 
 class Book(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    name: Mapped[str] = mapped_column(String)
+    name: Mapped[str] = mapped_column(String, index=True)
     count: Mapped[int] = mapped_column(Integer, default=1)
     price: Mapped[float] = mapped_column(Float, default=0)
-    catalog_id: Mapped[int] = mapped_column(ForeignKey(Catalog.id))
+    catalog_id: Mapped[int] = mapped_column(ForeignKey(Catalog.id), index=True)
     catalog: Mapped[Catalog] = relationship(Catalog)
+    # Bumped on every write, used as the ETag of the row
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default='1')
+
+    # Covering indexes of the catalog listing ordered by price or by name
+    __table_args__ = (
+        Index('ix_book_catalog_price', 'catalog_id', 'price', 'id', 'name', 'count', 'version'),
+        Index('ix_book_catalog_name', 'catalog_id', 'name', 'id', 'price', 'count', 'version'),
+    )
+
+
+# Inventory totals of a catalog, kept up to date in the same transaction as
+# every book write so /catalogs/<id>/stats never has to scan the books
+class CatalogStats(db.Model):
+    __tablename__ = 'catalog_stats'
+    catalog_id: Mapped[int] = mapped_column(ForeignKey(Catalog.id), primary_key=True)
+    titles: Mapped[int] = mapped_column(Integer, default=0)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    stock_value: Mapped[float] = mapped_column(Float, default=0)
+
+
+# Sequence-numbered log of every catalog and book change. Each entry is written
+# in the same transaction as the change itself and holds the full new state of
+# the row, so replicas can replay it idempotently.
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    entity: Mapped[str] = mapped_column(String)
+    entity_id: Mapped[int] = mapped_column(Integer)
+    data: Mapped[dict] = mapped_column(JSON)
+    created_at: Mapped[datetime] = mapped_column(DATETIME)
+
+
+# Stock escrow: units of a book moved out of its count and leased to an order
+# server (the holder), which sells them without calling the catalog server.
+# units is what the holder last reported unsold (an upper bound), expires_at
+# the end of the lease unless it is renewed. reclaimable is the part of units
+# the holder promised not to sell before its next report (a lower bound of
+# what is unsold), taken back into the count once the lease has expired;
+# reclaimed is what was taken back that way.
+class StockLease(db.Model):
+    __tablename__ = 'stock_lease'
+    __table_args__ = {'sqlite_with_rowid': False}
+    holder: Mapped[str] = mapped_column(String(32), primary_key=True)
+    book_id: Mapped[int] = mapped_column(ForeignKey(Book.id), primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    expires_at: Mapped[datetime] = mapped_column(EpochMillis, index=True)
+    reclaimable: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    reclaimed: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+
+
+# Default and maximum number of results returned by /books/find
+SEARCH_RESULT_LIMIT = 20
+MAX_SEARCH_RESULT_LIMIT = 100
+
+
+# Function to create an FTS5 full-text index over the name column of a table.
+# Triggers keep the index in sync with every insert, update and delete.
+def create_name_search_index(session, table, fts_table):
+    exists = session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': fts_table}).first()
+
+    session.execute(text(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+            name, content='{table}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2')"""))
+    session.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts_table}(rowid, name) VALUES (new.id, new.name);
+        END"""))
+    session.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts_table}({fts_table}, rowid, name) VALUES ('delete', old.id, old.name);
+        END"""))
+    session.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF name ON {table} BEGIN
+            INSERT INTO {fts_table}({fts_table}, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO {fts_table}(rowid, name) VALUES (new.id, new.name);
+        END"""))
+
+    # Index the rows that existed before the index was created
+    if exists is None:
+        session.execute(text(
+            f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+    session.commit()
+
+
+# Function to add a column to an existing table if it is missing
+# (db.create_all() only creates the tables that do not exist yet)
+def add_column_if_missing(session, table, column, ddl):
+    columns = [row.name for row in session.execute(text(f'PRAGMA table_info({table})'))]
+    if column not in columns:
+        session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+# Schema migrations of project.db, applied in order at startup by
+# storage.run_migrations. Only ever append to MIGRATIONS.
+def add_version_columns(session):
+    add_column_if_missing(session, 'catalog', 'version', 'INTEGER NOT NULL DEFAULT 1')
+    add_column_if_missing(session, 'book', 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def add_book_indexes(session):
+    session.execute(text('CREATE INDEX IF NOT EXISTS ix_book_name ON book (name)'))
+    session.execute(text('CREATE INDEX IF NOT EXISTS ix_book_catalog_id ON book (catalog_id)'))
+
+
+def add_catalog_listing_indexes(session):
+    session.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_book_catalog_price
+        ON book (catalog_id, price, id, name, count, version)"""))
+    session.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_book_catalog_name
+        ON book (catalog_id, name, id, price, count, version)"""))
+
+
+def add_lease_reclaim_columns(session):
+    add_column_if_missing(session, 'stock_lease', 'reclaimable', 'INTEGER NOT NULL DEFAULT 0')
+    add_column_if_missing(session, 'stock_lease', 'reclaimed', 'INTEGER NOT NULL DEFAULT 0')
+
+
+MIGRATIONS = [
+    add_version_columns,
+    add_book_indexes,
+    add_catalog_listing_indexes,
+    add_lease_reclaim_columns,
+]
+
+
+# Function to get the ETag of a list of rows from their ids and versions.
+# The rows must be in the order they are returned in.
+def rows_etag(rows):
+    versions = ','.join(f'{row.id}:{row.version}' for row in rows)
+    return hashlib.sha1(versions.encode()).hexdigest()
+
+
+# Function to answer a GET request with an ETag, or with 304 Not Modified
+# when the client's If-None-Match already matches it
+def conditional_response(data, etag):
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+# Function to answer a GET request from a cache of serialized responses.
+# On a miss build() runs the query and returns (data, status, etag), and the
+# serialized body is cached, so a hit skips both SQLite and JSON encoding.
+def cached_response(cache, key, build):
+    entry = cache.get(key)
+    if entry is None:
+        generation = cache.generation()
+        data, status, etag = build()
+        entry = (jsonify(data).get_data(), status, etag)
+        cache.put(key, entry, generation)
+
+    body, status, etag = entry
+    response = make_response(body, status)
+    response.mimetype = 'application/json'
+    if etag is None:
+        return response
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+# Function to drop the cached responses of changed books (after the commit)
+def invalidate_books(cache, books):
+    keys = []
+    for book in books:
+        keys += [('book', book['id']), ('availability', book['id']),
+                 ('search', book['name'])]
+    cache.invalidate(keys)
+
+
+# Function to turn a user search string into an FTS5 prefix query,
+# e.g. 'harry pot' -> '"harry"* "pot"*' (every word must match a prefix)
+def build_match_query(search_string):
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', search_string))
+
+
+# Function to read the 'limit' query parameter of a search request
+def parse_search_limit(args):
+    limit = int(args.get('limit', SEARCH_RESULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return min(limit, MAX_SEARCH_RESULT_LIMIT)
+
+
+# Default and maximum page size of /books and /catalogs, and the number of
+# rows fetched per round trip when streaming them as NDJSON
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+
+# Function to read the 'after' and 'limit' query parameters of a listing request
+def parse_page_args(args):
+    after = int(args.get('after', 0))
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
+# Function to list rows ordered by id using keyset pagination (WHERE id > after),
+# or to stream them as newline-delimited JSON when 'format=ndjson' is requested.
+# The stream reads from a server-side cursor, so the full result set is never
+# held in memory. read_session is the read_session method of a SQLiteStorage.
+def list_rows_by_id(read_session, columns, id_column, key, args):
+    after, limit = parse_page_args(args)
+    query = select(*columns).where(id_column > after).order_by(id_column)
+
+    if args.get('format') == 'ndjson':
+        if 'limit' in args:
+            query = query.limit(limit)
+        query = query.execution_options(yield_per=STREAM_BATCH_SIZE)
+
+        def generate():
+            with read_session() as session:
+                for row in session.execute(query):
+                    yield json.dumps(row._asdict()) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    # Fetch one extra row to know whether there is a next page
+    with read_session() as session:
+        rows = [row._asdict()
+                for row in session.execute(query.limit(limit + 1))]
+    next_after = rows[limit - 1]['id'] if len(rows) > limit else None
+    return jsonify({
+        key: rows[:limit],
+        'next_after': next_after,
+    })
 
 
-# Create database tables
+# Orders of the catalog listing. Ordering by id walks ix_book_catalog_id,
+# price and name are read from their covering indexes alone.
+CATALOG_LISTING_ORDERS = ('id', 'price', 'name')
+
+
+# Functions to encode and decode the opaque cursor of the catalog listing,
+# the sort key of the last row of a page
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+
+# Function to read the 'order', 'cursor' and 'limit' query parameters of a
+# catalog listing request
+def parse_catalog_listing_args(args):
+    order = args.get('order', 'id')
+    if order not in CATALOG_LISTING_ORDERS:
+        raise ValueError(f"order must be one of {', '.join(CATALOG_LISTING_ORDERS)}")
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    if cursor is not None and len(cursor) != (1 if order == 'id' else 2):
+        raise ValueError('cursor does not match the order')
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return order, cursor, min(limit, MAX_PAGE_SIZE)
+
+
+# Function to get one page of the books of a catalog with keyset pagination:
+# WHERE (sort key, id) > cursor ORDER BY sort key, id. Returns the response
+# body and its ETag. model is Book or the replica's book model.
+def list_catalog_books(read_session, model, catalog_id, args):
+    order, cursor, limit = parse_catalog_listing_args(args)
+    keys = [model.id] if order == 'id' else [getattr(model, order), model.id]
+
+    query = select(model.id, model.name, model.count, model.price, model.version) \
+        .where(model.catalog_id == catalog_id)
+    if cursor is not None:
+        query = query.where(tuple_(*keys) > tuple_(*cursor) if len(keys) > 1
+                            else keys[0] > cursor[0])
+    # Fetch one extra row to know whether there is a next page
+    query = query.order_by(*keys).limit(limit + 1)
+
+    with read_session() as session:
+        rows = session.execute(query).all()
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor([getattr(page[-1], key.key) for key in keys])
+
+    return {
+        'books': [{
+            'id': row.id,
+            'name': row.name,
+            'count': row.count,
+            'price': row.price,
+        } for row in page],
+        'next_cursor': next_cursor,
+    }, rows_etag(page)
+
+
+# Create database tables and bring existing ones up to date
 with app.app_context():
     db.create_all()
+    for migration in storage.run_migrations(MIGRATIONS):
+        app.logger.info(f'Applied migration {MIGRATIONS.index(migration) + 1}: '
+                        f'{migration.__name__}')
+    create_name_search_index(db.session, 'book', 'book_fts')
+
+
+# Functions to get the replicated state of a catalog or a book
+def catalog_state(catalog):
+    return {'id': catalog.id, 'name': catalog.name, 'version': catalog.version}
+
+
+def book_state(book):
+    return {'id': book.id, 'name': book.name, 'count': book.count,
+            'price': book.price, 'catalog_id': book.catalog_id,
+            'version': book.version}
+
+
+# Function to add a change to the change log (committed with the caller's transaction)
+def record_change(entity, data, entity_id=None):
+    db.session.add(ChangeLog(entity=entity,
+                             entity_id=data['id'] if entity_id is None else entity_id,
+                             data=data, created_at=datetime.now()))
+
+
+# Function to add deltas to the inventory totals of a catalog with one UPSERT,
+# returning the new totals. Shared with the replica, hence the explicit
+# session and model.
+def adjust_catalog_stats(session, model, catalog_id, titles=0, units=0, stock_value=0):
+    statement = sqlite_insert(model).values(
+        catalog_id=catalog_id, titles=titles, units=units, stock_value=stock_value)
+    statement = statement.on_conflict_do_update(
+        index_elements=['catalog_id'],
+        set_={
+            'titles': model.titles + titles,
+            'units': model.units + units,
+            'stock_value': model.stock_value + stock_value,
+        })
+    return session.execute(statement.returning(
+        model.catalog_id, model.titles, model.units, model.stock_value)).first()._asdict()
+
+
+# Function to recompute the inventory totals from the books, of every catalog
+# or only of the given ones, returning the new totals
+def rebuild_catalog_stats(session, model, book_model, catalog_ids=None):
+    reset = db.update(model).values(titles=0, units=0, stock_value=0)
+    totals = (
+        select(book_model.catalog_id,
+               func.count(),
+               func.coalesce(func.sum(book_model.count), 0),
+               func.coalesce(func.sum(book_model.count * book_model.price), 0))
+        .where(book_model.catalog_id.is_not(None))
+        .group_by(book_model.catalog_id))
+    if catalog_ids is not None:
+        reset = reset.where(model.catalog_id.in_(catalog_ids))
+        totals = totals.where(book_model.catalog_id.in_(catalog_ids))
+    session.execute(reset)
+
+    statement = sqlite_insert(model).from_select(
+        ['catalog_id', 'titles', 'units', 'stock_value'], totals)
+    statement = statement.on_conflict_do_update(
+        index_elements=['catalog_id'],
+        set_={column: statement.excluded[column]
+              for column in ['titles', 'units', 'stock_value']})
+    session.execute(statement)
+
+    query = select(model.catalog_id, model.titles, model.units, model.stock_value)
+    if catalog_ids is not None:
+        query = query.where(model.catalog_id.in_(catalog_ids))
+    return [row._asdict() for row in session.execute(query)]
+
+
+# Function to update the inventory totals of a catalog and record the change
+def update_catalog_stats(catalog_id, **deltas):
+    stats = adjust_catalog_stats(db.session, CatalogStats, catalog_id, **deltas)
+    record_change('catalog_stats', stats, stats['catalog_id'])
+    return stats
+
+
+# Function to record the change of many catalog totals with one executemany
+def record_stats_changes(states):
+    if not states:
+        return
+    now = datetime.now()
+    db.session.execute(db.insert(ChangeLog), [
+        {'entity': 'catalog_stats', 'entity_id': state['catalog_id'],
+         'data': state, 'created_at': now}
+        for state in states])
+
+
+# Fill the inventory totals the first time they are used on an existing database
+with app.app_context():
+    if db.session.execute(select(CatalogStats.catalog_id).limit(1)).first() is None:
+        rebuild_catalog_stats(db.session, CatalogStats, Book)
+        db.session.commit()
+
+
+# Raised inside a storage write to roll it back and answer with an error response
+class WriteAborted(Exception):
+    def __init__(self, status, body):
+        super().__init__(body)
+        self.status = status
+        self.body = body
+
 
+# Serialized GET responses, keyed by ('book', id), ('availability', id) and
+# ('search', name), and invalidated by every write to the books
+response_cache = ResponseCache()
 
-# Function to log messages to a file
-def log(message):
-    with open('./catalog_log.txt', 'a') as logger:
-        logger.write(f'{message}\n')
+# Requests are logged as JSON lines by a background writer
+catalog_log = AsyncLogWriter('./catalog_log.txt')
+
+
+# Function to log a structured record, e.g. log('get all catalogs', method='GET')
+def log(message, **fields):
+    catalog_log.write(dict(fields, message=message))
 
 # Socket.io event handler for handling catalog change
 @socketio.on('catalog_change')
@@ -110,28 +541,36 @@ def handle_book_change_replica(message):
 @app.get('/catalogs')
 def get_all_catalogs():
     """
-    Get a list of all catalogs.
+    Get a list of all catalogs, one page at a time.
 
     Input:
-    - None
+    - Optional query parameter 'after' (catalog id, default 0)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+    - Optional query parameter 'format' ('ndjson' to stream every catalog
+      after 'after' as newline-delimited JSON)
 
     Output:
-    - JSON response containing a list of catalogs
+    - JSON response containing a page of catalogs and 'next_after', the
+      cursor of the next page (null on the last page)
 
     Example:
-    - GET request: /catalogs
+    - GET request: /catalogs?after=100&limit=50
+    - GET request: /catalogs?format=ndjson
     """
     try:
-        catalogs = db.session.execute(
-            db.select(Catalog).order_by(Catalog.id)).scalars()
-        catalogs_list = [{'id': catalog.id, 'name': catalog.name}
-                         for catalog in catalogs]
-
-        log(f'make GET request on /catalogs > get all catalogs {
-            datetime.now()}')
-        return jsonify({
-            'catalogs': catalogs_list
+        parse_page_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
         })
+        return make_response(json_response, 400)
+
+    try:
+        response = list_rows_by_id(storage.read_session, [Catalog.id, Catalog.name],
+                                   Catalog.id, 'catalogs', request.args)
+
+        log('get all catalogs', method='GET', path='/catalogs')
+        return response
 
     except Exception as e:
         json_response = jsonify({
@@ -164,23 +603,106 @@ def create_catalog():
         })
         return make_response(json_response, 400)
 
-    catalog = Catalog(
-        name=name
-    )
+    def add_catalog():
+        catalog = Catalog(
+            name=name
+        )
+
+        db.session.add(catalog)
+        db.session.flush()
+        record_change('catalog', catalog_state(catalog))
+        update_catalog_stats(catalog.id)
+        return catalog_state(catalog)
 
-    db.session.add(catalog)
-    db.session.commit()
+    catalog = storage.write(add_catalog)
 
-    log(f'make POST request on /catalogs > add new catalog {datetime.now()}')
+    log('add new catalog', method='POST', path='/catalogs',
+        catalog_id=catalog['id'])
 
     # Emit an event to the replica server
     socketio.emit('catalog_change', {'catalog_info': {
-                  'id': catalog.id, 'name': catalog.name}}, namespace='/replica')
+                  'id': catalog['id'], 'name': catalog['name']}}, namespace='/replica')
+
+    return jsonify({
+        'success': True,
+        'catalog': catalog['name'],
+        'catalog_id': catalog['id'],
+    })
+
+# Function to format the inventory totals of a catalog
+def catalog_stats_info(catalog_id, stats):
+    return {
+        'catalog_id': catalog_id,
+        'titles': stats.titles if stats else 0,
+        'units': stats.units if stats else 0,
+        'stock_value': round(stats.stock_value, 2) if stats else 0.0,
+    }
+
+# Endpoint to get the inventory totals of a catalog
+
 
+@app.get('/catalogs/<int:id>/stats')
+def get_catalog_stats(id):
+    """
+    Get the number of titles, the units in stock and the stock value
+    (units times price) of a catalog. The totals are maintained with every
+    book write, so this is a single primary key lookup.
+
+    Input:
+    - Catalog ID (integer)
+
+    Output:
+    - JSON response containing the catalog totals, 404 if the catalog
+      does not exist
+
+    Example:
+    - GET request: /catalogs/1/stats
+    """
+    with storage.read_session() as session:
+        stats = session.get(CatalogStats, id)
+        if stats is None and session.get(Catalog, id) is None:
+            json_response = jsonify({
+                'error': f'catalog {id} not found'
+            })
+            return make_response(json_response, 404)
+        return jsonify(catalog_stats_info(id, stats))
+
+# Endpoint to recompute the inventory totals of every catalog
+
+
+@app.post('/catalogs/stats/rebuild')
+def rebuild_catalogs_stats():
+    """
+    Recompute the inventory totals of every catalog from the books,
+    e.g. after the database was edited by hand.
+
+    Input:
+    - None
+
+    Output:
+    - JSON response with the number of rebuilt catalogs
+
+    Example:
+    - POST request: /catalogs/stats/rebuild
+    """
+    def rebuild():
+        states = rebuild_catalog_stats(db.session, CatalogStats, Book)
+        record_stats_changes(states)
+        return len(states)
+
+    try:
+        rebuilt = storage.write(rebuild)
+    except Exception as e:
+        json_response = jsonify({
+            'error': e.__str__()
+        })
+        return make_response(json_response, 500)
+
+    log('rebuild catalog stats', method='POST', path='/catalogs/stats/rebuild',
+        catalogs=rebuilt)
     return jsonify({
         'success': True,
-        'catalog': catalog.name,
-        'catalog_id': catalog.id,
+        'catalogs': rebuilt,
     })
 
 # Endpoint to get all books
@@ -189,24 +711,33 @@ def create_catalog():
 @app.get('/books')
 def get_all_books():
     """
-    Get a list of all books.
+    Get a list of all books, one page at a time.
 
     Input:
-    - None
+    - Optional query parameter 'after' (book id, default 0)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+    - Optional query parameter 'format' ('ndjson' to stream every book
+      after 'after' as newline-delimited JSON)
 
     Output:
-    - JSON response containing a list of books
+    - JSON response containing a page of books and 'next_after', the
+      cursor of the next page (null on the last page)
 
     Example:
-    - GET request: /books
+    - GET request: /books?after=100&limit=50
+    - GET request: /books?format=ndjson
     """
     try:
-        books = db.session.execute(db.select(Book).order_by(Book.id)).scalars()
-        books_list = [{'id': book.id, 'name': book.name,
-                       'count': book.count, 'price': book.price} for book in books]
-        return jsonify({
-            'books': books_list
+        parse_page_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
         })
+        return make_response(json_response, 400)
+
+    try:
+        return list_rows_by_id(storage.read_session, [Book.id, Book.name, Book.count, Book.price],
+                               Book.id, 'books', request.args)
 
     except Exception as e:
         json_response = jsonify({
@@ -242,28 +773,275 @@ def create_book():
         })
         return make_response(json_response, 400)
 
-    book = Book(
-        name=name,
-        catalog_id=catalog,
-        count=count,
-        price=price,
-    )
+    def add_book():
+        book = Book(
+            name=name,
+            catalog_id=catalog,
+            count=count,
+            price=price,
+        )
+
+        db.session.add(book)
+        db.session.flush()
+        record_change('book', book_state(book))
+        update_catalog_stats(book.catalog_id, titles=1, units=book.count,
+                             stock_value=book.count * book.price)
+        return book_state(book)
 
-    db.session.add(book)
-    db.session.commit()
+    book = storage.write(add_book)
+    invalidate_books(response_cache, [book])
 
     # Emit an event to the replica server
     socketio.emit('catalog_change', {'catalog_info': {
                   'id': catalog, 'name': name}}, namespace='/replica')
     socketio.emit('book_change', {'book_info': {
-                  'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+                  'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
 
     return jsonify({
         'success': True,
-        'book': book.name,
-        'book_id': book.id,
+        'book': book['name'],
+        'book_id': book['id'],
     })
 
+# Number of rows inserted per transaction by the bulk import, and the maximum
+# number of rejected rows reported back
+IMPORT_CHUNK_SIZE = 5000
+MAX_IMPORT_ERRORS = 100
+
+
+# Functions to validate one imported row (raise ValueError if it is invalid)
+def validate_catalog_row(record):
+    name = (record.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    return {
+        'id': int(record['id']) if record.get('id') not in (None, '') else None,
+        'name': name,
+    }
+
+
+def validate_book_row(record):
+    row = validate_catalog_row(record)
+    row['catalog_id'] = int(record.get('catalog_id') or record['catalog'])
+    row['count'] = int(record['count'])
+    row['price'] = float(record['price'])
+    if row['count'] < 0 or row['price'] < 0:
+        raise ValueError('count and price must not be negative')
+    return row
+
+
+# Function to read the records of an uploaded CSV or NDJSON stream one at a
+# time, yielding (line number, record) with a dict record, or with the error
+# message if the line cannot be parsed
+def read_import_records(stream, import_format):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if import_format == 'csv':
+        reader = csv.DictReader(text_stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_no, line in enumerate(text_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            record = f'invalid JSON: {exc}'
+        yield line_no, record if isinstance(record, (dict, str)) else 'expected a JSON object'
+
+
+# Function to get the inventory deltas of each catalog caused by replacing
+# book states, given the states before (by id) and after, in write order
+def import_stats_deltas(previous, states):
+    deltas = {}
+
+    def add(state, sign):
+        delta = deltas.setdefault(
+            state['catalog_id'], {'titles': 0, 'units': 0, 'stock_value': 0})
+        delta['titles'] += sign
+        delta['units'] += sign * state['count']
+        delta['stock_value'] += sign * state['count'] * state['price']
+
+    for state in states:
+        if state['id'] in previous:
+            add(previous[state['id']], -1)
+        add(state, 1)
+        previous[state['id']] = state
+    return deltas
+
+
+# Function to insert or update one chunk of imported rows with executemany,
+# together with their change log entries and, for books, the catalog totals
+def insert_import_chunk(model, entity, columns, rows):
+    if model is Book:
+        ids = [row['id'] for row in rows if row['id'] is not None]
+        previous = {row.id: row._asdict() for row in db.session.execute(
+            select(Book.id, Book.catalog_id, Book.count, Book.price)
+            .where(Book.id.in_(ids)))}
+
+    statement = sqlite_insert(model)
+    statement = statement.on_conflict_do_update(
+        index_elements=['id'],
+        set_=dict({column: statement.excluded[column] for column in columns if column != 'id'},
+                  version=model.version + 1))
+    states = [row._asdict() for row in db.session.execute(
+        statement.returning(*[getattr(model, column) for column in columns], model.version),
+        rows)]
+
+    now = datetime.now()
+    seqs = db.session.execute(
+        db.insert(ChangeLog).returning(ChangeLog.seq),
+        [{'entity': entity, 'entity_id': state['id'], 'data': state, 'created_at': now}
+         for state in states]).scalars().all()
+
+    if model is Book:
+        for catalog_id, delta in import_stats_deltas(previous, states).items():
+            update_catalog_stats(catalog_id, **delta)
+    return {
+        'count': len(states),
+        'first_seq': min(seqs),
+        'last_seq': max(seqs),
+    }
+
+
+# Function to stream an upload into the database, IMPORT_CHUNK_SIZE rows per
+# transaction, and answer with a summary of imported and rejected rows
+def import_rows(model, entity, columns, validate):
+    import_format = request.args.get('format') or {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'ndjson',
+        'application/ndjson': 'ndjson',
+    }.get(request.mimetype)
+    if import_format not in ('csv', 'ndjson'):
+        json_response = jsonify({
+            'error': 'upload text/csv or application/x-ndjson, or pass format=csv|ndjson'
+        })
+        return make_response(json_response, 415)
+
+    summary = {'success': True, 'imported': 0,
+               'rejected': 0, 'chunks': 0, 'errors': []}
+
+    def flush(rows):
+        chunk = storage.write(insert_import_chunk, model, entity, columns, rows)
+        if model is Book:
+            # Imported rows may rename books, so every cached search is dropped
+            response_cache.clear()
+        summary['imported'] += chunk['count']
+        summary['chunks'] += 1
+        # One summary event per chunk instead of one event per row
+        socketio.emit(f'{entity}_import', chunk, namespace='/replica')
+
+    rows = []
+    for line_no, record in read_import_records(request.stream, import_format):
+        try:
+            if isinstance(record, str):
+                raise ValueError(record)
+            rows.append(validate(record))
+        except (KeyError, TypeError, ValueError) as exc:
+            summary['rejected'] += 1
+            if len(summary['errors']) < MAX_IMPORT_ERRORS:
+                summary['errors'].append({'line': line_no, 'error': exc.__str__()})
+            continue
+
+        if len(rows) >= IMPORT_CHUNK_SIZE:
+            flush(rows)
+            rows = []
+    if rows:
+        flush(rows)
+
+    log(f'import {entity}s', method='POST', imported=summary['imported'],
+        rejected=summary['rejected'])
+    return jsonify(summary)
+
+# Endpoint to import catalogs in bulk
+
+
+@app.post('/catalogs/import')
+def import_catalogs():
+    """
+    Import catalogs in bulk from a streamed CSV or NDJSON upload.
+    Rows are validated as they arrive and inserted 5000 per transaction.
+    A row with an existing id updates that catalog.
+
+    Input:
+    - Request body in CSV (with a header line) or NDJSON, with 'name' and
+      optional 'id' fields
+    - Content-Type text/csv or application/x-ndjson, or query parameter
+      'format' (csv or ndjson)
+
+    Output:
+    - JSON response with the number of imported and rejected rows and the
+      first rejected rows with their errors
+
+    Example:
+    - POST request: /catalogs/import?format=csv with body "id,name\n1,Fiction\n"
+    """
+    return import_rows(Catalog, 'catalog', ['id', 'name'], validate_catalog_row)
+
+# Endpoint to import books in bulk
+
+
+@app.post('/books/import')
+def import_books():
+    """
+    Import books in bulk from a streamed CSV or NDJSON upload.
+    Rows are validated as they arrive and inserted 5000 per transaction
+    with executemany. A row with an existing id updates that book.
+
+    Input:
+    - Request body in CSV (with a header line) or NDJSON, with 'name',
+      'catalog', 'count', 'price' and optional 'id' fields
+    - Content-Type text/csv or application/x-ndjson, or query parameter
+      'format' (csv or ndjson)
+
+    Output:
+    - JSON response with the number of imported and rejected rows and the
+      first rejected rows with their errors
+
+    Example:
+    - POST request: /books/import with Content-Type application/x-ndjson and body
+      {"name": "New Book", "catalog": 1, "count": 10, "price": 20.5}
+    """
+    return import_rows(Book, 'book', ['id', 'name', 'count', 'price', 'catalog_id'],
+                       validate_book_row)
+
+# Endpoint to list the books of a catalog
+
+
+@app.get('/books/search/<int:id>')
+def get_catalog_books(id):
+    """
+    List the books of a catalog, one page at a time, ordered by id, price
+    or name. Pages are read with keyset pagination from composite indexes
+    on (catalog_id, ...), so every page costs the same.
+
+    Input:
+    - Catalog ID (integer)
+    - Optional query parameter 'order' ('id', 'price' or 'name', default 'id')
+    - Optional query parameter 'cursor' ('next_cursor' of the previous page)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+    - Optional If-None-Match header with the ETag of a previous response
+
+    Output:
+    - JSON response containing a page of books and 'next_cursor', the
+      cursor of the next page (null on the last page), with an ETag
+      (304 Not Modified if it matches If-None-Match)
+
+    Example:
+    - GET request: /books/search/1?order=price&limit=50
+    """
+    try:
+        parse_catalog_listing_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    data, etag = list_catalog_books(storage.read_session, Book, id, request.args)
+    return conditional_response(data, etag)
+
 # Endpoint to search for books by name
 
 
@@ -274,19 +1052,24 @@ def search_books(name):
 
     Input:
     - Book name (string)
+    - Optional If-None-Match header with the ETag of a previous response
 
     Output:
-    - JSON response containing a list of matching books
+    - JSON response containing a list of matching books, with an ETag
+      (304 Not Modified if it matches If-None-Match)
 
     Example:
     - GET request: /books/search/New Book
     """
-    books = db.session.execute(db.select(Book).filter_by(name=name)).scalars()
-    books_list = [{'name': book.name, 'price': book.price, 'id': book.id}
-                  for book in books]
-    return jsonify({
-        'books': books_list
-    })
+    def search():
+        with storage.read_session() as session:
+            books = session.execute(
+                db.select(Book).filter_by(name=name).order_by(Book.id)).scalars().all()
+            books_list = [{'name': book.name, 'price': book.price, 'id': book.id}
+                          for book in books]
+        return {'books': books_list}, 200, rows_etag(books)
+
+    return cached_response(response_cache, ('search', name), search)
 
 # Endpoint to get books by name using a search string
 
@@ -294,29 +1077,54 @@ def search_books(name):
 @app.get('/books/find')
 def get_book_by_name():
     """
-    Get books by name using a search string.
+    Get books by name using a search string. Every word of the search
+    string is matched as a prefix against the full-text index on book
+    names, and the best matches are returned first.
 
     Input:
     - Query parameter 'name' (string)
+    - Optional query parameter 'limit' (integer, default 20, at most 100)
+    - Optional If-None-Match header with the ETag of a previous response
 
     Output:
-    - JSON response containing a list of matching books
+    - JSON response containing a list of matching books, with an ETag
+      (304 Not Modified if it matches If-None-Match)
 
     Example:
-    - GET request: /books/find?name=New
+    - GET request: /books/find?name=New&limit=10
     """
     search_string = request.args.get('name', '')
-    books = db.session.query(Book).filter(
-        or_(Book.name.like(f"%{search_string}%"))).all()
-
-    book_info = [{
-        'id': book.id,
-        'name': book.name,
-        'count': book.count
-    } for book in books]
-    return jsonify({
+    try:
+        limit = parse_search_limit(request.args)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    match_query = build_match_query(search_string)
+    with storage.read_session() as session:
+        if match_query:
+            books = session.execute(text("""
+                SELECT book.id, book.name, book.count, book.version
+                FROM book_fts JOIN book ON book.id = book_fts.rowid
+                WHERE book_fts MATCH :query
+                ORDER BY book_fts.rank
+                LIMIT :limit"""), {'query': match_query, 'limit': limit})
+        else:
+            books = session.execute(
+                db.select(Book.id, Book.name, Book.count, Book.version)
+                .order_by(Book.id).limit(limit))
+        books = books.all()
+
+        book_info = [{
+            'id': book.id,
+            'name': book.name,
+            'count': book.count
+        } for book in books]
+    return conditional_response({
         'books': book_info
-    })
+    }, rows_etag(books))
 
 # Endpoint to get information about a specific book by ID
 
@@ -328,23 +1136,27 @@ def get_book(id):
 
     Input:
     - Book ID (integer)
+    - Optional If-None-Match header with the ETag of a previous response
 
     Output:
-    - JSON response containing information about the book
+    - JSON response containing information about the book, with an ETag
+      (304 Not Modified if it matches If-None-Match)
 
     Example:
     - GET request: /books/1
     """
-    try:
-        book = Book.query.filter_by(id=id).first()
+    def get():
+        with storage.read_session() as session:
+            book = session.get(Book, id)
         book_info = dict({
             'id': book.id,
             'name': book.name,
             'count': book.count
         })
-        return jsonify({
-            'books': book_info
-        })
+        return {'books': book_info}, 200, f'book-{book.id}-v{book.version}'
+
+    try:
+        return cached_response(response_cache, ('book', id), get)
     except Exception as exc:
         json_response = jsonify({
             'error': exc.__str__()
@@ -373,18 +1185,21 @@ def stock_availability(id):
     Example:
     - GET request: /books/1/stock/availability
     """
-    book = Book.query.filter_by(id=id).first()
-    if book.count == 0:
-        json_response = jsonify({
-            'success': False,
-            'message': 'Out of stock'
-        })
-        return make_response(json_response, 403)
+    def availability():
+        with storage.read_session() as session:
+            book = session.get(Book, id)
+        if book.count == 0:
+            return {
+                'success': False,
+                'message': 'Out of stock'
+            }, 403, None
 
-    return jsonify({
-        'success': True,
-        'left': book.count
-    })
+        return {
+            'success': True,
+            'left': book.count
+        }, 200, None
+
+    return cached_response(response_cache, ('availability', id), availability)
 
 
 # Endpoint to increase the stock count of a book by ID
@@ -402,17 +1217,24 @@ def increase_book_stock(id):
     Example:
     - PUT request: /books/1/count/increase
     """
-    try:
-        book = Book.query.filter_by(id=id).first()
+    def increase():
+        book = db.session.get(Book, id)
         book.count = book.count + 1
-        db.session.commit()
+        book.version = book.version + 1
+        record_change('book', book_state(book))
+        update_catalog_stats(book.catalog_id, units=1, stock_value=book.price)
+        return book_state(book)
+
+    try:
+        book = storage.write(increase)
+        invalidate_books(response_cache, [book])
 
         # Emit an event to the replica server
         socketio.emit('book_change', {'book_info': {
-                      'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+                      'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
 
         return jsonify({
-            'count': book.count,
+            'count': book['count'],
         })
     except Exception as e:
         json_response = jsonify({
@@ -438,17 +1260,24 @@ def decrease_book_stock(id):
     Example:
     - PUT request: /books/1/count/decrease
     """
-    try:
-        book = Book.query.filter_by(id=id).first()
+    def decrease():
+        book = db.session.get(Book, id)
         book.count = book.count - 1
-        db.session.commit()
+        book.version = book.version + 1
+        record_change('book', book_state(book))
+        update_catalog_stats(book.catalog_id, units=-1, stock_value=-book.price)
+        return book_state(book)
+
+    try:
+        book = storage.write(decrease)
+        invalidate_books(response_cache, [book])
 
         # Emit an event to the replica server
         socketio.emit('book_change', {'book_info': {
-                      'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+                      'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
 
         return jsonify({
-            'count': book.count,
+            'count': book['count'],
         })
     except Exception as e:
         json_response = jsonify({
@@ -457,6 +1286,175 @@ def decrease_book_stock(id):
 
         return make_response(json_response, 404)
 
+# Endpoint to atomically check and decrease the stock count of a book by ID
+
+
+@app.put('/books/<int:id>/count/reserve')
+def reserve_book_stock(id):
+    """
+    Reserve stock of a book by ID: check availability and decrease the
+    count in a single conditional UPDATE, so the count can never go negative.
+
+    Input:
+    - Book ID (integer)
+    - Optional form data with 'quantity' parameter (default 1)
+
+    Output:
+    - JSON response containing the updated book, 403 if not enough stock
+      is left, 404 if the book does not exist
+
+    Example:
+    - PUT request: /books/1/count/reserve with form data {'quantity': 2}
+    """
+    try:
+        quantity = int(request.form.get('quantity', 1))
+        if quantity < 1:
+            raise ValueError('quantity must be a positive integer')
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    def reserve():
+        book = db.session.execute(
+            db.update(Book)
+            .where(Book.id == id, Book.count >= quantity)
+            .values(count=Book.count - quantity, version=Book.version + 1)
+            .returning(Book.id, Book.name, Book.count, Book.price, Book.catalog_id, Book.version)
+        ).first()
+
+        if book is None:
+            if db.session.get(Book, id) is None:
+                raise WriteAborted(404, {
+                    'error': f'book {id} not found'
+                })
+            raise WriteAborted(403, {
+                'success': False,
+                'message': 'Out of stock'
+            })
+
+        record_change('book', book._asdict())
+        update_catalog_stats(book.catalog_id, units=-quantity,
+                             stock_value=-quantity * book.price)
+        return book._asdict()
+
+    try:
+        book = storage.write(reserve)
+    except WriteAborted as exc:
+        return make_response(jsonify(exc.body), exc.status)
+    invalidate_books(response_cache, [book])
+
+    # Emit an event to the replica server
+    socketio.emit('book_change', {'book_info': {
+                  'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
+
+    return jsonify({
+        'books': {
+            'id': book['id'],
+            'name': book['name'],
+            'count': book['count'],
+            'price': book['price'],
+        }
+    })
+
+
+# Function to parse a list of {'id': ..., 'quantity': ...} items into {id: quantity}
+def parse_reserve_items(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get('items'), list):
+        raise ValueError("expected a JSON body with an 'items' list")
+
+    items = {}
+    for item in payload['items']:
+        book_id = int(item['id'])
+        quantity = int(item.get('quantity', 1))
+        if quantity < 1:
+            raise ValueError(f'quantity for book {book_id} must be a positive integer')
+        # Several lines for the same book are merged into one reservation
+        items[book_id] = items.get(book_id, 0) + quantity
+
+    if not items:
+        raise ValueError('no items were provided')
+    return items
+
+# Endpoint to atomically reserve stock for several books at once
+
+
+@app.put('/books/count/reserve')
+def reserve_books_stock():
+    """
+    Reserve stock for several books in one all-or-nothing transaction.
+    Either every item is reserved, or nothing is changed.
+
+    Input:
+    - JSON body with an 'items' list of {'id': book id, 'quantity': count}
+
+    Output:
+    - JSON response containing the updated books, 403 if any book does not
+      have enough stock left, 404 if any book does not exist
+
+    Example:
+    - PUT request: /books/count/reserve with JSON
+      {'items': [{'id': 1, 'quantity': 2}, {'id': 3, 'quantity': 1}]}
+    """
+    try:
+        items = parse_reserve_items(request.get_json(silent=True))
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    def reserve_all():
+        books = []
+        for book_id, quantity in items.items():
+            book = db.session.execute(
+                db.update(Book)
+                .where(Book.id == book_id, Book.count >= quantity)
+                .values(count=Book.count - quantity, version=Book.version + 1)
+                .returning(Book.id, Book.name, Book.count, Book.price, Book.catalog_id, Book.version)
+            ).first()
+
+            # Raising rolls back the reservations made so far for this cart
+            if book is None:
+                if db.session.get(Book, book_id) is None:
+                    raise WriteAborted(404, {
+                        'error': f'book {book_id} not found',
+                        'id': book_id,
+                    })
+                raise WriteAborted(403, {
+                    'success': False,
+                    'message': 'Out of stock',
+                    'id': book_id,
+                })
+
+            record_change('book', book._asdict())
+            update_catalog_stats(book.catalog_id, units=-quantity,
+                                 stock_value=-quantity * book.price)
+            books.append(dict(book._asdict(), quantity=quantity))
+        return books
+
+    try:
+        books = storage.write(reserve_all)
+    except WriteAborted as exc:
+        return make_response(jsonify(exc.body), exc.status)
+    invalidate_books(response_cache, books)
+
+    # Emit an event to the replica server
+    for book in books:
+        socketio.emit('book_change', {'book_info': {
+                      'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
+
+    return jsonify({
+        'books': [{
+            'id': book['id'],
+            'name': book['name'],
+            'count': book['count'],
+            'price': book['price'],
+            'quantity': book['quantity'],
+        } for book in books]
+    })
+
 # Endpoint to update the price of a book by ID
 
 
@@ -475,19 +1473,26 @@ def update_book_price(id):
     Example:
     - PUT request: /books/1/price with form data {'price': 25.5}
     """
+    def set_price(price):
+        book = db.session.get(Book, id)
+        update_catalog_stats(book.catalog_id, stock_value=book.count * (price - book.price))
+        book.price = price
+        book.version = book.version + 1
+        record_change('book', book_state(book))
+        return book_state(book)
+
     try:
         price = float(request.form['price'])
 
-        book = Book.query.filter_by(id=id).first()
-        book.price = price
-        db.session.commit()
+        book = storage.write(set_price, price)
+        invalidate_books(response_cache, [book])
 
         # Emit an event to the replica server
         socketio.emit('book_change', {'book_info': {
-                      'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+                      'id': book['id'], 'name': book['name'], 'catalog': book['catalog_id']}}, namespace='/replica')
 
         return jsonify({
-            'price': book.price,
+            'price': book['price'],
         })
     except Exception as e:
         json_response = jsonify({
@@ -497,6 +1502,508 @@ def update_book_price(id):
         return make_response(json_response, 404)
 
 
+# Maximum number of operations of one /books/batch request
+MAX_BATCH_OPERATIONS = 10000
+
+
+# Function to parse a list of {'id': ..., 'count_delta': ..., 'price': ...}
+# operations into rows of the book_batch table. Several operations on the same
+# book are merged: their count deltas add up and the last price wins.
+def parse_batch_operations(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get('operations'), list):
+        raise ValueError("expected a JSON body with an 'operations' list")
+    if len(payload['operations']) > MAX_BATCH_OPERATIONS:
+        raise ValueError(f'at most {MAX_BATCH_OPERATIONS} operations per request')
+
+    operations = {}
+    for operation in payload['operations']:
+        book_id = int(operation['id'])
+        count_delta = int(operation.get('count_delta', 0))
+        price = operation.get('price')
+        if price is not None:
+            price = float(price)
+            if price < 0:
+                raise ValueError(f'price for book {book_id} must not be negative')
+        elif not count_delta:
+            raise ValueError(f'operation for book {book_id} has no count_delta or price')
+
+        merged = operations.setdefault(
+            book_id, {'id': book_id, 'count_delta': 0, 'price': None})
+        merged['count_delta'] += count_delta
+        if price is not None:
+            merged['price'] = price
+
+    if not operations:
+        raise ValueError('no operations were provided')
+    return list(operations.values())
+
+
+# Function to apply batch operations with set-based statements: the operations
+# are loaded into a temporary table and joined with the books, so the whole
+# batch is checked, applied and logged with a handful of statements
+def apply_book_batch(operations):
+    db.session.execute(text("""
+        CREATE TEMP TABLE IF NOT EXISTS book_batch (
+            id INTEGER PRIMARY KEY, count_delta INTEGER NOT NULL, price REAL)"""))
+    db.session.execute(text('DELETE FROM book_batch'))
+    db.session.execute(text(
+        'INSERT INTO book_batch (id, count_delta, price) VALUES (:id, :count_delta, :price)'),
+        operations)
+
+    missing = db.session.execute(text("""
+        SELECT book_batch.id FROM book_batch LEFT JOIN book ON book.id = book_batch.id
+        WHERE book.id IS NULL ORDER BY book_batch.id""")).scalars().all()
+    if missing:
+        raise WriteAborted(404, {
+            'error': 'books not found',
+            'ids': missing,
+        })
+
+    negative = db.session.execute(text("""
+        SELECT book.id FROM book JOIN book_batch ON book.id = book_batch.id
+        WHERE book.count + book_batch.count_delta < 0 ORDER BY book.id""")).scalars().all()
+    if negative:
+        raise WriteAborted(403, {
+            'success': False,
+            'message': 'count would become negative',
+            'ids': negative,
+        })
+
+    # Catalog totals deltas, computed from the counts and prices before the update
+    deltas = db.session.execute(text("""
+        SELECT book.catalog_id,
+               SUM(book_batch.count_delta) AS units,
+               SUM((book.count + book_batch.count_delta) * COALESCE(book_batch.price, book.price)
+                   - book.count * book.price) AS stock_value
+        FROM book JOIN book_batch ON book.id = book_batch.id
+        GROUP BY book.catalog_id""")).all()
+
+    states = [row._asdict() for row in db.session.execute(text("""
+        UPDATE book SET
+            count = book.count + book_batch.count_delta,
+            price = COALESCE(book_batch.price, book.price),
+            version = book.version + 1
+        FROM book_batch WHERE book.id = book_batch.id
+        RETURNING id, name, count, price, catalog_id, version"""))]
+
+    now = datetime.now()
+    seqs = db.session.execute(
+        db.insert(ChangeLog).returning(ChangeLog.seq),
+        [{'entity': 'book', 'entity_id': state['id'], 'data': state, 'created_at': now}
+         for state in states]).scalars().all()
+    for delta in deltas:
+        update_catalog_stats(delta.catalog_id, units=delta.units,
+                             stock_value=delta.stock_value)
+    db.session.execute(text('DELETE FROM book_batch'))
+
+    return {
+        'count': len(states),
+        'first_seq': min(seqs),
+        'last_seq': max(seqs),
+        'books': sorted(states, key=lambda state: state['id']),
+    }
+
+# Endpoint to change the stock count and price of many books at once
+
+
+@app.put('/books/batch')
+def update_books_batch():
+    """
+    Change the stock count and/or the price of many books in one
+    all-or-nothing transaction, applied with set-based UPDATEs.
+
+    Input:
+    - JSON body with an 'operations' list of {'id': book id,
+      'count_delta': units to add (negative to remove), 'price': new price},
+      'count_delta' and 'price' are both optional but one is required
+
+    Output:
+    - JSON response containing the updated books, 403 if a count would
+      become negative, 404 if any book does not exist
+
+    Example:
+    - PUT request: /books/batch with JSON
+      {'operations': [{'id': 1, 'count_delta': 500}, {'id': 2, 'price': 19.5}]}
+    """
+    try:
+        operations = parse_batch_operations(request.get_json(silent=True))
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    try:
+        batch = storage.write(apply_book_batch, operations)
+    except WriteAborted as exc:
+        return make_response(jsonify(exc.body), exc.status)
+    invalidate_books(response_cache, batch['books'])
+
+    log('batch update books', method='PUT', path='/books/batch',
+        books=batch['count'])
+
+    # One event for the whole batch, the rows arrive through the change log
+    socketio.emit('book_batch_change', {
+        'count': batch['count'],
+        'first_seq': batch['first_seq'],
+        'last_seq': batch['last_seq'],
+    }, namespace='/replica')
+
+    return jsonify({
+        'success': True,
+        'books': batch['books'],
+    })
+
+
+# Lifetime of a stock lease, and the most units one holder may lease of a book
+LEASE_TTL = timedelta(seconds=30)
+MAX_LEASE_UNITS = 1000
+
+# How long after its expiry the reclaimable units of a lease are taken back,
+# and how often expired leases are looked for (seconds)
+LEASE_GRACE = timedelta(seconds=10)
+RECLAIM_INTERVAL = 5
+
+
+# Function to parse a lease request {'holder': ..., 'want': ..., 'remaining': ...,
+# 'allowance': ...}. 'remaining' is required by returns and renewals, absent
+# when acquiring. 'allowance' is the most units the holder may sell before its
+# next report (default: every unit, so none can be reclaimed).
+def parse_lease_request(payload, require_remaining=False):
+    if not isinstance(payload, dict):
+        raise ValueError('expected a JSON body')
+    holder = payload.get('holder')
+    if not isinstance(holder, str) or not 1 <= len(holder) <= 32:
+        raise ValueError("'holder' must have 1 to 32 characters")
+
+    want = int(payload.get('want', 0))
+    if not 0 <= want <= MAX_LEASE_UNITS:
+        raise ValueError(f"'want' must be between 0 and {MAX_LEASE_UNITS}")
+
+    remaining = payload.get('remaining')
+    if remaining is None:
+        if require_remaining:
+            raise ValueError("'remaining' is required")
+    else:
+        remaining = int(remaining)
+        if remaining < 0:
+            raise ValueError("'remaining' must not be negative")
+
+    allowance = payload.get('allowance')
+    if allowance is not None:
+        allowance = int(allowance)
+        if allowance < 0:
+            raise ValueError("'allowance' must not be negative")
+    return holder, want, remaining, allowance
+
+
+# Function to move units between the count of a book and its leases, and
+# record the change (committed by the caller)
+def adjust_leased_stock(book, units):
+    book.count = book.count + units
+    book.version = book.version + 1
+    record_change('book', book_state(book))
+    update_catalog_stats(book.catalog_id, units=units, stock_value=units * book.price)
+
+
+# Function to get the response describing a lease
+def lease_info(state, units, granted=0, returned=0):
+    return {
+        'books': {
+            'id': state['id'],
+            'name': state['name'],
+            'count': state['count'],
+            'price': state['price'],
+        },
+        'units': units,
+        'granted': granted,
+        'returned': returned,
+        'ttl': LEASE_TTL.total_seconds(),
+    }
+
+# Endpoint to acquire, renew or refill a stock lease
+
+
+@app.put('/books/<int:id>/lease')
+def lease_book_stock(id):
+    """
+    Lease units of a book to an order server, which then sells them
+    locally. The units are taken out of the count, at most as many as are
+    left. A renewal reports the units the holder has not sold yet and
+    extends the lease by LEASE_TTL; it may ask for more units at the same
+    time. An expired lease cannot be renewed, it must be returned first.
+    Units beyond the holder's 'allowance' are reclaimed into the count
+    LEASE_GRACE after the lease expires, if it is not returned by then.
+
+    Input:
+    - Book ID (integer)
+    - JSON body with 'holder' (name of the order server), 'want' (units the
+      holder wants to hold, at most 1000), optionally 'allowance' (the most
+      units it will sell before its next report) and, to renew, 'remaining'
+      (units the holder has not sold)
+
+    Output:
+    - JSON response containing the book, the 'units' now leased, the
+      units 'granted' by this call and the 'ttl' of the lease in seconds,
+      404 if the book does not exist, 409 if the lease is unknown or expired
+
+    Example:
+    - PUT request: /books/1/lease with JSON
+      {'holder': 'original', 'want': 200, 'remaining': 35}
+    """
+    try:
+        holder, want, remaining, allowance = parse_lease_request(request.get_json(silent=True))
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    def lease():
+        book = db.session.get(Book, id)
+        if book is None:
+            raise WriteAborted(404, {
+                'error': f'book {id} not found'
+            })
+
+        now = datetime.now()
+        lease = db.session.get(StockLease, (holder, id))
+        if lease is None and remaining is not None:
+            raise WriteAborted(409, {
+                'error': f'{holder} holds no lease of book {id}'
+            })
+        if lease is not None and lease.expires_at <= now:
+            raise WriteAborted(409, {
+                'error': f'the lease of book {id} held by {holder} has expired'
+            })
+
+        held = 0
+        if lease is not None:
+            held = lease.units if remaining is None else min(remaining, lease.units)
+        granted = min(max(want - held, 0), book.count)
+        if granted:
+            adjust_leased_stock(book, -granted)
+
+        if lease is None:
+            if not granted:
+                return lease_info(book_state(book), 0)
+            lease = StockLease(holder=holder, book_id=id)
+            db.session.add(lease)
+        lease.units = held + granted
+        lease.reclaimable = 0 if allowance is None else max(lease.units - allowance, 0)
+        lease.expires_at = now + LEASE_TTL
+        return lease_info(book_state(book), lease.units, granted=granted)
+
+    try:
+        info = storage.write(lease)
+    except WriteAborted as exc:
+        return make_response(jsonify(exc.body), exc.status)
+
+    if info['granted']:
+        invalidate_books(response_cache, [info['books']])
+        log('lease book stock', method='PUT', path=f'/books/{id}/lease',
+            holder=holder, granted=info['granted'])
+    return jsonify(info)
+
+# Endpoint to return a stock lease
+
+
+@app.delete('/books/<int:id>/lease')
+def return_book_stock(id):
+    """
+    End a stock lease: the units the holder has not sold go back to the
+    count of the book. Expired leases are returned the same way, less the
+    units already reclaimed; the count never gets back more units than the
+    lease holds.
+
+    Input:
+    - Book ID (integer)
+    - JSON body with 'holder' and 'remaining' (units the holder has not sold)
+
+    Output:
+    - JSON response containing the book and the units 'returned', 404 if
+      the holder has no lease of the book
+
+    Example:
+    - DELETE request: /books/1/lease with JSON {'holder': 'original', 'remaining': 12}
+    """
+    try:
+        holder, _, remaining, _ = parse_lease_request(
+            request.get_json(silent=True), require_remaining=True)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    def return_lease():
+        lease = db.session.get(StockLease, (holder, id))
+        if lease is None:
+            raise WriteAborted(404, {
+                'error': f'{holder} holds no lease of book {id}'
+            })
+        book = db.session.get(Book, id)
+        # The reclaimed units were unsold, so they are part of remaining
+        returned = max(min(remaining, lease.units) - lease.reclaimed, 0)
+        if returned:
+            adjust_leased_stock(book, returned)
+        db.session.delete(lease)
+        return lease_info(book_state(book), 0, returned=returned)
+
+    try:
+        info = storage.write(return_lease)
+    except WriteAborted as exc:
+        return make_response(jsonify(exc.body), exc.status)
+
+    if info['returned']:
+        invalidate_books(response_cache, [info['books']])
+    log('return book stock', method='DELETE', path=f'/books/{id}/lease',
+        holder=holder, returned=info['returned'])
+    return jsonify(info)
+
+# Function to take back the reclaimable units of the leases expired for more
+# than LEASE_GRACE, whose holder neither renewed nor returned them. The lease
+# is kept, with its reclaimed units, until the holder returns it.
+def reclaim_expired_leases():
+    def reclaim():
+        expired = db.session.execute(
+            select(StockLease)
+            .where(StockLease.expires_at <= datetime.now() - LEASE_GRACE)
+            .where(StockLease.reclaimable > StockLease.reclaimed)
+        ).scalars().all()
+        reclaimed = []
+        for lease in expired:
+            units = lease.reclaimable - lease.reclaimed
+            book = db.session.get(Book, lease.book_id)
+            adjust_leased_stock(book, units)
+            lease.reclaimed = lease.reclaimable
+            reclaimed.append((lease.holder, units, book_state(book)))
+        return reclaimed
+
+    reclaimed = storage.write(reclaim)
+    if reclaimed:
+        invalidate_books(response_cache, [state for _, _, state in reclaimed])
+    for holder, units, state in reclaimed:
+        log('reclaim book stock', holder=holder, book_id=state['id'], reclaimed=units)
+    return reclaimed
+
+
+def reclaim_expired_leases_loop():
+    while True:
+        socketio.sleep(RECLAIM_INTERVAL)
+        try:
+            reclaim_expired_leases()
+        except Exception as e:
+            app.logger.warning(f'Reclaiming expired leases failed: {e}')
+
+# Endpoint to list the stock leases
+
+
+@app.get('/leases')
+def get_leases():
+    """
+    List the stock leases held by the order servers.
+
+    Input:
+    - Optional query parameter 'holder' (only the leases of this order server)
+
+    Output:
+    - JSON response containing every lease with its holder, book, units,
+      expiry, whether it has expired and its reclaimable and reclaimed units
+
+    Example:
+    - GET request: /leases?holder=original
+    """
+    query = select(StockLease).order_by(StockLease.book_id, StockLease.holder)
+    if 'holder' in request.args:
+        query = query.where(StockLease.holder == request.args['holder'])
+
+    now = datetime.now()
+    with storage.read_session() as session:
+        leases = session.execute(query).scalars()
+        leases_list = [{
+            'holder': lease.holder,
+            'book_id': lease.book_id,
+            'units': lease.units,
+            'expires_at': lease.expires_at.isoformat(),
+            'expired': lease.expires_at <= now,
+            'reclaimable': lease.reclaimable,
+            'reclaimed': lease.reclaimed,
+        } for lease in leases]
+    return jsonify({
+        'leases': leases_list,
+    })
+
+
+# Endpoint to get the hit, miss and eviction counters of the response cache
+
+
+@app.get('/cache/stats')
+def get_cache_stats():
+    """
+    Get the counters of the cache of serialized book, availability and
+    search responses.
+
+    Input:
+    - None
+
+    Output:
+    - JSON response with the number of entries, hits, misses, evictions
+      and invalidations
+
+    Example:
+    - GET request: /cache/stats
+    """
+    return jsonify(response_cache.stats())
+
+
+# Endpoint to get the changes made after a sequence number
+
+
+@app.get('/changes')
+def get_changes():
+    """
+    Get the catalog and book changes made after a sequence number, in order.
+    Replicas use it to catch up on the changes they missed.
+
+    Input:
+    - Optional query parameter 'after' (sequence number, default 0)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+
+    Output:
+    - JSON response containing the changes and 'last_seq', the sequence
+      number of the latest change
+
+    Example:
+    - GET request: /changes?after=1200&limit=500
+    """
+    try:
+        after, limit = parse_page_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    with storage.read_session() as session:
+        changes = session.execute(
+            db.select(ChangeLog).where(ChangeLog.seq > after)
+            .order_by(ChangeLog.seq).limit(limit)).scalars()
+        changes_list = [{
+            'seq': change.seq,
+            'entity': change.entity,
+            'entity_id': change.entity_id,
+            'data': change.data,
+            'created_at': change.created_at.isoformat(),
+        } for change in changes]
+        last_seq = session.execute(db.select(func.max(ChangeLog.seq))).scalar()
+
+    return jsonify({
+        'changes': changes_list,
+        'last_seq': last_seq or 0,
+    })
+
+
 # Socket.io event handler for handling catalog change
 @socketio.on('catalog_change_replica')
 def handle_catalog_change(message):
@@ -513,4 +2020,9 @@ def handle_catalog_change(message):
 
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 4000 in debug mode
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=4000, debug=True)
+    debug = True
+    # The reloader also runs this block in its watcher process; only the
+    # process serving requests reclaims expired leases
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        socketio.start_background_task(reclaim_expired_leases_loop)
+    socketio.run(app, host='0.0.0.0', port=4000, debug=debug)
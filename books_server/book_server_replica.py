@@ -1,11 +1,23 @@
 import os
+import threading
+import time
 from flask import Flask, jsonify, make_response, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy import Float, Integer, String, ForeignKey, or_
+from sqlalchemy import Float, Integer, String, ForeignKey, or_, text, select, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
 from flask_socketio import SocketIO
-from book_server import Book
+from storage import SQLiteStorage
+from service_client import ServiceClient, ServiceUnavailable, enforce_deadline
+from response_cache import ResponseCache
+from book_server import storage as storage_original, Catalog, ChangeLog
+from book_server import (Book, create_name_search_index,
+                         build_match_query, parse_search_limit, parse_page_args,
+                         list_rows_by_id, add_column_if_missing,
+                         rows_etag, conditional_response,
+                         rebuild_catalog_stats, catalog_stats_info, cached_response,
+                         invalidate_books, parse_catalog_listing_args, list_catalog_books)
 
 Base = declarative_base()
 
@@ -17,78 +29,326 @@ app_replica.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + \
     os.path.join(os.getcwd(), 'project_replica.db')
 app_replica.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Catalog server whose change log the replica follows
+original_url = "http://127.0.0.1:4000"
+
+# Change log polls time out, and fail fast while the original is down
+original_client = ServiceClient()
+
 # Initialize SQLAlchemy directly with the Flask app
 db_replica = SQLAlchemy(app_replica, model_class=Base)
 
+# WAL mode, pooled read connections and a single writer thread
+storage_replica = SQLiteStorage(db_replica)
+storage_replica.init_app(app_replica)
+
+# Answer 504 to requests whose caller has already given up
+enforce_deadline(app_replica)
+
+# Serialized GET responses, invalidated by local writes and applied changes
+response_cache_replica = ResponseCache()
+
 
 # Define SQLAlchemy models for Catalog and Book in the replica
 class CatalogReplica(db_replica.Model):
     __tablename__ = 'catalog_replica'  # Specify the table name
     id = db_replica.Column(db_replica.Integer, primary_key=True)
     name = db_replica.Column(db_replica.String)
+    version = db_replica.Column(db_replica.Integer, default=1, server_default='1')
 
 
 class BookReplica(db_replica.Model):
     __tablename__ = 'book_replica'  # Specify the table name
     id = db_replica.Column(db_replica.Integer, primary_key=True)
-    name = db_replica.Column(db_replica.String)
+    name = db_replica.Column(db_replica.String, index=True)
     count = db_replica.Column(db_replica.Integer, default=1)
     price = db_replica.Column(db_replica.Float, default=0)
     catalog_id = db_replica.Column(
-        db_replica.Integer, db_replica.ForeignKey(CatalogReplica.id))
+        db_replica.Integer, db_replica.ForeignKey(CatalogReplica.id), index=True)
     catalog = db_replica.relationship(CatalogReplica)
+    version = db_replica.Column(db_replica.Integer, default=1, server_default='1')
+
+    # Covering indexes of the catalog listing ordered by price or by name
+    __table_args__ = (
+        db_replica.Index('ix_book_replica_catalog_price',
+                         'catalog_id', 'price', 'id', 'name', 'count', 'version'),
+        db_replica.Index('ix_book_replica_catalog_name',
+                         'catalog_id', 'name', 'id', 'price', 'count', 'version'),
+    )
 
 
-with app_replica.app_context():
-    db_replica.create_all()
+class CatalogStatsReplica(db_replica.Model):
+    __tablename__ = 'catalog_stats_replica'  # Specify the table name
+    catalog_id = db_replica.Column(
+        db_replica.Integer, db_replica.ForeignKey(CatalogReplica.id), primary_key=True)
+    titles = db_replica.Column(db_replica.Integer, default=0)
+    units = db_replica.Column(db_replica.Integer, default=0)
+    stock_value = db_replica.Column(db_replica.Float, default=0)
 
 
+# Key/value table holding the replication high-water marks of the replica
+class ReplicaSyncState(db_replica.Model):
+    __tablename__ = 'replica_sync_state'  # Specify the table name
+    name = db_replica.Column(db_replica.String, primary_key=True)
+    value = db_replica.Column(db_replica.Integer, default=0)
 
-# Define a flag to ensure data copy happens only once
-data_copy_done = False
 
-# Function to copy data from the original to the replica
+# Schema migrations of project_replica.db, the replica counterparts of
+# book_server.MIGRATIONS. Only ever append to MIGRATIONS_REPLICA.
+def add_version_columns_replica(session):
+    add_column_if_missing(session, 'catalog_replica', 'version', 'INTEGER NOT NULL DEFAULT 1')
+    add_column_if_missing(session, 'book_replica', 'version', 'INTEGER NOT NULL DEFAULT 1')
 
 
-# Function to copy data from the original to the replica
-def copy_data_from_original_to_replica():
-    try:
-        global data_copy_done
-        if not data_copy_done:
-            with app_replica.app_context():
-                # Fetch all books from the original database
-                books_original = Book.query.all()
-
-                # Copy each book to the replica database
-                for book_original in books_original:
-                    book_replica = BookReplica(
-                        id=book_original.id,
-                        name=book_original.name,
-                        count=book_original.count,
-                        price=book_original.price,
-                        catalog_id=book_original.catalog_id
-                    )
-                    # Add and commit the copied book to the replica database
-                    with app_replica.app_context():
-                        db_replica.session.add(book_replica)
-                        db_replica.session.commit()
-
-              
-                data_copy_done = True
-
-        return True
+def add_book_indexes_replica(session):
+    session.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_book_replica_name ON book_replica (name)'))
+    session.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_book_replica_catalog_id ON book_replica (catalog_id)'))
+
+
+def add_catalog_listing_indexes_replica(session):
+    session.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_book_replica_catalog_price
+        ON book_replica (catalog_id, price, id, name, count, version)"""))
+    session.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_book_replica_catalog_name
+        ON book_replica (catalog_id, name, id, price, count, version)"""))
+
 
+MIGRATIONS_REPLICA = [
+    add_version_columns_replica,
+    add_book_indexes_replica,
+    add_catalog_listing_indexes_replica,
+]
+
+
+with app_replica.app_context():
+    db_replica.create_all()
+    for migration in storage_replica.run_migrations(MIGRATIONS_REPLICA):
+        app_replica.logger.info(f'Applied migration {MIGRATIONS_REPLICA.index(migration) + 1}: '
+                                f'{migration.__name__}')
+    create_name_search_index(
+        db_replica.session, 'book_replica', 'book_replica_fts')
+
+
+
+# Number of rows copied from the original per transaction during bootstrap
+BOOTSTRAP_BATCH_SIZE = 5000
+
+# Progress of the startup bootstrap, exposed on /replica/status
+bootstrap_progress = {
+    'status': 'pending',
+    'catalogs': 0,
+    'books': 0,
+    'seconds': 0.0,
+    'rows_per_second': 0.0,
+}
+
+
+# Function to read a high-water mark of the replica (None if it was never set)
+def get_sync_state(name):
+    with storage_replica.read_session() as session:
+        state = session.get(ReplicaSyncState, name)
+    return state.value if state else None
+
+
+# Function to set a high-water mark of the replica (committed by the caller)
+def set_sync_state(name, value):
+    db_replica.session.merge(ReplicaSyncState(name=name, value=value))
+
+
+# Function to insert or update replica rows with one executemany statement
+def upsert_rows(model, rows):
+    keys = model.__table__.primary_key.columns.keys()
+    statement = sqlite_insert(model)
+    statement = statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={key: statement.excluded[key] for key in rows[0] if key not in keys})
+    db_replica.session.execute(statement, rows)
+
+
+# Function to write one bootstrap batch and its high-water mark in one transaction
+def copy_batch(target, rows, state_name, last_id):
+    upsert_rows(target, rows)
+    set_sync_state(state_name, last_id)
+
+
+# Function to copy one table from the original in id order, BOOTSTRAP_BATCH_SIZE
+# rows per transaction. The id of the last copied row is committed with each
+# batch, so an interrupted bootstrap resumes where it stopped.
+def copy_table_from_original(source, target, columns, progress_key, started_at):
+    last_id = get_sync_state(f'bootstrap_{progress_key}') or 0
+
+    while True:
+        with storage_original.read_session() as session:
+            rows = [row._asdict() for row in session.execute(
+                select(*[getattr(source, column) for column in columns])
+                .where(source.id > last_id)
+                .order_by(source.id)
+                .limit(BOOTSTRAP_BATCH_SIZE))]
+        if not rows:
+            return
+
+        last_id = rows[-1]['id']
+        storage_replica.write(copy_batch, target, rows,
+                              f'bootstrap_{progress_key}', last_id)
+
+        bootstrap_progress[progress_key] += len(rows)
+        elapsed = time.time() - started_at
+        copied = bootstrap_progress['catalogs'] + bootstrap_progress['books']
+        bootstrap_progress['seconds'] = round(elapsed, 3)
+        bootstrap_progress['rows_per_second'] = round(copied / elapsed, 1) if elapsed else 0.0
+        print(f"Replica bootstrap: {bootstrap_progress[progress_key]} {progress_key} copied "
+              f"(up to id {last_id}, {bootstrap_progress['rows_per_second']} rows/s)")
+
+
+# Function to copy catalogs and books from the original to the replica.
+# Runs once at startup, before the replica accepts traffic.
+def bootstrap_replica():
+    started_at = time.time()
+    bootstrap_progress.update(status='running', catalogs=0, books=0)
+    try:
+        # Changes made while copying are replayed from this point afterwards
+        if get_sync_state('change_seq') is None:
+            with storage_original.read_session() as session:
+                change_seq = session.execute(
+                    select(func.max(ChangeLog.seq))).scalar() or 0
+            storage_replica.write(set_sync_state, 'change_seq', change_seq)
+
+        # Catalogs first, books reference them
+        copy_table_from_original(Catalog, CatalogReplica, ['id', 'name', 'version'],
+                                 'catalogs', started_at)
+        copy_table_from_original(Book, BookReplica,
+                                 ['id', 'name', 'count', 'price', 'catalog_id', 'version'],
+                                 'books', started_at)
+        # The catalog totals are derived from the copied books
+        storage_replica.write(rebuild_catalog_stats, db_replica.session,
+                              CatalogStatsReplica, BookReplica)
+        bootstrap_progress['status'] = 'done'
     except Exception as e:
-        return False
+        bootstrap_progress['status'] = 'failed'
+        bootstrap_progress['error'] = e.__str__()
+        app_replica.logger.error(f"Replica bootstrap failed: {e}")
+        raise
+
+    print(f"Replica bootstrap finished in {bootstrap_progress['seconds']} seconds: "
+          f"{bootstrap_progress['catalogs']} catalogs, {bootstrap_progress['books']} books")
+
+
+# Number of changes pulled from the original per request, and the pause
+# between two polls once the replica has caught up
+CHANGES_BATCH_SIZE = 1000
+CHANGES_POLL_INTERVAL = 1.0
+
+# Replication lag of the replica, exposed on /replica/status
+replication_status = {
+    'connected': False,
+    'applied_seq': 0,
+    'original_seq': 0,
+    'lag_changes': 0,
+    'lag_seconds': 0.0,
+    'last_pull_at': None,
+}
+
+
+# Function to apply a batch of changes from the original change log.
+# Only the latest state of each row is written, with one upsert per table.
+def apply_changes(changes):
+    latest = {'catalog': {}, 'book': {}, 'catalog_stats': {}}
+    for change in changes:
+        latest[change['entity']][change['entity_id']] = change['data']
+
+    if latest['catalog']:
+        upsert_rows(CatalogReplica, list(latest['catalog'].values()))
+    if latest['book']:
+        upsert_rows(BookReplica, list(latest['book'].values()))
+    if latest['catalog_stats']:
+        upsert_rows(CatalogStatsReplica, list(latest['catalog_stats'].values()))
+    set_sync_state('change_seq', changes[-1]['seq'])
+
+
+# Function to pull and apply every change the replica has not seen yet
+def pull_changes_from_original():
+    applied_seq = get_sync_state('change_seq') or 0
+    while True:
+        response = original_client.get(f'{original_url}/changes', params={
+            'after': applied_seq, 'limit': CHANGES_BATCH_SIZE})
+        response.raise_for_status()
+        body = response.json()
+        changes = body['changes']
+
+        replication_status['connected'] = True
+        replication_status['original_seq'] = body['last_seq']
+        replication_status['last_pull_at'] = datetime.now().isoformat()
+
+        if changes:
+            storage_replica.write(apply_changes, changes)
+            invalidate_books(response_cache_replica, [
+                change['data'] for change in changes if change['entity'] == 'book'])
+            applied_seq = changes[-1]['seq']
+            # Age of the last applied change, i.e. how far behind the replica is
+            replication_status['lag_seconds'] = round((datetime.now() - datetime.fromisoformat(
+                changes[-1]['created_at'])).total_seconds(), 3)
+
+        replication_status['applied_seq'] = applied_seq
+        replication_status['lag_changes'] = max(body['last_seq'] - applied_seq, 0)
+
+        if len(changes) < CHANGES_BATCH_SIZE:
+            if not replication_status['lag_changes']:
+                replication_status['lag_seconds'] = 0.0
+            return
+
+
+# Set by a write forwarded to the original, to pull its change right away
+changes_pending = threading.Event()
+
+
+# Background task following the original change log. After a disconnect the
+# next successful poll applies every missed change in bulk.
+def replication_loop():
+    while True:
+        try:
+            pull_changes_from_original()
+        except Exception as e:
+            if replication_status['connected']:
+                app_replica.logger.warning(f"Lost connection to original: {e}")
+            replication_status['connected'] = False
+        changes_pending.wait(CHANGES_POLL_INTERVAL)
+        changes_pending.clear()
+
+
+# Function to send the current write request to the original catalog server
+# and answer with its response. Every row of the replica is a copy of the
+# original's, overwritten by the next change pulled for it, so the replica
+# never writes rows itself: the change comes back through the change log.
+def forward_to_original():
+    headers = {}
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+    try:
+        response = original_client.request(
+            request.method, f'{original_url}{request.path}', data=request.get_data(),
+            headers=headers, endpoint=f'{request.method} {original_url}{request.url_rule.rule}')
+    except ServiceUnavailable as e:
+        # The original did not answer: the write may or may not have happened
+        return make_response(jsonify({'error': str(e)}), e.status)
+
+    if response.status_code < 300:
+        changes_pending.set()
+    return make_response(response.content, response.status_code,
+                         {'Content-Type': response.headers.get('Content-Type', 'application/json')})
 
 
-# Run the data copy function before each request
+# Endpoint to get the replication status of the replica
 
 
-@app_replica.before_request
-def before_request():
-    with app_replica.app_context():
-        copy_data_from_original_to_replica()
+@app_replica.route('/replica/status')
+def replica_status():
+    return jsonify({
+        'bootstrap': bootstrap_progress,
+        'replication': replication_status,
+    })
 
 
 # Socket.io event handler for handling catalog change in replica
@@ -135,15 +395,29 @@ def handle_book_change_origin(message):
         app_replica.logger.warning("No book_info found in message")
 
 
+# Socket.io event handler for handling bulk imports and batch updates in origin
+
+
+@socketio_replica.on('book_import')
+@socketio_replica.on('catalog_import')
+@socketio_replica.on('book_batch_change')
+def handle_import_origin(message):
+    # The changed rows themselves arrive through the change log
+    print(f"Received bulk change from Origin: {message}")
+
+
 # Endpoint to get all catalogs in the replica
 @app_replica.route('/catalogs')
 def get_all_catalogs_replica():
     try:
-        catalogs = db_replica.session.execute(
-            db_replica.select(CatalogReplica).order_by(CatalogReplica.id)).scalars()
-        catalogs_list = [{'id': catalog.id, 'name': catalog.name}
-                         for catalog in catalogs]
-        return jsonify({'catalogs': catalogs_list})
+        parse_page_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({'error': exc.__str__()})
+        return make_response(json_response, 400)
+
+    try:
+        return list_rows_by_id(storage_replica.read_session, [CatalogReplica.id, CatalogReplica.name],
+                               CatalogReplica.id, 'catalogs', request.args)
     except Exception as e:
         json_response = jsonify({'error': e.__str__()})
         return make_response(json_response, 500)
@@ -153,27 +427,20 @@ def get_all_catalogs_replica():
 
 @app_replica.route('/catalogs', methods=['POST'])
 def create_catalog_replica():
-    try:
-        name = request.form['name']
-    except:
-        json_response = jsonify({'error': 'no name was provided'})
-        return make_response(json_response, 400)
-
-    catalog_replica = CatalogReplica(name=name)
+    return forward_to_original()
 
-    db_replica.session.add(catalog_replica)
-    db_replica.session.commit()
 
-    # Emit a Socket.IO event for catalog change to origin
-    socketio_replica.emit('catalog_change_replica', {'catalog_info': {
-                          'id': catalog_replica.id, 'name': catalog_replica.name}})
+# Endpoint to get the inventory totals of a catalog in the replica
 
-    return jsonify({
-        'success': True,
-        'catalog': catalog_replica.name,
-        'catalog_id': catalog_replica.id,
-    })
 
+@app_replica.route('/catalogs/<int:id>/stats')
+def get_catalog_stats_replica(id):
+    with storage_replica.read_session() as session:
+        stats = session.get(CatalogStatsReplica, id)
+        if stats is None and session.get(CatalogReplica, id) is None:
+            json_response = jsonify({'error': f'catalog {id} not found'})
+            return make_response(json_response, 404)
+        return jsonify(catalog_stats_info(id, stats))
 
 
 # Endpoint to get all books in the replica
@@ -182,13 +449,16 @@ def create_catalog_replica():
 @app_replica.route('/books', methods=['GET'])
 def get_all_books_replica():
     try:
-        books_replica = BookReplica.query.all()
-        books_list_replica = [{'id': book.id, 'name': book.name,
-                               'count': book.count, 'price': book.price} for book in books_replica]
+        parse_page_args(request.args)
+    except Exception as exc:
+        json_response = jsonify({'error': exc.__str__()})
+        return make_response(json_response, 400)
 
-        return jsonify({
-            'books': books_list_replica
-        })
+    try:
+        return list_rows_by_id(storage_replica.read_session,
+                               [BookReplica.id, BookReplica.name,
+                                   BookReplica.count, BookReplica.price],
+                               BookReplica.id, 'books', request.args)
 
     except Exception as e:
         json_response = jsonify({
@@ -200,34 +470,22 @@ def get_all_books_replica():
 # Endpoint to create a new book in the replica
 @app_replica.route('/books', methods=['POST'])
 def create_book_replica():
+    return forward_to_original()
+
+
+# Endpoint to list the books of a catalog in the replica
+
+
+@app_replica.route('/books/search/<int:id>')
+def get_catalog_books_replica(id):
     try:
-        name = request.form['name']
-        catalog = request.form['catalog']
-        count = int(request.form['count'])
-        price = int(request.form['price'])
+        parse_catalog_listing_args(request.args)
     except Exception as exc:
         json_response = jsonify({'error': exc.__str__()})
         return make_response(json_response, 400)
 
-    book_replica = BookReplica(
-        name=name,
-        catalog_id=catalog,
-        count=count,
-        price=price,
-    )
-
-    db_replica.session.add(book_replica)
-    db_replica.session.commit()
-
-    # Emit a Socket.IO event for book change to origin
-    socketio_replica.emit('book_change_replica', {'book_info': {
-                          'id': book_replica.id, 'name': book_replica.name, 'count': book_replica.count}})
-
-    return jsonify({
-        'success': True,
-        'book': book_replica.name,
-        'book_id': book_replica.id,
-    })
+    data, etag = list_catalog_books(storage_replica.read_session, BookReplica, id, request.args)
+    return conditional_response(data, etag)
 
 
 # Endpoint to search for books by name in the replica
@@ -235,13 +493,16 @@ def create_book_replica():
 
 @app_replica.route('/books/search/<string:name>')
 def search_books_replica(name):
-    books = db_replica.session.execute(
-        db_replica.select(BookReplica).filter_by(name=name)).scalars()
-    books_list = [{'name': book.name, 'price': book.price, 'id': book.id}
-                  for book in books]
-    return jsonify({
-        'books': books_list
-    })
+    def search():
+        with storage_replica.read_session() as session:
+            books = session.execute(
+                db_replica.select(BookReplica).filter_by(name=name)
+                .order_by(BookReplica.id)).scalars().all()
+            books_list = [{'name': book.name, 'price': book.price, 'id': book.id}
+                          for book in books]
+        return {'books': books_list}, 200, rows_etag(books)
+
+    return cached_response(response_cache_replica, ('search', name), search)
 
 # Endpoint to get books by name using a search string in the replica
 
@@ -249,33 +510,54 @@ def search_books_replica(name):
 @app_replica.route('/books/find')
 def get_book_by_name_replica():
     search_string = request.args.get('name', '')
-    books = db_replica.session.query(BookReplica).filter(
-        or_(BookReplica.name.like(f"%{search_string}%"))).all()
-
-    book_info = [{
-        'id': book.id,
-        'name': book.name,
-        'count': book.count
-    } for book in books]
-    return jsonify({
+    try:
+        limit = parse_search_limit(request.args)
+    except Exception as exc:
+        json_response = jsonify({'error': exc.__str__()})
+        return make_response(json_response, 400)
+
+    match_query = build_match_query(search_string)
+    with storage_replica.read_session() as session:
+        if match_query:
+            books = session.execute(text("""
+                SELECT book_replica.id, book_replica.name, book_replica.count, book_replica.version
+                FROM book_replica_fts JOIN book_replica ON book_replica.id = book_replica_fts.rowid
+                WHERE book_replica_fts MATCH :query
+                ORDER BY book_replica_fts.rank
+                LIMIT :limit"""), {'query': match_query, 'limit': limit})
+        else:
+            books = session.execute(
+                db_replica.select(BookReplica.id, BookReplica.name, BookReplica.count,
+                                  BookReplica.version)
+                .order_by(BookReplica.id).limit(limit))
+        books = books.all()
+
+        book_info = [{
+            'id': book.id,
+            'name': book.name,
+            'count': book.count
+        } for book in books]
+    return conditional_response({
         'books': book_info
-    })
+    }, rows_etag(books))
 
 # Endpoint to get information about a specific book by ID in the replica
 
 
 @app_replica.route('/books/<int:id>')
 def get_book_replica(id):
-    try:
-        book = BookReplica.query.filter_by(id=id).first()
+    def get():
+        with storage_replica.read_session() as session:
+            book = session.get(BookReplica, id)
         book_info = dict({
             'id': book.id,
             'name': book.name,
             'count': book.count
         })
-        return jsonify({
-            'books': book_info
-        })
+        return {'books': book_info}, 200, f'book-{book.id}-v{book.version}'
+
+    try:
+        return cached_response(response_cache_replica, ('book', id), get)
     except Exception as exc:
         json_response = jsonify({
             'error': exc.__str__()
@@ -287,96 +569,73 @@ def get_book_replica(id):
 # Endpoint to increase the stock count of a book by ID in the replica
 @app_replica.route('/books/<int:id>/count/increase', methods=['PUT'])
 def increase_book_stock_replica(id):
-    try:
-        book = BookReplica.query.get(id)
-        book.count += 1
-        db_replica.session.commit()
-
-        # Emit a Socket.IO event for book change to origin
-        socketio_replica.emit('book_change_replica', {'book_info': {
-                              'id': book.id, 'name': book.name, 'count': book.count}})
-
-        return jsonify({
-            'count': book.count,
-        })
-    except Exception as e:
-        json_response = jsonify({
-            'error': e.__str__()
-        })
+    return forward_to_original()
 
-        return make_response(json_response, 404)
 
 # Endpoint to decrease the stock count of a book by ID in the replica
 
 
 @app_replica.route('/books/<int:id>/count/decrease', methods=['PUT'])
 def decrease_book_stock_replica(id):
-    try:
-        book = BookReplica.query.get(id)
-        if book:
-            if book.count > 0:
-                book.count -= 1
-                db_replica.session.commit()
-
-                # Emit a Socket.IO event for book change to origin
-                socketio_replica.emit('book_change_replica', {'book_info': {
-                                      'id': book.id, 'name': book.name, 'count': book.count}})
-
-                return jsonify({'count': book.count})
-            else:
-                return jsonify({'error': 'Book is already out of stock'}), 403
-        else:
-            return jsonify({'error': 'Book not found'}), 404
-    except Exception as e:
-        json_response = jsonify({'error': e.__str__()})
-        return make_response(json_response, 500)
+    return forward_to_original()
+
+
+# Endpoint to atomically check and decrease the stock count of a book by ID in the replica
+
+
+@app_replica.route('/books/<int:id>/count/reserve', methods=['PUT'])
+def reserve_book_stock_replica(id):
+    return forward_to_original()
+
+
+# Endpoint to atomically reserve stock for several books at once in the replica
+
+
+@app_replica.route('/books/count/reserve', methods=['PUT'])
+def reserve_books_stock_replica():
+    return forward_to_original()
+
 
 # Endpoint to update the price of a book by ID in the replica
 
 
 @app_replica.route('/books/<int:id>/price', methods=['PUT'])
 def update_book_price_replica(id):
-    try:
-        price = float(request.form['price'])
+    return forward_to_original()
 
-        book = BookReplica.query.filter_by(id=id).first()
-        book.price = price
-        db_replica.session.commit()
-
-        # Emit a Socket.IO event for book change to origin
-        socketio_replica.emit('book_change_replica', {'book_info': {
-                              'id': book.id, 'name': book.name, 'count': book.count}})
-
-        return jsonify({
-            'price': book.price,
-        })
-    except Exception as e:
-        json_response = jsonify({
-            'error': e.__str__()
-        })
-        return make_response(json_response, 404)
 
 # Endpoint to check stock availability of a book by ID in the replica
 
 
 @app_replica.route('/books/<int:id>/stock/availability')
 def stock_availability_replica(id):
-    book = BookReplica.query.filter_by(id=id).first()
-    if book.count == 0:
-        json_response = jsonify({
-            'success': False,
-            'message': 'Out of stock'
-        })
-        return make_response(json_response, 403)
+    def availability():
+        with storage_replica.read_session() as session:
+            book = session.get(BookReplica, id)
+        if book.count == 0:
+            return {'success': False, 'message': 'Out of stock'}, 403, None
+        return {'success': True, 'left': book.count}, 200, None
 
-    return jsonify({
-        'success': True,
-        'left': book.count
-    })
+    return cached_response(response_cache_replica, ('availability', id), availability)
+
+
+# Endpoint to get the counters of the response cache of the replica
+
+
+@app_replica.route('/cache/stats')
+def get_cache_stats_replica():
+    return jsonify(response_cache_replica.stats())
 
 
 
 
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 4001 in debug mode
 if __name__ == '__main__':
-    socketio_replica.run(app_replica, host='0.0.0.0', port=4001, debug=True)
+    debug = True
+    # The reloader also runs this block in its watcher process; only the
+    # process serving requests bootstraps and follows the change log
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Copy the original data before accepting any request, then follow its change log
+        bootstrap_replica()
+        socketio_replica.start_background_task(replication_loop)
+    socketio_replica.run(app_replica, host='0.0.0.0', port=4001, debug=debug)
@@ -0,0 +1,78 @@
+# response_cache.py
+# Bounded in-process LRU cache of serialized GET responses of the catalog server.
+#
+# Entries are dropped by the write paths right after their transaction commits.
+# A read that started before an invalidation must not put its (possibly stale)
+# result in the cache, so every put carries the generation read before the
+# database query, and is ignored if anything was invalidated since.
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 10000
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with hit, miss and eviction counters."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value of key, or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self):
+        """Take before reading the value that will be put in the cache."""
+        return self._generation
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                # Something was written while the value was being read
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """Drop the entries of keys (call after the write has committed)."""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry, e.g. after a bulk write."""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
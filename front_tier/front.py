@@ -1,17 +1,38 @@
 from flask import Flask, request, jsonify
-import requests
-from cachetools import LRUCache
 from flask_socketio import SocketIO
 import time
+import uuid
+from service_client import ServiceClient, ServiceUnavailable, enforce_deadline
+from front_cache import FrontCache
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-cache = LRUCache(maxsize=1000)
+# Requests whose caller sent an X-Request-Deadline that has passed get a 504
+enforce_deadline(app)
+
+# Calls to the catalog and order servers, with timeouts, retries of GETs and
+# a circuit breaker per server and endpoint
+client = ServiceClient()
 
 CATALOG_SERVER_IPS = ["http://127.0.0.1:4000", "http://127.0.0.1:4001"]
 ORDER_SERVER_URLS = ["http://127.0.0.1:3000", "http://127.0.0.1:3001"]
 
+# Seconds the catalog responses of each endpoint are served from the cache
+# before they are revalidated (a conditional GET, answered with 304 and no
+# body if they are unchanged). Expired entries are served while they are
+# revalidated in the background, and while every catalog server is down.
+CACHE_TTLS = {
+    'search': 10,
+    'catalog': 10,
+    'info': 5,
+}
+cache = FrontCache(CACHE_TTLS)
+
+# Response header telling whether the answer came from the cache
+# (hit, stale, miss or stale-if-error)
+CACHE_HEADER = 'X-Cache'
+
 # round robin algorithm to detect the server ip 
 server_indices = {
     'search': 0,
@@ -20,6 +41,18 @@ server_indices = {
 }
 
 
+# Purchases carry an Idempotency-Key header (the client's own, or a new one),
+# so the order server runs each at most once and a purchase whose answer was
+# lost can be retried. Retries go to the same order server, which holds the
+# key; each attempt gets a shorter timeout than other calls.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+PURCHASE_ATTEMPT_TIMEOUT = 2.5
+
+
+def get_idempotency_key():
+    return request.headers.get(IDEMPOTENCY_HEADER) or str(uuid.uuid4())
+
+
 def get_order_server_url():
     index = server_indices['purchase']
     server_indices['purchase'] = (index + 1) % len(ORDER_SERVER_URLS)
@@ -32,26 +65,48 @@ def get_catalog_server_url(request_type):
     return CATALOG_SERVER_IPS[index]
 
 
-def get_data_from_cache_or_server(key, server_url, endpoint, request_type):
-    cached_data = cache.get(key)
-    if cached_data:
-        app.logger.info(f"Data retrieved from cache for key: {key}")
-        return cached_data
-    else:
-        response = requests.get(f"{server_url}/{endpoint}")
-        if response.status_code == 200:
-            data = response.json()
-            app.logger.info(f"Data retrieved from server {
-                            server_url} for key: {key}")
-            cache[key] = data  # Cache the data
-            return data
-        return {'error': f'Server {server_url} failed to respond'}, 500
-
-
-def invalidate_cache(key):
-    app.logger.info(f"Invalidating cache for key: {key}")
-    if key in cache:
-        cache.pop(key)
+# Function to call the catalog servers for a cached endpoint, starting with
+# the next one in round robin order and failing over to the others. Returns
+# (status code, data, ETag); raises ServiceUnavailable if none answered.
+def fetch_from_catalog(endpoint, request_type, etag=None):
+    first = CATALOG_SERVER_IPS.index(get_catalog_server_url(request_type))
+    headers = {'If-None-Match': etag} if etag else {}
+    error = None
+    for server_url in CATALOG_SERVER_IPS[first:] + CATALOG_SERVER_IPS[:first]:
+        try:
+            response = client.get(f"{server_url}/{endpoint}", headers=headers,
+                                  endpoint=f"GET {server_url} {request_type}")
+        except ServiceUnavailable as e:
+            error = e
+            app.logger.warning(f"Catalog server {server_url} failed: {e}")
+            continue
+        if response.status_code >= 500:
+            error = ServiceUnavailable(f'Server {server_url} failed to respond')
+            app.logger.warning(f"Catalog server {server_url} answered {response.status_code}")
+            continue
+
+        app.logger.info(f"Request to Catalog Server ({server_url}) for {endpoint}: "
+                        f"{response.status_code}")
+        if response.status_code == 304:
+            return 304, None, etag
+        return response.status_code, response.json(), response.headers.get('ETag')
+    raise error
+
+
+def get_data_from_cache_or_server(namespace, key, endpoint, request_type):
+    """
+    Answer a GET from the cache namespace, or from the catalog servers.
+    Returns (data, status code, headers) for the endpoint to return.
+    """
+    status, data, state = cache.get(
+        namespace, key, lambda etag: fetch_from_catalog(endpoint, request_type, etag))
+    app.logger.info(f"Cache {state} for {namespace} key: {key}")
+    return data, status, {CACHE_HEADER: state}
+
+
+def invalidate_cache(key, namespace='info'):
+    app.logger.info(f"Invalidating cache for {namespace} key: {key}")
+    if cache.invalidate(namespace, key):
         app.logger.info(f"Cache invalidated successfully for key: {key}")
     else:
         app.logger.warning(
@@ -75,7 +130,8 @@ def handle_catalog_change(message):
     if catalog_info:
         key = catalog_info.get('id')
         if key:
-            invalidate_cache(key)
+            # Every page of the catalog's listing
+            cache.invalidate_prefix('catalog', f'{key}?')
             socketio.emit('cache_invalidate', {
                           'key': key}, callback=handle_ack)
             app.logger.info(f"Received catalog change: {catalog_info}")
@@ -131,17 +187,59 @@ def search(item_type):
     """
     
     try:
-        server_url = get_catalog_server_url('search')
         start_time = time.time()
 
-        data = get_data_from_cache_or_server(
-            item_type, server_url, f"books/search/{item_type}", 'search')
+        data, status, headers = get_data_from_cache_or_server(
+            'search', item_type, f"books/search/{item_type}", 'search')
 
         end_time = time.time()
         response_time = end_time - start_time
-        print(f"Request to Catalog Server ({server_url})")
         print(f"Request processing time: {response_time} seconds")
-        return jsonify(data)
+        return jsonify(data), status, headers
+    except ServiceUnavailable as e:
+        app.logger.error(f"Service unavailable: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        app.logger.error(f"Exception: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Endpoint for listing the items of a catalog
+
+
+@app.route('/catalog/<int:catalog_id>', methods=['GET'])
+def catalog_items(catalog_id):
+    """
+    List the items of a catalog, one page at a time.
+
+    Input:
+    - catalog_id: The unique identifier of the catalog (integer)
+    - Optional query parameters 'order' (id, price or name), 'cursor'
+      and 'limit', passed on to the catalog server
+
+    Output:
+    - JSON response containing a page of items and the cursor of the next page
+
+    Example:
+    - GET request: /catalog/1?order=price&limit=20
+    """
+    try:
+        start_time = time.time()
+
+        query_string = request.query_string.decode()
+        endpoint = f"books/search/{catalog_id}"
+        if query_string:
+            endpoint += f"?{query_string}"
+        # Every page of every order is cached under its own key
+        data, status, headers = get_data_from_cache_or_server(
+            'catalog', f"{catalog_id}?{query_string}", endpoint, 'search')
+
+        end_time = time.time()
+        response_time = end_time - start_time
+        print(f"Request processing time: {response_time} seconds")
+        return jsonify(data), status, headers
+    except ServiceUnavailable as e:
+        app.logger.error(f"Service unavailable: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -164,21 +262,22 @@ def info(item_number):
     - GET request: /info/123
     """
     try:
-        server_url = get_catalog_server_url('info')
         start_time = time.time()
 
-        data = get_data_from_cache_or_server(
-            item_number, server_url, f"books/{item_number}", 'info')
+        data, status, headers = get_data_from_cache_or_server(
+            'info', item_number, f"books/{item_number}", 'info')
 
         end_time = time.time()
         response_time = end_time - start_time
-        print(f"Request to Catalog Server ({server_url})")
         print(f"Request processing time: {response_time} seconds")
 
         # Emit a socket.io event for cache invalidation
         socketio.emit('cache_invalidate', {'key': item_number})
 
-        return jsonify(data)
+        return jsonify(data), status, headers
+    except ServiceUnavailable as e:
+        app.logger.error(f"Service unavailable: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -193,6 +292,7 @@ def purchase(item_id):
 
     Input:
     - item_id: The unique identifier of the item to purchase (integer)
+    - Optional 'Idempotency-Key' header, to retry a purchase safely
 
     Output:
     - JSON response confirming the purchase
@@ -204,7 +304,10 @@ def purchase(item_id):
         server_url = get_order_server_url()
         start_time = time.time()
 
-        response = requests.post(f"{server_url}/purchase/{item_id}")
+        response = client.post(f"{server_url}/purchase/{item_id}",
+                               headers={IDEMPOTENCY_HEADER: get_idempotency_key()},
+                               timeout=PURCHASE_ATTEMPT_TIMEOUT, idempotent=True,
+                               endpoint=f"POST {server_url}/purchase")
         data = response.json()
         end_time = time.time()
         response_time = end_time - start_time
@@ -219,7 +322,59 @@ def purchase(item_id):
 
         app.logger.info(f"Response from order server {server_url}: {data}")
         print(f"Request to Order Server ({server_url})")
-        return jsonify(data)
+        return jsonify(data), response.status_code
+    except ServiceUnavailable as e:
+        app.logger.error(f"Service unavailable: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        app.logger.error(f"Exception: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Endpoint for purchasing several items at once
+
+
+@app.route('/cart', methods=['POST'])
+def purchase_cart():
+    """
+    Purchase several items in one request.
+
+    Input:
+    - JSON body with an 'items' list of {'id': item id, 'quantity': count}
+
+    Output:
+    - JSON response confirming the orders
+
+    Example:
+    - POST request: /cart with JSON {'items': [{'id': 1, 'quantity': 2}]}
+    """
+    try:
+        server_url = get_order_server_url()
+        start_time = time.time()
+
+        response = client.post(f"{server_url}/cart", json=request.get_json(silent=True),
+                               headers={IDEMPOTENCY_HEADER: get_idempotency_key()},
+                               timeout=PURCHASE_ATTEMPT_TIMEOUT, idempotent=True,
+                               endpoint=f"POST {server_url}/cart")
+        data = response.json()
+        end_time = time.time()
+        response_time = end_time - start_time
+        print(f"Request processing time: {response_time} seconds")
+
+        if response.status_code == 200:
+            for order in data['orders']:
+                item_id = order['book_info']['books']['id']
+                # Invalidate the cache for every purchased item
+                invalidate_cache(item_id)
+                # Emit a notification about the update
+                socketio.emit('cache_invalidate', {'key': item_id})
+            print("Order server made a change")
+
+        app.logger.info(f"Response from order server {server_url}: {data}")
+        print(f"Request to Order Server ({server_url})")
+        return jsonify(data), response.status_code
+    except ServiceUnavailable as e:
+        app.logger.error(f"Service unavailable: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -230,13 +385,20 @@ def purchase(item_id):
 @app.route('/cached_data', methods=['GET'])
 def get_cached_data():
     try:
-        cached_data = {key: cache[key] for key in cache.keys()}
+        cached_data = cache.snapshot()
         app.logger.info(f"All cached data: {cached_data}")
         return jsonify(cached_data)
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Endpoint to get the counters of the cache
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(cache.stats())
+
 
 # Run the Flask application on host 0.0.0.0 and port 5000 in debug mode
 if __name__ == '__main__':
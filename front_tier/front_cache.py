@@ -0,0 +1,230 @@
+# front_cache.py
+# Cache of the catalog responses served by the front tier.
+#
+# - Entries are kept per namespace ('search', 'catalog', 'info'), each with
+#   its own TTL, so the search for "1" and the book with id 1 never collide.
+#   Keys are strings within their namespace.
+# - A fresh entry is served as is. Once its TTL is over, it is still served
+#   for STALE_WHILE_REVALIDATE seconds while one background refresh (a
+#   conditional GET with its ETag) fetches a fresh copy.
+# - Past that window the entry is fetched before answering. Concurrent misses
+#   of a key wait for one fetch instead of each calling a catalog server.
+# - If the fetch fails (every catalog server is down), the entry is served up
+#   to STALE_IF_ERROR seconds after its TTL, then the error is returned.
+# - Only 200 answers are cached; errors are returned to the caller, and a 4xx
+#   answer (e.g. a book that was deleted) drops the entry.
+# - A fetch that started before an invalidation does not put its (possibly
+#   stale) result in the cache, as in the catalog server's response cache.
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = 1000
+
+# Default seconds an entry of a namespace is fresh
+DEFAULT_TTL = 5.0
+
+# How long an expired entry is served while it is refreshed in the background,
+# and the hard limit on serving it while the catalog servers are down
+# (seconds after its TTL)
+STALE_WHILE_REVALIDATE = 30.0
+STALE_IF_ERROR = 600.0
+
+# Longest wait for the fetch of a key started by another request (seconds)
+FLIGHT_WAIT = 10.0
+
+
+class Entry:
+    """A cached 200 answer of a catalog server."""
+
+    def __init__(self, data, etag, now):
+        self.data = data
+        self.etag = etag
+        self.validated_at = now
+
+
+class Flight:
+    """A fetch of a key in progress, waited for by the other requests of the key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class FrontCache:
+    """
+    Thread-safe LRU cache of catalog responses, per namespace. load(etag) is
+    passed to get() and calls the catalog servers; it returns (status code,
+    data, etag), with status 304 and no data if the ETag still matches, or
+    raises (e.g. ServiceUnavailable) if no catalog server answered.
+    """
+
+    def __init__(self, ttls, max_entries=MAX_ENTRIES,
+                 stale_while_revalidate=STALE_WHILE_REVALIDATE,
+                 stale_if_error=STALE_IF_ERROR):
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'stale_if_error_hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, load):
+        """
+        Return (status code, data, state) for key, where state is 'hit',
+        'stale', 'miss' or 'stale-if-error'. Errors of load are raised unless
+        a stale entry can be served instead.
+        """
+        key = (namespace, str(key))
+        ttl = self.ttls.get(namespace, DEFAULT_TTL)
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry.validated_at if entry else None
+            if entry is not None and age < ttl:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return 200, entry.data, 'hit'
+            if entry is not None and age < ttl + self.stale_while_revalidate:
+                self._entries.move_to_end(key)
+                self.counters['stale_hits'] += 1
+                if key not in self._flights:
+                    flight = self._flights[key] = Flight()
+                    threading.Thread(target=self._refresh, args=(key, entry, load, flight),
+                                     daemon=True).start()
+                return 200, entry.data, 'stale'
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.counters['misses'] += 1
+
+        if leader:
+            try:
+                status, data = self._fetch(key, entry, load)
+                return status, data, 'miss'
+            except Exception as e:
+                flight.error = e
+                stale = self._stale_if_error(key, ttl)
+                if stale is None:
+                    raise
+                return 200, stale, 'stale-if-error'
+            finally:
+                self._land(key, flight)
+
+        # Another request is fetching the key, use its result
+        flight.done.wait(FLIGHT_WAIT)
+        if flight.error is None:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return 200, entry.data, 'hit'
+        else:
+            stale = self._stale_if_error(key, ttl)
+            if stale is not None:
+                return 200, stale, 'stale-if-error'
+        # The answer was not cached (an error, or an invalidation meanwhile)
+        status, data = self._fetch(key, entry, load)
+        return status, data, 'miss'
+
+    def _fetch(self, key, entry, load):
+        # Call the catalog servers and store a 200 answer. Returns (status, data).
+        generation = self._generation
+        status, data, etag = load(entry.etag if entry else None)
+        now = time.monotonic()
+        with self._lock:
+            current = generation == self._generation
+            if status == 304 and entry is not None:
+                if current and self._entries.get(key) is entry:
+                    entry.validated_at = now
+                self.counters['revalidated'] += 1
+                return 200, entry.data
+            if status == 200:
+                if current:
+                    self._entries[key] = Entry(data, etag, now)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.counters['evictions'] += 1
+            elif status < 500:
+                self._entries.pop(key, None)
+        return status, data
+
+    def _refresh(self, key, entry, load, flight):
+        # Runs on its own thread; the stale entry is served until it is done
+        try:
+            self._fetch(key, entry, load)
+            counter = 'refreshes'
+        except Exception as e:
+            flight.error = e
+            counter = 'refresh_errors'
+        finally:
+            with self._lock:
+                self.counters[counter] += 1
+            self._land(key, flight)
+
+    def _land(self, key, flight):
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.done.set()
+
+    def _stale_if_error(self, key, ttl):
+        # Data of the entry of key if it may still be served, else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry.validated_at >= ttl + self.stale_if_error:
+                return None
+            self.counters['stale_if_error_hits'] += 1
+            return entry.data
+
+    def invalidate(self, namespace, key):
+        """Drop the entry of key."""
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop((namespace, str(key)), None) is not None:
+                self.counters['invalidations'] += 1
+                return True
+            return False
+
+    def invalidate_prefix(self, namespace, prefix):
+        """Drop the entries of a namespace whose key starts with prefix."""
+        with self._lock:
+            self._generation += 1
+            keys = [key for key in self._entries
+                    if key[0] == namespace and key[1].startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+            self.counters['invalidations'] += len(keys)
+            return len(keys)
+
+    def snapshot(self):
+        """Entries by namespace, with their age in seconds."""
+        now = time.monotonic()
+        with self._lock:
+            entries = {}
+            for (namespace, key), entry in self._entries.items():
+                entries.setdefault(namespace, {})[key] = {
+                    'data': entry.data,
+                    'etag': entry.etag,
+                    'age': round(now - entry.validated_at, 3),
+                }
+            return entries
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries),
+                        max_entries=self.max_entries, ttls=self.ttls,
+                        stale_while_revalidate=self.stale_while_revalidate,
+                        stale_if_error=self.stale_if_error)
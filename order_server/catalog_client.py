@@ -0,0 +1,114 @@
+# catalog_client.py
+# Asynchronous HTTP client of the catalog server, shared by the order servers.
+#
+# One asyncio event loop runs on a background thread and owns an aiohttp
+# session whose connector keeps a pool of keep-alive connections to the catalog
+# server, so purchases no longer open a new TCP connection per call. Flask
+# request threads hand their purchase pipeline (a coroutine) to the loop with
+# run() and wait for its result, while the loop interleaves the I/O of every
+# request in flight.
+#
+# Calls follow the policy of service_client.ServiceClient: a timeout bounded by
+# the caller's deadline, which is sent downstream, retries with jitter for
+# GETs only, and a circuit breaker per endpoint.
+import asyncio
+import threading
+import aiohttp
+from service_client import (DEADLINE_HEADER, DEFAULT_TIMEOUT, MAX_RETRIES, CircuitBreaker,
+                            CircuitOpen, ServiceUnavailable, call_budget, out_of_time,
+                            retry_delay)
+
+# Maximum number of open connections to the catalog server, and how long an
+# idle connection is kept (seconds)
+POOL_SIZE = 100
+KEEPALIVE_TIMEOUT = 30
+
+
+class CatalogClient:
+    """Keep-alive connection pool to the catalog server on a background event loop."""
+
+    def __init__(self, base_url, pool_size=POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 retries=MAX_RETRIES):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._breakers = {}
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name='catalog-client', daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        """Run a coroutine on the client loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def breaker(self, endpoint):
+        # Only used on the loop thread
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = CircuitBreaker()
+        return self._breakers[endpoint]
+
+    def breakers(self):
+        """State of every circuit breaker, by endpoint."""
+        return {endpoint: {'state': breaker.state, 'failures': breaker.failures}
+                for endpoint, breaker in list(self._breakers.items())}
+
+    async def request(self, method, path, deadline=None, endpoint=None, **kwargs):
+        """
+        Call the catalog server, returning (status code, JSON body), or raise
+        ServiceUnavailable. deadline is the caller's deadline (Unix time, read
+        from its request with service_client.current_deadline()), endpoint
+        names the circuit breaker of the call (default: method and path).
+        """
+        if self._session is None:
+            # Created on the loop thread, aiohttp sessions belong to their loop
+            self._session = aiohttp.ClientSession(
+                base_url=self.base_url,
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, keepalive_timeout=KEEPALIVE_TIMEOUT))
+
+        endpoint = endpoint or f'{method} {path}'
+        breaker = self.breaker(endpoint)
+        attempts = 1 + (self.retries if method == 'GET' else 0)
+
+        for attempt in range(attempts):
+            # A retry that cannot be made reports the outcome of the last
+            # attempt, which was sent
+            if attempt and out_of_time(deadline):
+                break
+            if not breaker.allow():
+                if attempt:
+                    break
+                raise CircuitOpen(f'circuit open for {endpoint}')
+            call_timeout, call_deadline = call_budget(self.timeout, deadline)
+
+            try:
+                async with self._session.request(
+                        method, path, headers={DEADLINE_HEADER: f'{call_deadline:.3f}'},
+                        timeout=aiohttp.ClientTimeout(total=call_timeout), **kwargs) as response:
+                    status = response.status
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = {'error': await response.text()}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                breaker.record_failure()
+                # A connection that could not be opened carried no request;
+                # after a timeout the server may have applied it
+                error = ServiceUnavailable(
+                    f'{endpoint} failed: {exc!r}',
+                    sent=not isinstance(exc, aiohttp.ClientConnectorError))
+            else:
+                if status < 500:
+                    breaker.record_success()
+                    return status, body
+                breaker.record_failure()
+                error = None
+
+            if attempt + 1 < attempts:
+                await asyncio.sleep(retry_delay(attempt))
+        if error is not None:
+            raise error
+        return status, body
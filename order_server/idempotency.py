@@ -0,0 +1,191 @@
+# idempotency.py
+# Idempotency keys for the purchase endpoints of the order servers.
+#
+# A client that does not know whether a purchase went through (e.g. its call
+# timed out) retries it with the same Idempotency-Key header. The first
+# request with a key claims it in the dedupe table and runs; its response is
+# stored with the key. A repeat gets the stored response back without
+# touching the catalog server, or, while the first request is still running,
+# waits for its outcome. Keys expire IDEMPOTENCY_TTL after their response.
+#
+# Every response is stored, errors included (403 out of stock, 404 unknown
+# book, 5xx). A 5xx may follow a catalog call that timed out after reserving
+# the stock, so running the purchase again could reserve a second unit. Only
+# a response the view marks with not_applied() releases the claim, so the
+# purchase can run again: a failure known to come before any side effect
+# (the catalog call was never sent, or the purchase was not admitted). A view
+# that raises is answered with a stored 500 for the same reason.
+#
+# Known gap: the response is stored after the order is committed, not with
+# it. If the server dies in between, the claim expires after PENDING_TTL and
+# a retry with the key runs the purchase again.
+import functools
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from flask import Response, jsonify, make_response, request
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+# How long a response is kept, and how long a claim may stay without one
+# (a request still running, or one lost in a crash)
+IDEMPOTENCY_TTL = timedelta(hours=24)
+PENDING_TTL = timedelta(seconds=60)
+
+# How long a repeat waits for the outcome of a request still running, and how
+# often it checks (seconds)
+PENDING_WAIT = 5.0
+PENDING_POLL_INTERVAL = 0.05
+
+# Expired keys deleted per transaction, and how often they are purged (seconds)
+PURGE_BATCH_SIZE = 1000
+PURGE_INTERVAL = 60
+
+
+# Function to get the fingerprint of the request, so that a key reused for
+# a different request is rejected
+def request_fingerprint():
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+# Function to get the unexpired record of a key, or None
+def lookup_key(session, model, key, now):
+    row = session.execute(
+        select(model.request_hash, model.status, model.response)
+        .where(model.key == key, model.expires_at > now)).first()
+    return row._asdict() if row else None
+
+
+# Function to claim a key, run on the writer thread. Returns None if the key
+# was free (or expired) and is now claimed, else the record holding it.
+def claim_key(session, model, key, fingerprint, now):
+    statement = sqlite_insert(model).values(
+        key=key, request_hash=fingerprint, status=None, response=None,
+        expires_at=now + PENDING_TTL)
+    statement = statement.on_conflict_do_update(
+        index_elements=['key'],
+        set_={
+            'request_hash': statement.excluded.request_hash,
+            'status': None,
+            'response': None,
+            'expires_at': statement.excluded.expires_at,
+        },
+        where=model.expires_at <= now,
+    ).returning(model.key)
+    if session.execute(statement).first() is not None:
+        return None
+    return lookup_key(session, model, key, now)
+
+
+# Function to store the response of a claimed key, run on the writer thread
+def finish_key(session, model, key, status, body, now):
+    session.execute(update(model).where(model.key == key).values(
+        status=status, response=body, expires_at=now + IDEMPOTENCY_TTL))
+
+
+# Function to release a claimed key, run on the writer thread
+def release_key(session, model, key):
+    session.execute(delete(model).where(model.key == key))
+
+
+# Function to delete up to PURGE_BATCH_SIZE expired keys, run on the writer
+# thread (reads the expires_at index). Returns the number deleted.
+def purge_expired_keys(session, model, now):
+    expired = select(model.key).where(model.expires_at <= now).limit(PURGE_BATCH_SIZE)
+    return session.execute(delete(model).where(model.key.in_(expired))).rowcount
+
+
+# Function to mark a response to a failure known to come before any side
+# effect, so the key is released instead of storing it
+def not_applied(response):
+    response.not_applied = True
+    return response
+
+
+# Function to answer a repeated request from the record of its key
+def replay(record, fingerprint):
+    if record['request_hash'] != fingerprint:
+        json_response = jsonify({
+            'error': f'{IDEMPOTENCY_HEADER} was already used for a different request'
+        })
+        return make_response(json_response, 422)
+    if record['status'] is None:
+        json_response = jsonify({
+            'error': 'a request with this idempotency key is still in progress'
+        })
+        return make_response(json_response, 409)
+
+    response = Response(record['response'], status=record['status'],
+                        mimetype='application/json')
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(storage, model):
+    """
+    Decorator making a Flask view honour the Idempotency-Key header.
+    model is the dedupe table (key, request_hash, status, response,
+    expires_at) in the database of storage. Requests without the header
+    run as before.
+    """
+    session = storage.db.session
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if key is None:
+                return view(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                json_response = jsonify({
+                    'error': f'{IDEMPOTENCY_HEADER} must have 1 to {MAX_KEY_LENGTH} characters'
+                })
+                return make_response(json_response, 400)
+
+            fingerprint = request_fingerprint()
+            with storage.read_session() as read_session:
+                record = lookup_key(read_session, model, key, datetime.now())
+            if record is None:
+                record = storage.write(claim_key, session, model, key, fingerprint, datetime.now())
+
+            # Wait for the outcome of the request that holds the key
+            waited_until = time.monotonic() + PENDING_WAIT
+            while (record is not None and record['status'] is None
+                   and record['request_hash'] == fingerprint
+                   and time.monotonic() < waited_until):
+                time.sleep(PENDING_POLL_INTERVAL)
+                with storage.read_session() as read_session:
+                    record = lookup_key(read_session, model, key, datetime.now())
+                if record is None:
+                    # Released or expired, the request may run again
+                    record = storage.write(
+                        claim_key, session, model, key, fingerprint, datetime.now())
+                    if record is None:
+                        break
+            if record is not None:
+                return replay(record, fingerprint)
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception as e:
+                # The purchase may have reserved stock before failing
+                storage.write(finish_key, session, model, key, 500,
+                              json.dumps({'error': f'purchase failed: {e}'}), datetime.now())
+                raise
+
+            if getattr(response, 'not_applied', False):
+                storage.write(release_key, session, model, key)
+            else:
+                storage.write(finish_key, session, model, key, response.status_code,
+                              response.get_data(as_text=True), datetime.now())
+            return response
+        return wrapper
+    return decorator
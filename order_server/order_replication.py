@@ -0,0 +1,146 @@
+# order_replication.py
+# Log-shipping replication between the two order servers.
+#
+# - The orders placed on a server (origin NULL) form its order log, in id
+#   order: the order id is the sequence number. GET /orders/log pages
+#   through it with read_order_log.
+# - Each server follows the log of its peer with an OrderLogFollower: it
+#   pulls a batch after the last sequence number it applied, and stores the
+#   orders (origin = peer name, origin_id = sequence number) together with
+#   the new sequence number in one transaction. After downtime the next
+#   pulls catch up batch by batch.
+# - Replaying a batch is harmless: (origin, origin_id) is unique and orders
+#   already stored are skipped, so each order is stored once.
+# - Replicated orders are not part of the local log, so they are never sent
+#   back to the server they came from.
+from datetime import datetime
+from sqlalchemy import func, select
+from sales_analytics import add_sales, order_sales
+
+# Orders pulled from the peer per request, and the pause between two polls
+# once the peer's log has been applied (seconds)
+LOG_BATCH_SIZE = 1000
+LOG_POLL_INTERVAL = 1.0
+
+
+# Function to read a page of the local order log after a sequence number.
+# Returns the orders, the last sequence number of the log and the number of
+# orders after the page.
+def read_order_log(session, model, after, limit):
+    local = model.origin.is_(None)
+    orders = [{
+        'seq': row.id,
+        'book_id': row.book_id,
+        'unit_price': row.unit_price,
+        'quantity': row.quantity,
+        'purchase_date': row.purchase_date.isoformat(),
+    } for row in session.execute(
+        select(model.id, model.book_id, model.unit_price, model.quantity, model.purchase_date)
+        .where(local, model.id > after)
+        .order_by(model.id)
+        .limit(limit))]
+
+    last_seq = session.execute(select(func.max(model.id)).where(local)).scalar() or 0
+    page_end = orders[-1]['seq'] if orders else after
+    remaining = session.execute(
+        select(func.count()).where(local, model.id > page_end)).scalar()
+    return orders, last_seq, remaining
+
+
+# Function to get the last sequence number applied from a peer
+def get_applied_seq(session, state_model, peer):
+    state = session.get(state_model, peer)
+    return state.applied_seq if state else 0
+
+
+# Function to store a batch of the peer's order log, run on the writer
+# thread. store_orders(orders, sales) is the server's own order insert.
+# Returns the sales of the orders stored, for the in-memory rollups.
+def apply_order_log(session, model, state_model, peer, entries, store_orders):
+    seqs = [entry['seq'] for entry in entries]
+    stored = set(session.execute(
+        select(model.origin_id)
+        .where(model.origin == peer, model.origin_id.in_(seqs))).scalars())
+
+    orders = [model(book_id=entry['book_id'], unit_price=entry['unit_price'],
+                    quantity=entry['quantity'],
+                    purchase_date=datetime.fromisoformat(entry['purchase_date']),
+                    origin=peer, origin_id=entry['seq'])
+              for entry in entries if entry['seq'] not in stored]
+    sales = order_sales(orders)
+    if orders:
+        store_orders(orders, sales)
+    session.merge(state_model(peer=peer, applied_seq=seqs[-1]))
+    return sales
+
+
+class OrderLogFollower:
+    """Pulls the order log of the peer order server into the local database."""
+
+    def __init__(self, storage, model, state_model, store_orders, sales_columns,
+                 client, peer, peer_url, batch_size=LOG_BATCH_SIZE):
+        self.storage = storage
+        self.model = model
+        self.state_model = state_model
+        self.store_orders = store_orders
+        self.sales_columns = sales_columns
+        self.client = client
+        self.peer = peer
+        self.peer_url = peer_url
+        self.batch_size = batch_size
+        # Replication lag, exposed on /replication/status
+        self.status = {
+            'peer': peer,
+            'connected': False,
+            'applied_seq': 0,
+            'peer_seq': 0,
+            'lag_orders': 0,
+            'lag_seconds': 0.0,
+            'orders_applied': 0,
+            'last_pull_at': None,
+        }
+
+    def pull(self):
+        """Pull and apply every order of the peer's log not applied yet."""
+        with self.storage.read_session() as session:
+            applied_seq = get_applied_seq(session, self.state_model, self.peer)
+        while True:
+            response = self.client.get(f'{self.peer_url}/orders/log', params={
+                'after': applied_seq, 'limit': self.batch_size},
+                endpoint=f'GET {self.peer_url}/orders/log')
+            response.raise_for_status()
+            body = response.json()
+            entries = body['orders']
+
+            self.status['connected'] = True
+            self.status['peer_seq'] = body['last_seq']
+            self.status['last_pull_at'] = datetime.now().isoformat()
+
+            if entries:
+                sales = self.storage.write(
+                    apply_order_log, self.storage.db.session, self.model,
+                    self.state_model, self.peer, entries, self.store_orders)
+                add_sales(self.sales_columns, sales)
+                applied_seq = entries[-1]['seq']
+                self.status['orders_applied'] += len(sales)
+                # Age of the last applied order, i.e. how far behind this server is
+                self.status['lag_seconds'] = round((datetime.now() - datetime.fromisoformat(
+                    entries[-1]['purchase_date'])).total_seconds(), 3)
+
+            self.status['applied_seq'] = applied_seq
+            self.status['lag_orders'] = body['remaining']
+
+            if not body['remaining']:
+                self.status['lag_seconds'] = 0.0
+                return
+
+    def run(self, sleep, logger):
+        """Follow the peer's log forever; sleep is e.g. socketio.sleep."""
+        while True:
+            try:
+                self.pull()
+            except Exception as e:
+                if self.status['connected']:
+                    logger.warning(f"Lost connection to order server {self.peer}: {e}")
+                self.status['connected'] = False
+            sleep(LOG_POLL_INTERVAL)
@@ -1,12 +1,24 @@
 # original.py
+import asyncio
+import os
 from datetime import datetime
-from flask import Flask, make_response, jsonify
+from flask import Flask, make_response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Integer, JSON, DATETIME
+from sqlalchemy import Float, Index, Integer, String, Text, select, text
 from sqlalchemy.orm import Mapped, mapped_column
-import requests
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit, join_room
+from storage import EPOCH_MILLIS_SQL, EpochMillis, SQLiteStorage
+from access_log import AsyncLogWriter
+from catalog_client import CatalogClient
+from sales_analytics import (add_sales, backfill_sales, load_sales_columns, order_sales,
+                             parse_analytics_args, record_sales, sales_timeseries,
+                             sales_velocity, top_sellers)
+from service_client import ServiceClient, ServiceUnavailable, current_deadline, enforce_deadline
+from idempotency import PURGE_INTERVAL, idempotent, not_applied, purge_expired_keys
+from order_replication import OrderLogFollower, read_order_log
+from stock_escrow import StockEscrow, cart_items, consume_quota
+from purchase_queue import PurchaseQueue
 
 # Define a base class for SQLAlchemy models
 
@@ -25,22 +37,177 @@ app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///project.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
+# WAL mode, pooled read connections and a single writer thread. Orders are
+# group committed: the writes queued within a few milliseconds share one
+# durable commit, and each purchase is acknowledged once its batch is on disk.
+storage = SQLiteStorage(db, group_commit=True)
+storage.init_app(app)
+
 # Define SQLAlchemy model for Order
 
 
 class Order(db.Model):
+    __table_args__ = (
+        Index('ux_order_origin', 'origin', 'origin_id', unique=True),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    book_data: Mapped[dict] = mapped_column(JSON)
-    purchase_date: Mapped[datetime] = mapped_column(DATETIME)
-    count: Mapped[int] = mapped_column(Integer)
-
-
-# Create the Order table in the database
+    book_id: Mapped[int] = mapped_column(Integer, index=True)
+    # Price paid per copy (NULL for orders placed before it was recorded)
+    unit_price: Mapped[float] = mapped_column(Float, nullable=True)
+    quantity: Mapped[int] = mapped_column(Integer)
+    purchase_date: Mapped[datetime] = mapped_column(EpochMillis, index=True)
+    # Server the order was placed on and its id there, for orders replicated
+    # from the peer order server (NULL for orders placed here)
+    origin: Mapped[str] = mapped_column(String(32), nullable=True)
+    origin_id: Mapped[int] = mapped_column(Integer, nullable=True)
+
+
+# Last sequence number of the peer's order log stored here (see order_replication.py)
+class ReplicationState(db.Model):
+    __tablename__ = 'replication_state'
+    peer: Mapped[str] = mapped_column(String(32), primary_key=True)
+    applied_seq: Mapped[int] = mapped_column(Integer, default=0)
+
+
+# Sales rollups, units and revenue per book per hour and per day (bucket is
+# the number of hours or days since 1970-01-01, see sales_analytics.py).
+# Clustered by bucket, so time ranges are contiguous reads.
+class SalesHourly(db.Model):
+    __tablename__ = 'sales_hourly'
+    __table_args__ = (
+        Index('ix_sales_hourly_book_bucket', 'book_id', 'bucket'),
+        {'sqlite_with_rowid': False},
+    )
+    bucket: Mapped[int] = mapped_column(Integer, primary_key=True)
+    book_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[float] = mapped_column(Float, default=0)
+
+
+class SalesDaily(db.Model):
+    __tablename__ = 'sales_daily'
+    __table_args__ = (
+        Index('ix_sales_daily_book_bucket', 'book_id', 'bucket'),
+        {'sqlite_with_rowid': False},
+    )
+    bucket: Mapped[int] = mapped_column(Integer, primary_key=True)
+    book_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[float] = mapped_column(Float, default=0)
+
+
+SALES_ROLLUPS = {
+    'hour': SalesHourly,
+    'day': SalesDaily,
+}
+
+
+# Units of hot books leased from the catalog server and not sold yet (see
+# stock_escrow.py)
+class StockQuota(db.Model):
+    __tablename__ = 'stock_quota'
+    book_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    name: Mapped[str] = mapped_column(String)
+    price: Mapped[float] = mapped_column(Float)
+
+
+# Outcomes of the purchases sent with an Idempotency-Key header, replayed
+# to retries of the same request (see idempotency.py). status is NULL while
+# the first request is still running.
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    __table_args__ = {'sqlite_with_rowid': False}
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64))
+    status: Mapped[int] = mapped_column(Integer, nullable=True)
+    response: Mapped[str] = mapped_column(Text, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(EpochMillis, index=True)
+
+
+# Schema migrations of project.db, applied in order at startup by
+# storage.run_migrations. Only ever append to MIGRATIONS.
+def add_order_indexes(session):
+    session.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_order_purchase_date ON "order" (purchase_date)'))
+
+
+# Orders used to hold the whole catalog response in a book_data JSON column
+# and the purchase date as text; rebuild the table with typed columns, taking
+# book_id (and unit_price when present) from the JSON. New databases already
+# have the compact table.
+def compact_orders(session):
+    columns = [row[1] for row in session.execute(text('PRAGMA table_info("order")'))]
+    if 'book_data' not in columns:
+        return
+    session.execute(text('DROP INDEX IF EXISTS ix_order_purchase_date'))
+    session.execute(text('ALTER TABLE "order" RENAME TO order_json'))
+    Order.__table__.create(session.connection())
+    session.execute(text(f'''
+        INSERT INTO "order" (id, book_id, unit_price, quantity, purchase_date)
+        SELECT id, json_extract(book_data, '$.books.id'),
+               json_extract(book_data, '$.books.price'), count,
+               {EPOCH_MILLIS_SQL.format(column='purchase_date')}
+        FROM order_json'''))
+    session.execute(text('DROP TABLE order_json'))
+
+
+# The rollup tables are created empty by db.create_all(); fill them with the
+# orders placed before they existed
+def add_sales_rollups(session):
+    backfill_sales(session, '"order"', SALES_ROLLUPS)
+
+
+# Orders replicated from the peer order server record where they came from
+def add_order_origin(session):
+    columns = [row[1] for row in session.execute(text('PRAGMA table_info("order")'))]
+    if 'origin' not in columns:
+        session.execute(text('ALTER TABLE "order" ADD COLUMN origin VARCHAR(32)'))
+        session.execute(text('ALTER TABLE "order" ADD COLUMN origin_id INTEGER'))
+    session.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_order_origin ON "order" (origin, origin_id)'))
+
+
+MIGRATIONS = [
+    add_order_indexes,
+    compact_orders,
+    add_sales_rollups,
+    add_order_origin,
+]
+
+
+# Create the Order table in the database and bring it up to date
 with app.app_context():
     db.create_all()
+    applied = storage.run_migrations(MIGRATIONS)
+    for migration in applied:
+        app.logger.info(f'Applied migration {MIGRATIONS.index(migration) + 1}: '
+                        f'{migration.__name__}')
+    if compact_orders in applied:
+        # Give the space of the dropped JSON table back to the file system
+        storage.vacuum()
+
+# In-memory columns of the sales rollups, read by the analytics endpoints
+with storage.read_session() as session:
+    sales_columns = load_sales_columns(session, SALES_ROLLUPS)
 
 server_url = "http://127.0.0.1:4000"
 
+# Keep-alive connection pool to the catalog server, used by the purchase pipelines
+catalog_client = CatalogClient(server_url)
+
+# Hot books are sold from units leased from the catalog server
+escrow = StockEscrow(storage, StockQuota, catalog_client, 'original')
+escrow.load()
+
+# Answer 504 to requests whose caller has already given up
+enforce_deadline(app)
+
+peer_url = "http://127.0.0.1:3001"
+
+# Purchases are logged as JSON lines by a background writer
+order_log = AsyncLogWriter('./order_log.txt')
+
 # SocketIO event handler for handling order confirmation
 
 
@@ -54,16 +221,223 @@ def handle_order_confirmation_original(message):
     else:
         print("No order_info found in message")
 
+
+# Function to store orders and add their sales (order_sales(orders)) to the
+# rollup tables, in one transaction on the writer thread
+def store_orders(orders, sales, taken=()):
+    db.session.add_all(orders)
+    record_sales(db.session, SALES_ROLLUPS, sales)
+    # Units sold from the local quotas, as (book_id, units)
+    consume_quota(db.session, StockQuota, taken)
+
+# Purchase pipeline, run on the catalog client loop: reserve the stock, then
+# store the order and log it at the same time (the log write only queues the
+# record while the writer thread inserts the order). Returns (status code, body).
+async def purchase_pipeline(id, deadline=None):
+    # Sell from the local quota of a hot book, without calling the catalog server
+    book, taken = escrow.take(id), [(id, 1)]
+    if book is not None:
+        status, book = 200, {'books': book}
+    else:
+        # Check and decrease the stock count in a single call to the catalog server
+        status, book = await catalog_client.request(
+            'PUT', f'/books/{id}/count/reserve', deadline=deadline,
+            endpoint='PUT /books/<id>/count/reserve')
+        if status != 200:
+            return status, book
+        escrow.record_sale(id, 1)
+        taken = []
+
+    # Create an Order record in the database
+    order = Order(book_id=book['books']['id'], unit_price=book['books']['price'],
+                  quantity=1, purchase_date=datetime.now())
+    sales = order_sales([order])
+    inserted = asyncio.wrap_future(storage.submit(store_orders, [order], sales, taken))
+
+    # Log the order information
+    order_log.write({
+        'event': 'purchase',
+        'book_id': book['books']['id'],
+        'book_name': book['books']['name'],
+        'quantity': 1,
+        'left': book['books']['count'],
+    })
+
+    try:
+        await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+    return status, book
+
+
+# Cart pipeline, the same steps for several books at once
+async def cart_pipeline(items, deadline=None):
+    # Sell from the local quotas if every book of the cart has one
+    taken = cart_items(items)
+    books = escrow.take_all(taken) if taken else None
+    if books is None:
+        # Reserve the stock for every item in a single call to the catalog server
+        status, body = await catalog_client.request(
+            'PUT', '/books/count/reserve', json=items, deadline=deadline)
+        if status != 200:
+            return status, body
+        books = body['books']
+        for book in books:
+            escrow.record_sale(book['id'], book['quantity'])
+        taken = []
+
+    status = 200
+    purchase_date = datetime.now()
+
+    # Create one Order record per book and commit them together
+    orders = [Order(book_id=book['id'], unit_price=book['price'], quantity=book['quantity'],
+                    purchase_date=purchase_date) for book in books]
+    sales = order_sales(orders)
+    inserted = asyncio.wrap_future(storage.submit(store_orders, orders, sales, taken))
+
+    # Log the order information
+    for book in books:
+        order_log.write({
+            'event': 'purchase',
+            'book_id': book['id'],
+            'book_name': book['name'],
+            'quantity': book['quantity'],
+            'left': book['count'],
+            'cart': True,
+        })
+
+    try:
+        await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+    return status, {'books': books, 'purchase_date': purchase_date}
+
+
+# Function to store queued orders like store_orders, returning their ids
+def store_queued_orders(orders, sales, taken):
+    store_orders(orders, sales, taken)
+    db.session.flush()
+    return [order.id for order in orders]
+
+
+# Function to reserve up to quantity copies of a book on the catalog server,
+# all of those left if there are fewer. Returns (status code, body, copies).
+async def reserve_copies(id, quantity):
+    status, book = await catalog_client.request(
+        'PUT', f'/books/{id}/count/reserve', data={'quantity': quantity},
+        endpoint='PUT /books/<id>/count/reserve')
+    if status == 403:
+        # Fewer copies left than purchases in the batch, reserve them all
+        status, info = await catalog_client.request(
+            'GET', f'/books/{id}', endpoint='GET /books/<id>')
+        left = info['books']['count'] if status == 200 else 0
+        if not 0 < left < quantity:
+            return 403, {'success': False, 'message': 'Out of stock'}, 0
+        quantity = left
+        status, book = await catalog_client.request(
+            'PUT', f'/books/{id}/count/reserve', data={'quantity': quantity},
+            endpoint='PUT /books/<id>/count/reserve')
+    return status, book, quantity if status == 200 else 0
+
+
+# Batch pipeline of the purchase queue, run on the catalog client loop:
+# sell up to quantity copies of a book from its quota, reserve the rest with
+# one call and store one order per copy. Returns (status code, body, order
+# ids); the body has the book even if the reservation failed after copies
+# were taken from the quota.
+async def purchase_batch_pipeline(id, quantity):
+    local, units = await escrow.take_up_to(id, quantity)
+    taken = [(id, units)] if units else []
+    status, book, reserved = 200, {'books': local}, 0
+    if units < quantity:
+        try:
+            status, book, reserved = await reserve_copies(id, quantity - units)
+        except ServiceUnavailable as e:
+            if not units:
+                raise
+            status, book = e.status, {'error': str(e)}
+        if reserved:
+            escrow.record_sale(id, reserved)
+        elif not units:
+            return status, book, []
+        elif status == 403:
+            # The rest is out of stock, the copies of the quota are sold
+            status, book = 200, {'books': local}
+        else:
+            book = dict(book, books=local)
+
+    purchase_date = datetime.now()
+    orders = [Order(book_id=id, unit_price=local['price'], quantity=1,
+                    purchase_date=purchase_date) for _ in range(units)]
+    orders += [Order(book_id=id, unit_price=book['books']['price'], quantity=1,
+                     purchase_date=purchase_date) for _ in range(reserved)]
+    sales = order_sales(orders)
+    inserted = asyncio.wrap_future(storage.submit(store_queued_orders, orders, sales, taken))
+
+    # Log the order information
+    order_log.write({
+        'event': 'purchase',
+        'book_id': id,
+        'book_name': book['books']['name'],
+        'quantity': units + reserved,
+        'left': book['books']['count'],
+        'queued': True,
+    })
+
+    try:
+        order_ids = await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+
+    # Emit a cache invalidation event
+    socketio.emit('cache_invalidate', {'key': id})
+    return status, book, order_ids
+
+
+# Function to send the outcome of a queued purchase to its subscribers
+def notify_ticket(ticket):
+    socketio.emit('ticket_update', ticket, to=f"ticket:{ticket['id']}")
+
+
+# Queued purchases, drained in batches on the catalog client loop
+purchase_queue = PurchaseQueue(catalog_client.loop, purchase_batch_pipeline, notify_ticket,
+                               escrow.copies_left)
+
+
+# SocketIO event handler subscribing a client to the outcome of a queued purchase
+@socketio.on('subscribe_ticket')
+def handle_subscribe_ticket(message):
+    ticket_id = message.get('ticket')
+    join_room(f'ticket:{ticket_id}')
+    # The purchase may have been resolved before the client subscribed
+    ticket = purchase_queue.get(ticket_id)
+    if ticket and ticket['status'] != 'queued':
+        emit('ticket_update', ticket)
+
+
+# Follower of the replica's order log, so this server holds every order
+order_follower = OrderLogFollower(storage, Order, ReplicationState, store_orders,
+                                  sales_columns, ServiceClient(), 'replica', peer_url)
+
 # Endpoint to purchase a book
 
 
 @app.route('/purchase/<int:id>', methods=['POST'])
+@idempotent(storage, IdempotencyKey)
 def purchase_book(id):
     """
     Make a purchase request for a specific item.
 
     Input:
     - item_id: The unique identifier of the item to purchase (integer)
+    - Optional 'Idempotency-Key' header; a retry with the same key gets the
+      response of the first request instead of buying again
 
     Output:
     - JSON response confirming the purchase
@@ -72,32 +446,14 @@ def purchase_book(id):
     - POST request: /purchase/456
     """
 
-    # Check stock availability from the catalog server
-    av_response = requests.get(f'{server_url}/books/{id}/stock/availability')
-
-    if av_response.status_code == 200:
-        # Decrease the stock count if the book is available
-        decrease_response = requests.put(
-            f'{server_url}/books/{id}/count/decrease')
-
-        # Check if the stock count decrease was successful
-        if decrease_response.status_code == 404:
-            return make_response(decrease_response.json(), 404)
-
-        # Retrieve book information after the stock count decrease
-        book_info = requests.get(f'{server_url}/books/{id}')
-        book = book_info.json()
-
-        # Create an Order record in the database
-        order = Order(book_data=book, purchase_date=datetime.now(), count=1)
-        db.session.add(order)
-        db.session.commit()
-
-        # Log the order information
-        with open('./order_log.txt', 'a') as log:
-            log.write(f"user purchased book {book['books']['name']} at {
-                      datetime.now()}, in stock left {decrease_response.json()['count']}\n")
+    try:
+        status, book = catalog_client.run(purchase_pipeline(id, current_deadline()))
+    except ServiceUnavailable as e:
+        # The catalog server did not answer in time, or its circuit is open
+        response = make_response(jsonify({'error': str(e)}), e.status)
+        return response if e.sent else not_applied(response)
 
+    if status == 200:
         # Emit a notification about the order confirmation
         socketio.emit('order_confirmation_original', {'order_info': {
             'book_info': book,
@@ -119,14 +475,406 @@ def purchase_book(id):
         return json_response
 
     else:
-        # Return an error response if the book is not available
-        json_response = av_response.json()
-        return make_response(json_response, 403)
+        # Return an error response if the book is not available or not found
+        return make_response(book, status)
+
+
+# Endpoint to queue the purchase of a book
+
+
+@app.route('/purchase/<int:id>/queue', methods=['POST'])
+@idempotent(storage, IdempotencyKey)
+def queue_purchase(id):
+    """
+    Queue the purchase of one copy of a book, for flash sales: the purchase
+    is accepted at once and sold later, in arrival order, by a worker that
+    reserves the copies of many queued purchases with one call.
+
+    Input:
+    - id: The unique identifier of the book to purchase (integer)
+    - Optional 'Idempotency-Key' header (see purchase_book)
+
+    Output:
+    - 202 with the 'ticket' of the purchase (its 'id', 'status' queued and
+      'position' in the queue); GET /tickets/<id>, or the 'subscribe_ticket'
+      Socket.IO event, gives its outcome
+    - 403 if the book is out of stock, 429 if its queue already holds as
+      many purchases as copies are left
+
+    Example:
+    - POST request: /purchase/456/queue
+    """
+    ticket, rejected = purchase_queue.submit(id)
+    if rejected is not None:
+        status, body = rejected
+        response = make_response(jsonify(body), status)
+        if status == 429:
+            # Not admitted, the purchase may be retried with the same key
+            response.headers['Retry-After'] = '1'
+            return not_applied(response)
+        return response
+
+    response = make_response(jsonify({'ticket': ticket}), 202)
+    response.headers['Location'] = f"/tickets/{ticket['id']}"
+    return response
+
+# Endpoint to get the outcome of a queued purchase
+
+
+@app.get('/tickets/<ticket_id>')
+def get_ticket(ticket_id):
+    """
+    Get the status of a queued purchase: 'queued', 'confirmed' with its
+    'order', or 'rejected' with the 'error' (and its 'status' code).
+    Resolved tickets are kept for 10 minutes.
+
+    Input:
+    - ticket_id: The id of the ticket returned by /purchase/<id>/queue
+
+    Output:
+    - JSON response containing the ticket, 404 if it is unknown or expired
+
+    Example:
+    - GET request: /tickets/2f1c9a7e0b6d4e5f8a3b2c1d0e9f8a7b
+    """
+    ticket = purchase_queue.get(ticket_id)
+    if ticket is None:
+        json_response = jsonify({
+            'error': f'ticket {ticket_id} not found'
+        })
+        return make_response(json_response, 404)
+    return jsonify({'ticket': ticket})
+
+# Endpoint to get the counters of the purchase queue
+
+
+@app.get('/queue/stats')
+def get_queue_stats():
+    """
+    Get the number of queued purchases accepted, rejected at admission,
+    confirmed and rejected, the batches run and the queue length per book.
+
+    Example:
+    - GET request: /queue/stats
+    """
+    return jsonify(purchase_queue.stats())
+
+
+# Endpoint to purchase several books at once
+
+
+@app.route('/cart', methods=['POST'])
+@idempotent(storage, IdempotencyKey)
+def purchase_cart():
+    """
+    Purchase several books in one request. Stock for every item is reserved
+    on the catalog server in a single all-or-nothing call, and all orders
+    are written in a single commit.
+
+    Input:
+    - JSON body with an 'items' list of {'id': book id, 'quantity': count}
+    - Optional 'Idempotency-Key' header (see purchase_book)
+
+    Output:
+    - JSON response confirming the orders
+
+    Example:
+    - POST request: /cart with JSON
+      {'items': [{'id': 1, 'quantity': 2}, {'id': 3, 'quantity': 1}]}
+    """
+
+    try:
+        status, body = catalog_client.run(
+            cart_pipeline(request.get_json(silent=True), current_deadline()))
+    except ServiceUnavailable as e:
+        # The catalog server did not answer in time, or its circuit is open
+        response = make_response(jsonify({'error': str(e)}), e.status)
+        return response if e.sent else not_applied(response)
+
+    if status != 200:
+        # Return an error response if any book is not available or not found
+        return make_response(body, status)
+
+    purchase_date = body['purchase_date']
+    books = body['books']
+
+    orders_info = [{
+        'book_info': {'books': book},
+        'purchase_date': purchase_date,
+        'count': book['quantity'],
+    } for book in books]
+
+    for order_info in orders_info:
+        # Emit a notification about the order confirmation
+        socketio.emit('order_confirmation_original',
+                      {'order_info': order_info})
+
+        # Emit a cache invalidation event
+        socketio.emit('cache_invalidate', {
+                      'key': order_info['book_info']['books']['id']})
+
+    # Return a JSON response confirming the orders
+    return jsonify({
+        'orders': orders_info
+    })
+
+
+# Default and maximum page size of the order listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+# Function to read the 'after' and 'limit' query parameters of a listing
+def parse_page_args(args):
+    after = int(args.get('after', 0))
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return after, min(limit, MAX_PAGE_SIZE)
+
+# Endpoint to get the counters of the storage writer
+
+
+@app.get('/storage/stats')
+def get_storage_stats():
+    """
+    Get the number of writes and of commits of the storage writer; with
+    group commit, writes_per_commit is the average batch size.
+
+    Output:
+    - JSON response containing 'group_commit', 'writes', 'commits' and
+      'writes_per_commit'
+
+    Example:
+    - GET request: /storage/stats
+    """
+    return jsonify(storage.stats())
 
+# Endpoint to list the orders of a book
+
+
+@app.get('/orders/book/<int:book_id>')
+def get_book_orders(book_id):
+    """
+    Get the orders of a book, oldest first, one page at a time (read from
+    the ix_order_book_id index). Includes the orders replicated from the
+    replica, whose 'origin' is 'replica'.
+
+    Input:
+    - book_id: The unique identifier of the book (integer)
+    - Optional query parameter 'after' (order id, default 0)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+
+    Output:
+    - JSON response containing a page of orders and 'next_after', the
+      cursor of the next page (null on the last page)
+
+    Example:
+    - GET request: /orders/book/1?after=100&limit=50
+    """
+    try:
+        after, limit = parse_page_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    query = (select(Order.id, Order.book_id, Order.unit_price, Order.quantity,
+                    Order.purchase_date, Order.origin)
+             .where(Order.book_id == book_id, Order.id > after)
+             .order_by(Order.id)
+             .limit(limit + 1))
+
+    # Fetch one extra row to know whether there is a next page
+    with storage.read_session() as session:
+        orders = [row._asdict() for row in session.execute(query)]
+    next_after = orders[limit - 1]['id'] if len(orders) > limit else None
+    return jsonify({
+        'orders': orders[:limit],
+        'next_after': next_after,
+    })
+
+# Endpoint to get the orders placed on this server after a sequence number
+
+
+@app.get('/orders/log')
+def get_order_log():
+    """
+    Get the orders placed on this server after a sequence number (the
+    order id), in order. The replica follows this log to copy them.
+
+    Input:
+    - Optional query parameter 'after' (sequence number, default 0)
+    - Optional query parameter 'limit' (integer, default 100, at most 1000)
+
+    Output:
+    - JSON response containing the orders, 'last_seq', the sequence number
+      of the latest order, and 'remaining', the number of orders after
+      this page
+
+    Example:
+    - GET request: /orders/log?after=1200&limit=500
+    """
+    try:
+        after, limit = parse_page_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    with storage.read_session() as session:
+        orders, last_seq, remaining = read_order_log(session, Order, after, limit)
+    return jsonify({
+        'orders': orders,
+        'last_seq': last_seq,
+        'remaining': remaining,
+    })
+
+# Endpoint to get the replication status of this server
+
+
+@app.get('/replication/status')
+def get_replication_status():
+    """
+    Get how far this server is behind the replica's order log.
+
+    Output:
+    - JSON response containing 'connected', 'applied_seq', 'peer_seq',
+      'lag_orders' (orders not applied yet), 'lag_seconds' (age of the last
+      applied order while behind), 'orders_applied' and 'last_pull_at'
+
+    Example:
+    - GET request: /replication/status
+    """
+    return jsonify(order_follower.status)
+
+# Endpoint to get the stock escrow counters and quotas
+
+
+@app.get('/escrow/stats')
+def get_escrow_stats():
+    """
+    Get the units of hot books leased from the catalog server, and how many
+    purchases were sold from them instead of calling the catalog server.
+
+    Output:
+    - JSON response containing 'local_sales', 'remote_sales',
+      'leases_acquired', 'units_leased', 'units_returned', 'lease_errors'
+      and the 'quotas' with their units left and seconds before they expire
+
+    Example:
+    - GET request: /escrow/stats
+    """
+    return jsonify(escrow.stats())
+
+
+# Function to run an analytics query on the rollup of its granularity
+def run_sales_query(analysis):
+    try:
+        query = parse_analytics_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    columns = sales_columns[query['granularity']].select(query)
+    return jsonify(analysis(columns, query))
+
+# Endpoint to get the best-selling books
+
+
+@app.get('/analytics/top-sellers')
+def get_top_sellers():
+    """
+    Rank books by units or revenue sold in a time range, read from the
+    sales rollups.
+
+    Input:
+    - Optional query parameters 'start' and 'end' (ISO 8601 datetimes,
+      default the last 7 days)
+    - Optional query parameter 'granularity' ('hour' or 'day', default
+      'hour'); the range is rounded to whole buckets
+    - Optional query parameter 'by' ('units' or 'revenue', default 'units')
+    - Optional query parameter 'limit' (integer, default 10, at most 1000)
+
+    Output:
+    - JSON response containing the range and the ranked books with their
+      units and revenue
+
+    Example:
+    - GET request: /analytics/top-sellers?start=2024-01-01&end=2024-01-08&by=revenue
+    """
+    return run_sales_query(top_sellers)
+
+# Endpoint to get the sales velocity of books
+
+
+@app.get('/analytics/velocity')
+def get_sales_velocity():
+    """
+    Get the units sold per day by books in a time range, and the trend of
+    that rate (least-squares slope, in units per day, per day).
+
+    Input:
+    - Optional query parameters 'start', 'end', 'granularity' and 'limit'
+      (see /analytics/top-sellers)
+    - Optional query parameter 'book_id' (integer) to get one book only
+
+    Output:
+    - JSON response containing the range and the books, fastest sellers
+      first, with units, revenue, units_per_day and trend
+
+    Example:
+    - GET request: /analytics/velocity?book_id=1&granularity=day
+    """
+    return run_sales_query(sales_velocity)
+
+# Endpoint to get the sales of every hour or day of a time range
+
+
+@app.get('/analytics/timeseries')
+def get_sales_timeseries():
+    """
+    Get the units and revenue of every bucket of a time range, including
+    buckets without sales.
+
+    Input:
+    - Optional query parameters 'start', 'end' and 'granularity' (see
+      /analytics/top-sellers)
+    - Optional query parameter 'book_id' (integer, default all books)
+
+    Output:
+    - JSON response containing the range and the series of buckets with
+      their start, units and revenue
+
+    Example:
+    - GET request: /analytics/timeseries?book_id=1&start=2024-01-01T00:00
+    """
+    return run_sales_query(sales_timeseries)
 
 
+# Background task deleting the expired idempotency keys
+def purge_idempotency_keys_loop():
+    while True:
+        socketio.sleep(PURGE_INTERVAL)
+        try:
+            while storage.write(purge_expired_keys, db.session, IdempotencyKey, datetime.now()):
+                pass
+        except Exception as e:
+            app.logger.warning(f"Purging idempotency keys failed: {e}")
 
 
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 3000 in debug mode
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=3000, debug=True)
+    debug = True
+    # In debug mode the reloader also runs this block in its watcher process.
+    # The background tasks must run once, in the process serving requests:
+    # two escrow managers with the same holder would return each other's leases.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        socketio.start_background_task(purge_idempotency_keys_loop)
+        socketio.start_background_task(order_follower.run, socketio.sleep, app.logger)
+        escrow.start()
+    socketio.run(app, host='0.0.0.0', port=3000, debug=debug)
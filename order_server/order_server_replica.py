@@ -1,12 +1,24 @@
 # order_server_replica.py
+import asyncio
+import os
 from datetime import datetime
 from flask import Flask, make_response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Integer, JSON, DATETIME
+from sqlalchemy import Integer, select, text
 from sqlalchemy.orm import Mapped, mapped_column
-from flask_socketio import SocketIO
-import requests
+from flask_socketio import SocketIO, emit, join_room
+from storage import EPOCH_MILLIS_SQL, EpochMillis, SQLiteStorage
+from access_log import AsyncLogWriter
+from catalog_client import CatalogClient
+from sales_analytics import (add_sales, backfill_sales, load_sales_columns, order_sales,
+                             parse_analytics_args, record_sales, sales_timeseries,
+                             sales_velocity, top_sellers)
+from service_client import ServiceClient, ServiceUnavailable, current_deadline, enforce_deadline
+from idempotency import PURGE_INTERVAL, idempotent, not_applied, purge_expired_keys
+from order_replication import OrderLogFollower, read_order_log
+from stock_escrow import StockEscrow, cart_items, consume_quota
+from purchase_queue import PurchaseQueue
 
 # Define a base class for SQLAlchemy models
 
@@ -25,23 +37,171 @@ app_replica.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db_replica = SQLAlchemy(model_class=Base)
 db_replica.init_app(app_replica)
 
+# WAL mode, pooled read connections and a single writer thread, with group
+# commit (see order_server.py)
+storage_replica = SQLiteStorage(db_replica, group_commit=True)
+storage_replica.init_app(app_replica)
+
 # Define SQLAlchemy model for Order in the replica
 
 
 class OrderReplica(db_replica.Model):
     __tablename__ = 'order_replica'  # Specify the table name
+    __table_args__ = (
+        db_replica.Index('ux_order_replica_origin', 'origin', 'origin_id', unique=True),
+    )
     id = db_replica.Column(db_replica.Integer, primary_key=True)
-    book_data = db_replica.Column(db_replica.JSON)
-    purchase_date = db_replica.Column(db_replica.DATETIME)
-    count = db_replica.Column(db_replica.Integer)
-
-
-# Create the Order replica table in the database
+    book_id = db_replica.Column(db_replica.Integer, index=True)
+    # Price paid per copy (NULL for orders placed before it was recorded)
+    unit_price = db_replica.Column(db_replica.Float)
+    quantity = db_replica.Column(db_replica.Integer)
+    purchase_date = db_replica.Column(EpochMillis, index=True)
+    # Orders replicated from the original order server (see order_server.Order)
+    origin = db_replica.Column(db_replica.String(32))
+    origin_id = db_replica.Column(db_replica.Integer)
+
+
+# Last sequence number of the original's order log stored here
+class ReplicationStateReplica(db_replica.Model):
+    __tablename__ = 'replication_state_replica'
+    peer = db_replica.Column(db_replica.String(32), primary_key=True)
+    applied_seq = db_replica.Column(db_replica.Integer, default=0)
+
+
+# Sales rollups of the replica's orders (see order_server.SalesHourly)
+class SalesHourlyReplica(db_replica.Model):
+    __tablename__ = 'sales_hourly_replica'
+    __table_args__ = (
+        db_replica.Index('ix_sales_hourly_replica_book_bucket', 'book_id', 'bucket'),
+        {'sqlite_with_rowid': False},
+    )
+    bucket = db_replica.Column(db_replica.Integer, primary_key=True)
+    book_id = db_replica.Column(db_replica.Integer, primary_key=True)
+    units = db_replica.Column(db_replica.Integer, default=0)
+    revenue = db_replica.Column(db_replica.Float, default=0)
+
+
+class SalesDailyReplica(db_replica.Model):
+    __tablename__ = 'sales_daily_replica'
+    __table_args__ = (
+        db_replica.Index('ix_sales_daily_replica_book_bucket', 'book_id', 'bucket'),
+        {'sqlite_with_rowid': False},
+    )
+    bucket = db_replica.Column(db_replica.Integer, primary_key=True)
+    book_id = db_replica.Column(db_replica.Integer, primary_key=True)
+    units = db_replica.Column(db_replica.Integer, default=0)
+    revenue = db_replica.Column(db_replica.Float, default=0)
+
+
+SALES_ROLLUPS_REPLICA = {
+    'hour': SalesHourlyReplica,
+    'day': SalesDailyReplica,
+}
+
+
+# Units of hot books leased from the catalog server (see order_server.StockQuota)
+class StockQuotaReplica(db_replica.Model):
+    __tablename__ = 'stock_quota_replica'
+    book_id = db_replica.Column(db_replica.Integer, primary_key=True)
+    units = db_replica.Column(db_replica.Integer, default=0)
+    name = db_replica.Column(db_replica.String)
+    price = db_replica.Column(db_replica.Float)
+
+
+# Outcomes of the purchases sent with an Idempotency-Key header (see
+# order_server.IdempotencyKey)
+class IdempotencyKeyReplica(db_replica.Model):
+    __tablename__ = 'idempotency_key_replica'
+    __table_args__ = {'sqlite_with_rowid': False}
+    key = db_replica.Column(db_replica.String(255), primary_key=True)
+    request_hash = db_replica.Column(db_replica.String(64))
+    status = db_replica.Column(db_replica.Integer)
+    response = db_replica.Column(db_replica.Text)
+    expires_at = db_replica.Column(EpochMillis, index=True)
+
+
+# Schema migrations of project_replica.db, the replica counterparts of
+# order_server.MIGRATIONS. Only ever append to MIGRATIONS_REPLICA.
+def add_order_indexes_replica(session):
+    session.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_order_replica_purchase_date ON order_replica (purchase_date)'))
+
+
+# Rebuild order_replica with typed columns instead of book_data JSON blobs
+# (see order_server.compact_orders)
+def compact_orders_replica(session):
+    columns = [row[1] for row in session.execute(text('PRAGMA table_info(order_replica)'))]
+    if 'book_data' not in columns:
+        return
+    session.execute(text('DROP INDEX IF EXISTS ix_order_replica_purchase_date'))
+    session.execute(text('ALTER TABLE order_replica RENAME TO order_replica_json'))
+    OrderReplica.__table__.create(session.connection())
+    session.execute(text(f'''
+        INSERT INTO order_replica (id, book_id, unit_price, quantity, purchase_date)
+        SELECT id, json_extract(book_data, '$.books.id'),
+               json_extract(book_data, '$.books.price'), count,
+               {EPOCH_MILLIS_SQL.format(column='purchase_date')}
+        FROM order_replica_json'''))
+    session.execute(text('DROP TABLE order_replica_json'))
+
+
+# Fill the rollup tables with the orders placed before they existed
+def add_sales_rollups_replica(session):
+    backfill_sales(session, 'order_replica', SALES_ROLLUPS_REPLICA)
+
+
+def add_order_origin_replica(session):
+    columns = [row[1] for row in session.execute(text('PRAGMA table_info(order_replica)'))]
+    if 'origin' not in columns:
+        session.execute(text('ALTER TABLE order_replica ADD COLUMN origin VARCHAR(32)'))
+        session.execute(text('ALTER TABLE order_replica ADD COLUMN origin_id INTEGER'))
+    session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ux_order_replica_origin '
+                         'ON order_replica (origin, origin_id)'))
+
+
+MIGRATIONS_REPLICA = [
+    add_order_indexes_replica,
+    compact_orders_replica,
+    add_sales_rollups_replica,
+    add_order_origin_replica,
+]
+
+
+# Create the Order replica table in the database and bring it up to date
 with app_replica.app_context():
     db_replica.create_all()
+    applied = storage_replica.run_migrations(MIGRATIONS_REPLICA)
+    for migration in applied:
+        app_replica.logger.info(f'Applied migration {MIGRATIONS_REPLICA.index(migration) + 1}: '
+                                f'{migration.__name__}')
+    if compact_orders_replica in applied:
+        # Give the space of the dropped JSON table back to the file system
+        storage_replica.vacuum()
+
+# In-memory columns of the sales rollups, read by the analytics endpoints
+with storage_replica.read_session() as session:
+    sales_columns = load_sales_columns(session, SALES_ROLLUPS_REPLICA)
 
 catalog_replica_url = "http://127.0.0.1:4001"
 
+# Keep-alive connection pool to the catalog replica, used by the purchase pipelines
+catalog_client = CatalogClient(catalog_replica_url)
+
+# Hot books are sold from units leased from the original catalog server,
+# which holds the count both catalog servers follow. The escrow's client has
+# its own loop, where every lease call runs (see StockEscrow.take_up_to).
+catalog_url = "http://127.0.0.1:4000"
+escrow = StockEscrow(storage_replica, StockQuotaReplica, CatalogClient(catalog_url), 'replica')
+escrow.load()
+
+# Answer 504 to requests whose caller has already given up
+enforce_deadline(app_replica)
+
+original_url = "http://127.0.0.1:3000"
+
+# Purchases are logged as JSON lines by a background writer (see order_server.py)
+order_log = AsyncLogWriter('./order_log_replica.txt')
+
 # SocketIO event handler for handling order confirmation in the replica
 
 
@@ -55,42 +215,225 @@ def handle_order_confirmation_replica(message):
         print("No order_info found in message")
 
 
-# Function to get the current catalog server replica index for a given action
-catalog_indices = {'purchase': 0}
+# Function to store orders and add their sales (order_sales(orders)) to the
+# rollup tables, in one transaction on the writer thread
+def store_orders_replica(orders_replica, sales, taken=()):
+    db_replica.session.add_all(orders_replica)
+    record_sales(db_replica.session, SALES_ROLLUPS_REPLICA, sales)
+    consume_quota(db_replica.session, StockQuotaReplica, taken)
 
 
+# Purchase pipeline, run on the catalog client loop: reserve the stock, then
+# store the order and log it at the same time. Returns (status code, body).
+async def purchase_pipeline(id, deadline=None):
+    # Sell from the local quota of a hot book, without calling a catalog server
+    book, taken = escrow.take(id), [(id, 1)]
+    if book is not None:
+        status, book = 200, {'books': book}
+    else:
+        # Check and decrease the stock count in a single call to the catalog replica server
+        status, book = await catalog_client.request(
+            'PUT', f'/books/{id}/count/reserve', deadline=deadline,
+            endpoint='PUT /books/<id>/count/reserve')
+        if status != 200:
+            return status, book
+        escrow.record_sale(id, 1)
+        taken = []
+
+    # Create an Order replica record in the database
+    order_replica = OrderReplica(
+        book_id=book['books']['id'], unit_price=book['books']['price'],
+        quantity=1, purchase_date=datetime.now())
+    sales = order_sales([order_replica])
+    inserted = asyncio.wrap_future(storage_replica.submit(
+        store_orders_replica, [order_replica], sales, taken))
+
+    # Log the order information
+    order_log.write({
+        'event': 'purchase',
+        'book_id': book['books']['id'],
+        'book_name': book['books']['name'],
+        'quantity': 1,
+        'left': book['books']['count'],
+    })
+
+    try:
+        await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+    return status, book
+
+
+# Cart pipeline, the same steps for several books at once
+async def cart_pipeline(items, deadline=None):
+    # Sell from the local quotas if every book of the cart has one
+    taken = cart_items(items)
+    books = escrow.take_all(taken) if taken else None
+    if books is None:
+        # Reserve the stock for every item in a single call to the catalog replica server
+        status, body = await catalog_client.request(
+            'PUT', '/books/count/reserve', json=items, deadline=deadline)
+        if status != 200:
+            return status, body
+        books = body['books']
+        for book in books:
+            escrow.record_sale(book['id'], book['quantity'])
+        taken = []
+
+    status = 200
+    purchase_date = datetime.now()
+
+    # Create one Order replica record per book and commit them together
+    orders_replica = [OrderReplica(book_id=book['id'], unit_price=book['price'],
+                                   quantity=book['quantity'], purchase_date=purchase_date)
+                      for book in books]
+    sales = order_sales(orders_replica)
+    inserted = asyncio.wrap_future(storage_replica.submit(
+        store_orders_replica, orders_replica, sales, taken))
+
+    # Log the order information
+    for book in books:
+        order_log.write({
+            'event': 'purchase',
+            'book_id': book['id'],
+            'book_name': book['name'],
+            'quantity': book['quantity'],
+            'left': book['count'],
+            'cart': True,
+        })
 
+    try:
+        await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+    return status, {'books': books, 'purchase_date': purchase_date}
+
+
+# Function to store queued orders like store_orders_replica, returning their ids
+def store_queued_orders_replica(orders_replica, sales, taken):
+    store_orders_replica(orders_replica, sales, taken)
+    db_replica.session.flush()
+    return [order_replica.id for order_replica in orders_replica]
+
+
+# Function to reserve up to quantity copies of a book on the catalog server,
+# all of those left if there are fewer. Returns (status code, body, copies).
+async def reserve_copies(id, quantity):
+    status, book = await catalog_client.request(
+        'PUT', f'/books/{id}/count/reserve', data={'quantity': quantity},
+        endpoint='PUT /books/<id>/count/reserve')
+    if status == 403:
+        # Fewer copies left than purchases in the batch, reserve them all
+        status, info = await catalog_client.request(
+            'GET', f'/books/{id}', endpoint='GET /books/<id>')
+        left = info['books']['count'] if status == 200 else 0
+        if not 0 < left < quantity:
+            return 403, {'success': False, 'message': 'Out of stock'}, 0
+        quantity = left
+        status, book = await catalog_client.request(
+            'PUT', f'/books/{id}/count/reserve', data={'quantity': quantity},
+            endpoint='PUT /books/<id>/count/reserve')
+    return status, book, quantity if status == 200 else 0
+
+
+# Batch pipeline of the purchase queue, run on the catalog client loop:
+# sell up to quantity copies of a book from its quota, reserve the rest with
+# one call and store one order per copy. Returns (status code, body, order
+# ids); the body has the book even if the reservation failed after copies
+# were taken from the quota.
+async def purchase_batch_pipeline(id, quantity):
+    local, units = await escrow.take_up_to(id, quantity)
+    taken = [(id, units)] if units else []
+    status, book, reserved = 200, {'books': local}, 0
+    if units < quantity:
+        try:
+            status, book, reserved = await reserve_copies(id, quantity - units)
+        except ServiceUnavailable as e:
+            if not units:
+                raise
+            status, book = e.status, {'error': str(e)}
+        if reserved:
+            escrow.record_sale(id, reserved)
+        elif not units:
+            return status, book, []
+        elif status == 403:
+            # The rest is out of stock, the copies of the quota are sold
+            status, book = 200, {'books': local}
+        else:
+            book = dict(book, books=local)
+
+    purchase_date = datetime.now()
+    orders_replica = [OrderReplica(book_id=id, unit_price=local['price'], quantity=1,
+                                   purchase_date=purchase_date) for _ in range(units)]
+    orders_replica += [OrderReplica(book_id=id, unit_price=book['books']['price'], quantity=1,
+                                    purchase_date=purchase_date) for _ in range(reserved)]
+    sales = order_sales(orders_replica)
+    inserted = asyncio.wrap_future(storage_replica.submit(
+        store_queued_orders_replica, orders_replica, sales, taken))
+
+    # Log the order information
+    order_log.write({
+        'event': 'purchase',
+        'book_id': id,
+        'book_name': book['books']['name'],
+        'quantity': units + reserved,
+        'left': book['books']['count'],
+        'queued': True,
+    })
+
+    try:
+        order_ids = await inserted
+    except Exception:
+        escrow.give_back(taken)
+        raise
+    add_sales(sales_columns, sales)
+    return status, book, order_ids
+
+
+# Function to send the outcome of a queued purchase to its subscribers
+def notify_ticket(ticket):
+    socketio_replica.emit('ticket_update', ticket, to=f"ticket:{ticket['id']}")
+
+
+# Queued purchases, drained in batches on the catalog client loop
+purchase_queue = PurchaseQueue(catalog_client.loop, purchase_batch_pipeline, notify_ticket,
+                               escrow.copies_left)
+
+
+# SocketIO event handler subscribing a client to the outcome of a queued purchase
+@socketio_replica.on('subscribe_ticket')
+def handle_subscribe_ticket(message):
+    ticket_id = message.get('ticket')
+    join_room(f'ticket:{ticket_id}')
+    # The purchase may have been resolved before the client subscribed
+    ticket = purchase_queue.get(ticket_id)
+    if ticket and ticket['status'] != 'queued':
+        emit('ticket_update', ticket)
+
+
+# Follower of the original's order log, so the replica holds every order
+order_follower = OrderLogFollower(storage_replica, OrderReplica, ReplicationStateReplica,
+                                  store_orders_replica, sales_columns, ServiceClient(),
+                                  'original', original_url)
 
 # Endpoint to purchase a book
 
 
 @app_replica.route('/purchase/<int:id>', methods=['POST'])
+@idempotent(storage_replica, IdempotencyKeyReplica)
 def purchase_book(id):
-   
-
-    # Check stock availability from the catalog replica server
-    av_response = requests.get(
-        f'{catalog_replica_url}/books/{id}/stock/availability')
-
-    if av_response.status_code == 200:
-        # Decrease the stock count if the book is available
-        decrease_response = requests.put(
-            f'{catalog_replica_url}/books/{id}/count/decrease')
-
-        # Check if the stock count decrease was successful
-        if decrease_response.status_code == 404:
-            return make_response(decrease_response.json(), 404)
-
-        # Retrieve book information after the stock count decrease
-        book_info = requests.get(f'{catalog_replica_url}/books/{id}')
-        book = book_info.json()
-
-        # Create an Order replica record in the database
-        order_replica = OrderReplica(
-            book_data=book, purchase_date=datetime.now(), count=1)
-        db_replica.session.add(order_replica)
-        db_replica.session.commit()
-
+    try:
+        status, book = catalog_client.run(purchase_pipeline(id, current_deadline()))
+    except ServiceUnavailable as e:
+        # The catalog server did not answer in time, or its circuit is open
+        response = make_response(jsonify({'error': str(e)}), e.status)
+        return response if e.sent else not_applied(response)
+
+    if status == 200:
         # Emit a notification about the order confirmation
         socketio_replica.emit('order_confirmation_replica', {'order_info': {
             'book_info': book,
@@ -109,11 +452,225 @@ def purchase_book(id):
         return json_response
 
     else:
-        # Return an error response if the book is not available
-        json_response = av_response.json()
-        return make_response(json_response, 403)
+        # Return an error response if the book is not available or not found
+        return make_response(book, status)
+
+
+# Endpoint to queue the purchase of a book
+
+
+@app_replica.route('/purchase/<int:id>/queue', methods=['POST'])
+@idempotent(storage_replica, IdempotencyKeyReplica)
+def queue_purchase(id):
+    ticket, rejected = purchase_queue.submit(id)
+    if rejected is not None:
+        status, body = rejected
+        response = make_response(jsonify(body), status)
+        if status == 429:
+            # Not admitted, the purchase may be retried with the same key
+            response.headers['Retry-After'] = '1'
+            return not_applied(response)
+        return response
+
+    response = make_response(jsonify({'ticket': ticket}), 202)
+    response.headers['Location'] = f"/tickets/{ticket['id']}"
+    return response
+
+# Endpoint to get the outcome of a queued purchase in the replica
+
+
+@app_replica.get('/tickets/<ticket_id>')
+def get_ticket(ticket_id):
+    ticket = purchase_queue.get(ticket_id)
+    if ticket is None:
+        json_response = jsonify({
+            'error': f'ticket {ticket_id} not found'
+        })
+        return make_response(json_response, 404)
+    return jsonify({'ticket': ticket})
+
+# Endpoint to get the counters of the purchase queue of the replica
+
+
+@app_replica.get('/queue/stats')
+def get_queue_stats():
+    return jsonify(purchase_queue.stats())
+
+
+# Endpoint to purchase several books at once
+
+
+@app_replica.route('/cart', methods=['POST'])
+@idempotent(storage_replica, IdempotencyKeyReplica)
+def purchase_cart():
+
+    try:
+        status, body = catalog_client.run(
+            cart_pipeline(request.get_json(silent=True), current_deadline()))
+    except ServiceUnavailable as e:
+        # The catalog server did not answer in time, or its circuit is open
+        response = make_response(jsonify({'error': str(e)}), e.status)
+        return response if e.sent else not_applied(response)
+
+    if status != 200:
+        # Return an error response if any book is not available or not found
+        return make_response(body, status)
+
+    purchase_date = body['purchase_date']
+    books = body['books']
+
+    orders_info = [{
+        'book_info': {'books': book},
+        'purchase_date': purchase_date,
+        'count': book['quantity'],
+    } for book in books]
+
+    # Emit a notification about the order confirmation
+    for order_info in orders_info:
+        socketio_replica.emit('order_confirmation_replica',
+                              {'order_info': order_info})
+
+    # Return a JSON response confirming the orders
+    return jsonify({
+        'orders': orders_info
+    })
+
+
+# Default and maximum page size of the order listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+# Function to read the 'after' and 'limit' query parameters of a listing
+def parse_page_args(args):
+    after = int(args.get('after', 0))
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return after, min(limit, MAX_PAGE_SIZE)
+
+# Endpoint to get the counters of the storage writer of the replica
+
+
+@app_replica.get('/storage/stats')
+def get_storage_stats():
+    return jsonify(storage_replica.stats())
+
+# Endpoint to list the orders of a book in the replica
+
+
+@app_replica.get('/orders/book/<int:book_id>')
+def get_book_orders(book_id):
+    try:
+        after, limit = parse_page_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    query = (select(OrderReplica.id, OrderReplica.book_id, OrderReplica.unit_price,
+                    OrderReplica.quantity, OrderReplica.purchase_date, OrderReplica.origin)
+             .where(OrderReplica.book_id == book_id, OrderReplica.id > after)
+             .order_by(OrderReplica.id)
+             .limit(limit + 1))
+
+    # Fetch one extra row to know whether there is a next page
+    with storage_replica.read_session() as session:
+        orders = [row._asdict() for row in session.execute(query)]
+    next_after = orders[limit - 1]['id'] if len(orders) > limit else None
+    return jsonify({
+        'orders': orders[:limit],
+        'next_after': next_after,
+    })
+
+# Endpoint to get the orders placed on the replica after a sequence number
+
+
+@app_replica.get('/orders/log')
+def get_order_log():
+    try:
+        after, limit = parse_page_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    with storage_replica.read_session() as session:
+        orders, last_seq, remaining = read_order_log(session, OrderReplica, after, limit)
+    return jsonify({
+        'orders': orders,
+        'last_seq': last_seq,
+        'remaining': remaining,
+    })
+
+# Endpoint to get how far the replica is behind the original's order log
+
+
+@app_replica.get('/replication/status')
+def get_replication_status():
+    return jsonify(order_follower.status)
+
+# Endpoint to get the stock escrow counters and quotas of the replica
+
+
+@app_replica.get('/escrow/stats')
+def get_escrow_stats():
+    return jsonify(escrow.stats())
+
+
+# Function to run an analytics query on the rollup of its granularity
+def run_sales_query(analysis):
+    try:
+        query = parse_analytics_args(request.args)
+    except ValueError as exc:
+        json_response = jsonify({
+            'error': exc.__str__()
+        })
+        return make_response(json_response, 400)
+
+    columns = sales_columns[query['granularity']].select(query)
+    return jsonify(analysis(columns, query))
+
+# Endpoints to get sales analytics of the replica's orders (see order_server.py)
+
+
+@app_replica.get('/analytics/top-sellers')
+def get_top_sellers():
+    return run_sales_query(top_sellers)
+
+
+@app_replica.get('/analytics/velocity')
+def get_sales_velocity():
+    return run_sales_query(sales_velocity)
+
+
+@app_replica.get('/analytics/timeseries')
+def get_sales_timeseries():
+    return run_sales_query(sales_timeseries)
+
+
+# Background task deleting the expired idempotency keys
+def purge_idempotency_keys_loop():
+    while True:
+        socketio_replica.sleep(PURGE_INTERVAL)
+        try:
+            while storage_replica.write(purge_expired_keys, db_replica.session,
+                                        IdempotencyKeyReplica, datetime.now()):
+                pass
+        except Exception as e:
+            app_replica.logger.warning(f"Purging idempotency keys failed: {e}")
 
 
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 3001 in debug mode
 if __name__ == '__main__':
-    socketio_replica.run(app_replica, host='0.0.0.0', port=3001, debug=True)
+    debug = True
+    # The background tasks run once, in the process serving requests, not in
+    # the watcher process of the reloader
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        socketio_replica.start_background_task(purge_idempotency_keys_loop)
+        socketio_replica.start_background_task(order_follower.run, socketio_replica.sleep,
+                                               app_replica.logger)
+        escrow.start()
+    socketio_replica.run(app_replica, host='0.0.0.0', port=3001, debug=debug)
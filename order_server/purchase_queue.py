@@ -0,0 +1,200 @@
+# purchase_queue.py
+# Queued purchases ("accept now, confirm later") for flash sales, shared by
+# the order servers.
+#
+# - A queued purchase is admitted into a bounded queue per book and answered
+#   at once with a ticket; it is not sold yet.
+# - Admission control rejects it right away once the book is known to be out
+#   of stock (403), or once its queue holds as many purchases as copies are
+#   left, or MAX_QUEUE_PER_BOOK of them (429). The copies left are those
+#   reported by the last batch, else those known to the stock escrow; while
+#   neither knows, at most UNKNOWN_STOCK_QUEUE purchases are queued.
+# - A pool of WORKERS coroutines on the catalog client loop drains the
+#   queues: each takes a book, reserves up to BATCH_SIZE copies with one call
+#   and stores the orders with one write, then confirms or rejects the
+#   tickets of the batch. Each book is drained by one worker at a time, so
+#   its purchases are sold in arrival order.
+# - Clients poll the ticket, or subscribe to it over Socket.IO, for the
+#   outcome. Tickets are kept in memory for TICKET_TTL once resolved; the
+#   queued purchases of a server that stops are lost, never sold.
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+# Most purchases queued per book, purchases reserved per catalog call, and
+# number of books drained at the same time
+MAX_QUEUE_PER_BOOK = 1000
+UNKNOWN_STOCK_QUEUE = 20
+BATCH_SIZE = 100
+WORKERS = 4
+
+# How long a resolved ticket can still be read, and how long the copies
+# left reported by a batch are trusted by the admission control (seconds)
+TICKET_TTL = 600
+STOCK_TTL = 5.0
+
+
+class Ticket:
+    """A queued purchase of one copy of a book."""
+
+    def __init__(self, book_id):
+        self.id = uuid.uuid4().hex
+        self.book_id = book_id
+        self.status = 'queued'
+        self.queued_at = datetime.now()
+        self.resolved_at = None
+        self.expires = None
+        # Order confirming the purchase, or the error rejecting it
+        self.order = None
+        self.error = None
+
+    def resolve(self, order=None, error=None):
+        self.status = 'confirmed' if order is not None else 'rejected'
+        self.order = order
+        self.error = error
+        self.resolved_at = datetime.now()
+        self.expires = time.monotonic() + TICKET_TTL
+
+    def info(self):
+        return {
+            'id': self.id,
+            'book_id': self.book_id,
+            'status': self.status,
+            'queued_at': self.queued_at.isoformat(),
+            'resolved_at': self.resolved_at and self.resolved_at.isoformat(),
+            'order': self.order,
+            'error': self.error,
+        }
+
+
+class PurchaseQueue:
+    """
+    Bounded purchase queues per book, drained in batches on loop.
+    process(book_id, quantity) is a coroutine reserving and storing up to
+    quantity copies; it returns (status code, body, order ids), with one order
+    id per copy sold and the book in the body if any was sold. The tickets
+    left over are rejected with the error, or as out of stock. notify(ticket
+    info) is called when a ticket is resolved. copies_left(book_id), if
+    given, returns the copies of a book known to be left, or None.
+    """
+
+    def __init__(self, loop, process, notify, copies_left=None, workers=WORKERS,
+                 batch_size=BATCH_SIZE, max_queue=MAX_QUEUE_PER_BOOK):
+        self.loop = loop
+        self.process = process
+        self.notify = notify
+        self.copies_left = copies_left
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.queues = {}
+        # Copies of each book left as of its last batch, (count, time)
+        self.stock = {}
+        self.tickets = {}
+        # Resolved tickets, in the order they were resolved, hence of expiry
+        self.resolved = deque()
+        self.draining = set()
+        self.lock = threading.Lock()
+        self.counters = {'accepted': 0, 'rejected_at_admission': 0,
+                         'confirmed': 0, 'rejected': 0, 'batches': 0}
+        self._workers = None
+        self._worker_count = workers
+
+    def submit(self, book_id):
+        """
+        Admit a purchase of one copy of a book. Returns (ticket info, None),
+        or (None, (status code, body)) if it is rejected.
+        """
+        with self.lock:
+            self._expire_tickets()
+            queue = self.queues.setdefault(book_id, deque())
+            left, reported_at = self.stock.get(book_id, (None, 0))
+            if time.monotonic() - reported_at > STOCK_TTL:
+                # Stock may have been added since
+                left = None
+            if left is None and self.copies_left is not None:
+                left = self.copies_left(book_id)
+            # Until a count is known, the book may have only a few copies
+            limit = self.max_queue if left is not None else min(self.max_queue,
+                                                                UNKNOWN_STOCK_QUEUE)
+            if left == 0:
+                self.counters['rejected_at_admission'] += 1
+                return None, (403, {'success': False, 'message': 'Out of stock'})
+            if len(queue) >= limit or (left is not None and len(queue) >= left):
+                self.counters['rejected_at_admission'] += 1
+                return None, (429, {'error': f'the purchase queue of book {book_id} is full, '
+                                             'every copy left is already queued'})
+
+            ticket = Ticket(book_id)
+            queue.append(ticket)
+            self.tickets[ticket.id] = ticket
+            self.counters['accepted'] += 1
+            position = len(queue)
+            start = book_id not in self.draining
+            if start:
+                self.draining.add(book_id)
+        if start:
+            asyncio.run_coroutine_threadsafe(self._drain(book_id), self.loop)
+        return dict(ticket.info(), position=position), None
+
+    def get(self, ticket_id):
+        """Info of a ticket, or None if it is unknown or expired."""
+        with self.lock:
+            ticket = self.tickets.get(ticket_id)
+            return ticket.info() if ticket else None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, queued={
+                book_id: len(queue) for book_id, queue in self.queues.items() if queue})
+
+    def _expire_tickets(self):
+        # A ticket still queued does not hold back the expiry of the others
+        now = time.monotonic()
+        while self.resolved and self.resolved[0].expires <= now:
+            del self.tickets[self.resolved.popleft().id]
+
+    async def _drain(self, book_id):
+        # Runs on the loop; at most one drain per book, at most WORKERS at a time
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self._worker_count)
+        async with self._workers:
+            while True:
+                with self.lock:
+                    queue = self.queues[book_id]
+                    batch = [queue.popleft() for _ in range(min(len(queue), self.batch_size))]
+                    if not batch:
+                        self.draining.discard(book_id)
+                        del self.queues[book_id]
+                        return
+                await self._run_batch(book_id, batch)
+
+    async def _run_batch(self, book_id, batch):
+        try:
+            status, body, order_ids = await self.process(book_id, len(batch))
+        except Exception as e:
+            status, body, order_ids = getattr(e, 'status', 500), {'error': str(e)}, []
+
+        with self.lock:
+            self.counters['batches'] += 1
+            if status == 200:
+                self.stock[book_id] = (body['books']['count'], time.monotonic())
+            elif status == 403:
+                self.stock[book_id] = (0, time.monotonic())
+            # Copies sold from a quota are confirmed even if the rest failed
+            for ticket, order_id in zip(batch, order_ids):
+                ticket.resolve(order={'id': order_id, 'book_info': {'books': body['books']},
+                                      'count': 1})
+            error = {key: value for key, value in body.items() if key != 'books'}
+            for ticket in batch[len(order_ids):]:
+                ticket.resolve(error=dict(
+                    error if status != 200 else {'success': False, 'message': 'Out of stock'},
+                    status=status if status != 200 else 403))
+            self.resolved.extend(batch)
+            self.counters['confirmed'] += len(order_ids)
+            self.counters['rejected'] += len(batch) - len(order_ids)
+
+        for ticket in batch:
+            self.notify(ticket.info())
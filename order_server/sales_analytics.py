@@ -0,0 +1,365 @@
+# sales_analytics.py
+# Sales rollups and analytics of the order servers.
+#
+# Every order adds its units and revenue to two rollup tables, sales per book
+# per hour and per book per day, in the same transaction as the order itself.
+# A rollup row is keyed by (bucket, book_id), the bucket being the number of
+# hours or days since 1970-01-01.
+#
+# Each server also keeps its rollups in memory as NumPy column arrays
+# (SalesColumns): loaded from the tables at startup, then appended to as
+# orders commit. Analytics select the rows of a time range with a vectorized
+# mask and aggregate them with bincount, without touching SQLite, so their
+# cost depends on the number of (bucket, book) pairs sold, not on the number
+# of orders.
+import functools
+import itertools
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from storage import EPOCH
+
+# Bucket size of each rollup
+GRANULARITIES = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+DEFAULT_GRANULARITY = 'hour'
+
+# Time range of a query when 'start' is not given
+DEFAULT_RANGE = timedelta(days=7)
+
+# Longest time range of a query, in buckets
+MAX_BUCKETS = 10000
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 1000
+
+RANKINGS = ('units', 'revenue')
+
+# Initial row capacity of the in-memory columns, and the number of rows read
+# from a rollup table at a time when loading them
+INITIAL_CAPACITY = 1024
+LOAD_BATCH_SIZE = 100000
+
+# Book ids below this are grouped with a dense bincount instead of a sort
+DENSE_BOOK_IDS = 1000000
+
+
+# Function to get the bucket of a naive datetime
+def bucket_of(moment, granularity):
+    return (moment - EPOCH) // GRANULARITIES[granularity]
+
+
+# Function to get the start of a bucket as an ISO 8601 string
+def bucket_start(bucket, granularity):
+    return (EPOCH + bucket * GRANULARITIES[granularity]).isoformat()
+
+
+# Function to get the sales of orders as plain
+# (purchase_date, book_id, quantity, unit_price) tuples
+def order_sales(orders):
+    return [(order.purchase_date, order.book_id, order.quantity, order.unit_price)
+            for order in orders]
+
+
+# Function to get the statement adding units and revenue to a rollup row,
+# built once per rollup table
+@functools.lru_cache(maxsize=None)
+def sales_upsert(table):
+    statement = sqlite_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=['bucket', 'book_id'],
+        set_={
+            'units': table.c.units + statement.excluded.units,
+            'revenue': table.c.revenue + statement.excluded.revenue,
+        })
+
+
+# Function to add sales to the rollup tables, in the transaction that stores
+# their orders. rollups maps each granularity to its model.
+def record_sales(session, rollups, sales):
+    for granularity, model in rollups.items():
+        totals = {}
+        for purchase_date, book_id, quantity, unit_price in sales:
+            key = (bucket_of(purchase_date, granularity), book_id)
+            units, revenue = totals.get(key, (0, 0.0))
+            totals[key] = (units + quantity, revenue + quantity * (unit_price or 0))
+        if not totals:
+            continue
+
+        # Core statement on the session's connection, skipping the ORM bulk path
+        session.connection().execute(sales_upsert(model.__table__), [
+            {'bucket': bucket, 'book_id': book_id, 'units': units, 'revenue': revenue}
+            for (bucket, book_id), (units, revenue) in totals.items()])
+
+
+# Function to fill empty rollups from the orders already in order_table,
+# for the migration that adds them
+def backfill_sales(session, order_table, rollups):
+    for granularity, model in rollups.items():
+        bucket_ms = GRANULARITIES[granularity] // timedelta(milliseconds=1)
+        session.execute(text(f'''
+            INSERT INTO {model.__tablename__} (bucket, book_id, units, revenue)
+            SELECT purchase_date / {bucket_ms}, book_id, SUM(quantity),
+                   SUM(quantity * COALESCE(unit_price, 0))
+            FROM {order_table}
+            GROUP BY 1, 2'''))
+
+
+# Function to parse the query parameters shared by the analytics endpoints.
+# Raises ValueError for invalid ones.
+def parse_analytics_args(args):
+    granularity = args.get('granularity', DEFAULT_GRANULARITY)
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+
+    end = datetime.fromisoformat(args['end']) if 'end' in args else datetime.now()
+    start = datetime.fromisoformat(args['start']) if 'start' in args else end - DEFAULT_RANGE
+    if end <= start:
+        raise ValueError('end must be after start')
+    # Every bucket overlapping [start, end)
+    first = bucket_of(start, granularity)
+    last = bucket_of(end - timedelta(microseconds=1), granularity)
+    if last - first >= MAX_BUCKETS:
+        raise ValueError(f'the range must not span more than {MAX_BUCKETS} buckets')
+
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+
+    by = args.get('by', 'units')
+    if by not in RANKINGS:
+        raise ValueError(f"by must be one of {', '.join(RANKINGS)}")
+
+    return {
+        'granularity': granularity,
+        'first': first,
+        'last': last,
+        'book_id': int(args['book_id']) if 'book_id' in args else None,
+        'limit': min(limit, MAX_LIMIT),
+        'by': by,
+    }
+
+
+class SalesColumns:
+    """
+    In-memory copy of one rollup as NumPy columns (bucket, book_id, units,
+    revenue). New sales are appended as rows of their own, so a (bucket,
+    book_id) pair may repeat until the next compaction merges the rows;
+    queries sum them either way. Rows up to the last compaction are ordered
+    by bucket, so a range is found by binary search; later rows are masked.
+    Appends come from several threads (the purchase pipelines on the catalog
+    client loop and the order-log follower), and select() from any request
+    thread, so both hold the lock.
+    """
+
+    def __init__(self, granularity, capacity=INITIAL_CAPACITY):
+        self.granularity = granularity
+        self._columns = self._allocate(capacity)
+        self._size = 0
+        # Size right after the last compaction; compact when it has doubled
+        self._compacted_size = 0
+        # Required: appends and snapshots race between threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _allocate(capacity):
+        return {
+            'bucket': np.zeros(capacity, dtype=np.int64),
+            'book_id': np.zeros(capacity, dtype=np.int64),
+            'units': np.zeros(capacity, dtype=np.float64),
+            'revenue': np.zeros(capacity, dtype=np.float64),
+        }
+
+    def load(self, session, model):
+        """Append every row of the rollup table model (call once, at startup)."""
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute(
+                f'SELECT bucket, book_id, units, revenue FROM {model.__tablename__} '
+                'ORDER BY bucket, book_id')
+            while True:
+                rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+                if not rows:
+                    break
+                self._append(np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                                         count=4 * len(rows)).reshape(-1, 4), ordered=True)
+        finally:
+            cursor.close()
+
+    def add(self, sales):
+        """Append the sales (see order_sales) of committed orders."""
+        if sales:
+            self._append(np.array([
+                (bucket_of(purchase_date, self.granularity), book_id,
+                 quantity, quantity * (unit_price or 0))
+                for purchase_date, book_id, quantity, unit_price in sales], dtype=np.float64))
+
+    def _append(self, rows, ordered=False):
+        # ordered: rows are distinct pairs that follow every row so far in
+        # bucket order (the table is read in primary key order)
+        with self._lock:
+            size = self._size + len(rows)
+            capacity = len(self._columns['bucket'])
+            if size > capacity:
+                # Grow into new arrays; snapshots taken by select() keep the old ones
+                columns = self._allocate(max(size, 2 * capacity))
+                for name, column in columns.items():
+                    column[:self._size] = self._columns[name][:self._size]
+                self._columns = columns
+            for index, name in enumerate(('bucket', 'book_id', 'units', 'revenue')):
+                self._columns[name][self._size:size] = rows[:, index]
+
+            if ordered and self._compacted_size == self._size:
+                self._size = self._compacted_size = size
+            else:
+                self._size = size
+                if self._size >= 2 * max(self._compacted_size, INITIAL_CAPACITY):
+                    self._compact()
+
+    def _compact(self):
+        # Merge the rows of each (bucket, book_id) pair, ordered by bucket
+        bucket = self._columns['bucket'][:self._size]
+        book_id = self._columns['book_id'][:self._size]
+        keys, index = np.unique(bucket * 2 ** 32 + book_id, return_inverse=True)
+        columns = self._allocate(max(2 * len(keys), INITIAL_CAPACITY))
+        columns['bucket'][:len(keys)] = keys // 2 ** 32
+        columns['book_id'][:len(keys)] = keys % 2 ** 32
+        for name in ('units', 'revenue'):
+            columns[name][:len(keys)] = np.bincount(
+                index, weights=self._columns[name][:self._size], minlength=len(keys))
+        self._columns = columns
+        self._size = self._compacted_size = len(keys)
+
+    def select(self, query):
+        """Rows of the query's range (and book), with buckets relative to its first."""
+        with self._lock:
+            columns = {name: column[:self._size] for name, column in self._columns.items()}
+            ordered = self._compacted_size
+
+        bucket = columns['bucket']
+        start = np.searchsorted(bucket[:ordered], query['first'], side='left')
+        end = np.searchsorted(bucket[:ordered], query['last'], side='right')
+        recent = (bucket[ordered:] >= query['first']) & (bucket[ordered:] <= query['last'])
+        selected = {name: np.concatenate((column[start:end], column[ordered:][recent]))
+                    for name, column in columns.items()}
+
+        if query['book_id'] is not None:
+            mask = selected['book_id'] == query['book_id']
+            selected = {name: column[mask] for name, column in selected.items()}
+        selected['bucket'] -= query['first']
+        return selected
+
+
+# Function to create and load the in-memory columns of every rollup
+def load_sales_columns(session, rollups):
+    sales_columns = {}
+    for granularity, model in rollups.items():
+        sales_columns[granularity] = SalesColumns(granularity)
+        sales_columns[granularity].load(session, model)
+    return sales_columns
+
+
+# Function to add the sales of committed orders to the in-memory columns
+def add_sales(sales_columns, sales):
+    for columns in sales_columns.values():
+        columns.add(sales)
+
+
+# Function to get the range of a query as a JSON-ready dict
+def describe_range(query):
+    return {
+        'granularity': query['granularity'],
+        'start': bucket_start(query['first'], query['granularity']),
+        'end': bucket_start(query['last'] + 1, query['granularity']),
+    }
+
+
+# Function to group rows by book. Returns the distinct book ids and the
+# group (index into them) of every row.
+def group_by_book(book_id):
+    if not len(book_id) or book_id.max() >= DENSE_BOOK_IDS:
+        return np.unique(book_id, return_inverse=True)
+    present = np.bincount(book_id) > 0
+    return np.flatnonzero(present), (np.cumsum(present) - 1)[book_id]
+
+
+# Function to sum the units and revenue of every book in the columns.
+# Returns the book ids, the group of every row and the totals, as arrays.
+def totals_by_book(columns):
+    book_ids, index = group_by_book(columns['book_id'])
+    units = np.bincount(index, weights=columns['units'], minlength=len(book_ids))
+    revenue = np.bincount(index, weights=columns['revenue'], minlength=len(book_ids))
+    return book_ids, index, units, revenue
+
+
+# Function to get the indices of the limit largest values, largest first
+def top_indices(values, limit):
+    if len(values) > limit:
+        candidates = np.argpartition(-values, limit - 1)[:limit]
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+
+# Function to rank books by units or revenue sold in the range
+def top_sellers(columns, query):
+    book_ids, _, units, revenue = totals_by_book(columns)
+    ranked = top_indices(units if query['by'] == 'units' else revenue, query['limit'])
+    return {
+        **describe_range(query),
+        'books': [{
+            'book_id': int(book_ids[i]),
+            'units': int(units[i]),
+            'revenue': round(float(revenue[i]), 2),
+        } for i in ranked],
+    }
+
+
+# Function to get the sales rate of books over the range: units sold per day,
+# and its trend, the least-squares slope of the sales rate over time (units
+# per day, per day). Buckets without sales count as zero sales.
+def sales_velocity(columns, query):
+    book_ids, index, units, revenue = totals_by_book(columns)
+    buckets = query['last'] - query['first'] + 1
+    buckets_per_day = timedelta(days=1) / GRANULARITIES[query['granularity']]
+    days = buckets / buckets_per_day
+
+    # Slope of units per bucket against the bucket number. The zero buckets
+    # add nothing to the numerator, so it is a weighted sum of the sold ones.
+    offsets = columns['bucket'] - (buckets - 1) / 2
+    denominator = (buckets ** 3 - buckets) / 12
+    numerator = np.bincount(index, weights=columns['units'] * offsets, minlength=len(book_ids))
+    trend = numerator / denominator * buckets_per_day ** 2 if buckets > 1 else np.zeros_like(units)
+
+    ranked = top_indices(units, query['limit'])
+    return {
+        **describe_range(query),
+        'books': [{
+            'book_id': int(book_ids[i]),
+            'units': int(units[i]),
+            'revenue': round(float(revenue[i]), 2),
+            'units_per_day': round(float(units[i] / days), 4),
+            'trend': round(float(trend[i]), 4),
+        } for i in ranked],
+    }
+
+
+# Function to get the units and revenue of every bucket of the range,
+# including buckets without sales
+def sales_timeseries(columns, query):
+    buckets = query['last'] - query['first'] + 1
+    units = np.bincount(columns['bucket'], weights=columns['units'], minlength=buckets)
+    revenue = np.bincount(columns['bucket'], weights=columns['revenue'], minlength=buckets)
+    return {
+        **describe_range(query),
+        'book_id': query['book_id'],
+        'series': [{
+            'start': bucket_start(query['first'] + i, query['granularity']),
+            'units': int(units[i]),
+            'revenue': round(float(revenue[i]), 2),
+        } for i in range(buckets)],
+    }
@@ -0,0 +1,230 @@
+# service_client.py
+# Resilient HTTP calls between the services, shared by the front tier, the
+# order servers and the catalog servers (one copy in each service folder).
+#
+# - Every call has a timeout, never longer than what is left of the deadline.
+# - Idempotent GETs are retried a bounded number of times, with jittered
+#   exponential backoff, on connection errors, timeouts and 5xx answers.
+#   Other calls are retried the same way only when the caller marks them
+#   idempotent, e.g. a POST carrying an Idempotency-Key header.
+# - A circuit breaker per endpoint fails fast while the endpoint keeps failing,
+#   and lets one trial call through after BREAKER_RESET_TIMEOUT seconds.
+# - The deadline of a call is sent downstream in the X-Request-Deadline header
+#   (absolute Unix time). enforce_deadline() makes a Flask app answer 504 to
+#   requests whose caller has already given up, instead of working on them.
+import random
+import threading
+import time
+import requests
+from urllib3.exceptions import NewConnectionError
+from flask import has_request_context, jsonify, make_response, request
+
+DEADLINE_HEADER = 'X-Request-Deadline'
+
+# Timeout of one call (seconds), retries of a failed idempotent call and their base delay
+DEFAULT_TIMEOUT = 5.0
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.1
+
+# Consecutive failures that open a circuit, and how long it stays open (seconds)
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 10.0
+
+
+class ServiceUnavailable(Exception):
+    """
+    A call was not made or did not complete. status is the HTTP status to
+    answer with. sent is False when the request was known never to reach the
+    server (so it had no effect there), True when it may have.
+    """
+
+    def __init__(self, message, status=503, sent=True):
+        super().__init__(message)
+        self.status = status
+        self.sent = sent
+
+
+class CircuitOpen(ServiceUnavailable):
+    def __init__(self, message):
+        super().__init__(message, sent=False)
+
+
+class DeadlineExceeded(ServiceUnavailable):
+    def __init__(self, message):
+        # Raised before the call is made
+        super().__init__(message, 504, sent=False)
+
+
+class CircuitBreaker:
+    """Closed -> open after threshold consecutive failures -> half-open after reset_timeout."""
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Whether a call may be made now (only one trial call when half-open)."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+# Function to get the deadline of the request being handled (None if it has none)
+def current_deadline():
+    if not has_request_context():
+        return None
+    try:
+        return float(request.headers[DEADLINE_HEADER])
+    except (KeyError, ValueError):
+        return None
+
+
+# Function to make a Flask app answer 504 to requests past their deadline
+def enforce_deadline(app):
+    @app.before_request
+    def reject_expired_request():
+        deadline = current_deadline()
+        if deadline is not None and time.time() >= deadline:
+            json_response = jsonify({
+                'error': 'request deadline exceeded'
+            })
+            return make_response(json_response, 504)
+
+
+# Function to tell whether the deadline of the caller (if any) has passed
+def out_of_time(deadline):
+    return deadline is not None and deadline <= time.time()
+
+
+# Function to tell whether a failed call never reached the server: no
+# connection could be opened (refused, unresolved or timed out), so nothing
+# was sent. requests wraps a refused connection in a plain ConnectionError.
+def never_sent(exc):
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    cause = exc.args[0] if exc.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+
+
+# Function to get the timeout of a call and the deadline sent downstream,
+# from the timeout of the call and the deadline of the caller (if any)
+def call_budget(timeout, deadline=None):
+    call_deadline = time.time() + timeout
+    if deadline is not None:
+        call_deadline = min(call_deadline, deadline)
+    remaining = call_deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded('request deadline exceeded')
+    return remaining, call_deadline
+
+
+# Function to get the jittered delay before retry number attempt (0-based)
+def retry_delay(attempt, backoff=RETRY_BACKOFF):
+    return backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class ServiceClient:
+    """requests.Session with timeouts, GET retries, circuit breakers and deadline propagation."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker()
+            return self._breakers[endpoint]
+
+    def breakers(self):
+        """State of every circuit breaker, by endpoint."""
+        return {endpoint: {'state': breaker.state, 'failures': breaker.failures}
+                for endpoint, breaker in self._breakers.items()}
+
+    def request(self, method, url, endpoint=None, timeout=None, idempotent=False, **kwargs):
+        """
+        Make a call and return its response, or raise ServiceUnavailable.
+        endpoint names the circuit breaker of the call, e.g.
+        'GET http://catalog:4000/books/<id>' (default: method and URL).
+        GETs are retried, other methods only if idempotent is True (the
+        server must deduplicate them, e.g. by an Idempotency-Key header).
+        5xx responses are returned once the retries are used up.
+        """
+        endpoint = endpoint or f'{method} {url}'
+        breaker = self.breaker(endpoint)
+        deadline = current_deadline()
+        attempts = 1 + (self.retries if method == 'GET' or idempotent else 0)
+
+        for attempt in range(attempts):
+            # A retry that cannot be made reports the outcome of the last
+            # attempt, which was sent
+            if attempt and out_of_time(deadline):
+                break
+            if not breaker.allow():
+                if attempt:
+                    break
+                raise CircuitOpen(f'circuit open for {endpoint}')
+            call_timeout, call_deadline = call_budget(timeout or self.timeout, deadline)
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers[DEADLINE_HEADER] = f'{call_deadline:.3f}'
+            kwargs['headers'] = headers
+
+            try:
+                response = self.session.request(method, url, timeout=call_timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                breaker.record_failure()
+                error = ServiceUnavailable(f'{endpoint} failed: {exc}', sent=not never_sent(exc))
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                error = None
+
+            if attempt + 1 < attempts:
+                time.sleep(retry_delay(attempt))
+        if error is not None:
+            raise error
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
@@ -0,0 +1,444 @@
+# stock_escrow.py
+# Stock escrow for hot books, shared by the order servers.
+#
+# - The order server leases a block of units of each hot book from the
+#   catalog server (PUT /books/<id>/lease), which takes them out of the book's
+#   count. Purchases of the book are then sold from this local quota, with no
+#   call to the catalog server; the quota is decremented in the same
+#   transaction as the order (stock_quota table), so it survives a restart.
+# - A maintenance task on the catalog client loop refills a quota that runs
+#   low, renews it before its lease expires (reporting the units left), and
+#   returns the unsold units of books that went cold.
+# - A quota is never sold from after its local deadline, which falls before
+#   the catalog server's expiry, and expired quotas are returned. At startup
+#   every lease the catalog server still has for this order server is
+#   returned, with the units left in the stock_quota table, so leased units
+#   go back to the count unless they were sold. Units are never sold twice:
+#   the catalog only hands out units it took out of the count.
+# - Every lease request also sends an allowance: the most units the quota
+#   will sell until the next successful report. If the order server stops
+#   and never returns its leases, the catalog server takes back the units
+#   beyond the last allowance once the lease has expired (plus a grace
+#   period); a renewal or return then fails or returns less, and the quota is
+#   given up. The units of the last allowance that were not sold stay leased
+#   until the order server starts again and returns them.
+# - Books without a quota, or with too few units left, are reserved on the
+#   catalog server as before. A batch of queued purchases takes what the
+#   quota has and reserves only the rest.
+import asyncio
+import threading
+import time
+from collections import deque
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+# A book is hot when at least HOT_UNITS of it are sold within HOT_WINDOW seconds
+HOT_WINDOW = 10.0
+HOT_UNITS = 20
+
+# A lease covers REFILL_HORIZON seconds of sales, within these bounds, and is
+# refilled once less than REFILL_BELOW of that is left
+REFILL_HORIZON = 30.0
+MIN_LEASE_UNITS = 10
+MAX_LEASE_UNITS = 1000
+REFILL_BELOW = 0.5
+
+# A quota may sell ALLOWANCE_HORIZON seconds of sales (at least
+# MIN_ALLOWANCE units) between two reports, and reports again once less than
+# REFILL_BELOW of that is left
+ALLOWANCE_HORIZON = 5.0
+MIN_ALLOWANCE = 5
+
+# Quotas without a sale for COLD_AFTER seconds are returned
+COLD_AFTER = 60.0
+
+# A quota stops selling EXPIRY_MARGIN seconds before its lease expires, and
+# is renewed once less than half of its lease time is left
+EXPIRY_MARGIN = 2.0
+
+# Pause between two maintenance rounds (seconds)
+MAINTAIN_INTERVAL = 1.0
+
+
+class Quota:
+    """Units of a book leased by this order server."""
+
+    def __init__(self, book_id, units=0, name=None, price=None, count=0):
+        self.book_id = book_id
+        self.units = units
+        self.name = name
+        self.price = price
+        # Count of the book on the catalog server when the lease was last renewed
+        self.count = count
+        self.ttl = 0.0
+        self.renewed_at = 0.0
+        self.deadline = 0.0
+        self.last_sale = time.monotonic()
+        # Units that may still be sold until the next report, and units sold
+        # so far (less those given back)
+        self.allowance = 0
+        self.sold = 0
+        # Held while a renewal is in flight: the catalog server must keep the
+        # allowance of the last answer the quota applied
+        self.renewing = asyncio.Lock()
+        # Set while the quota is being returned, it is not sold from anymore
+        self.closed = False
+
+    def available(self, now):
+        # Units that can be sold right now
+        if self.closed or now >= self.deadline:
+            return 0
+        return max(min(self.units, self.allowance), 0)
+
+    def sell(self, quantity, now):
+        self.units -= quantity
+        self.allowance -= quantity
+        self.sold += quantity
+        self.last_sale = now
+
+    def book(self, quantity=None):
+        book = {'id': self.book_id, 'name': self.name,
+                'count': self.count + self.units, 'price': self.price}
+        if quantity is not None:
+            book['quantity'] = quantity
+        return book
+
+
+# Function to decrease the quotas by the units sold with an order, run on the
+# writer thread in the order's transaction. taken is a list of (book_id, units).
+def consume_quota(session, model, taken):
+    for book_id, units in taken:
+        session.execute(update(model).where(model.book_id == book_id)
+                        .values(units=model.units - units))
+
+
+# Function to add leased units to a quota, run on the writer thread
+def add_quota(session, model, book_id, units, name, price):
+    statement = sqlite_insert(model).values(
+        book_id=book_id, units=units, name=name, price=price)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=['book_id'],
+        set_={'units': model.units + units, 'name': name, 'price': price}))
+
+
+# Function to delete a returned quota (every quota if book_id is None), run
+# on the writer thread
+def drop_quota(session, model, book_id):
+    statement = delete(model)
+    if book_id is not None:
+        statement = statement.where(model.book_id == book_id)
+    session.execute(statement)
+
+
+# Function to read the (book_id, quantity) items of a cart request, or None
+# if it is malformed (the catalog server then answers with the error)
+def cart_items(payload):
+    try:
+        items = {}
+        for item in payload['items']:
+            book_id, quantity = int(item['id']), int(item.get('quantity', 1))
+            if quantity < 1:
+                return None
+            items[book_id] = items.get(book_id, 0) + quantity
+        return list(items.items()) or None
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return None
+
+
+class StockEscrow:
+    """Local quotas of hot books, leased from the catalog server by holder."""
+
+    def __init__(self, storage, model, client, holder):
+        self.storage = storage
+        self.model = model
+        self.client = client
+        self.holder = holder
+        self.quotas = {}
+        # Units left in the stock_quota table at startup, by book, until the
+        # leases of the last run are returned
+        self.unreconciled = None
+        # Recent sales per book, (time, units), for the hot book detection
+        self.sales = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            'local_sales': 0,
+            'remote_sales': 0,
+            'leases_acquired': 0,
+            'units_leased': 0,
+            'units_returned': 0,
+            'lease_errors': 0,
+        }
+
+    def load(self):
+        """Read the quotas left by the last run; they are returned first."""
+        with self.storage.read_session() as session:
+            self.unreconciled = {row.book_id: row.units for row in session.query(self.model)}
+
+    def start(self):
+        """Start the maintenance task on the catalog client loop."""
+        asyncio.run_coroutine_threadsafe(self.maintain_forever(), self.client.loop)
+
+    def take(self, book_id, quantity=1):
+        """Take units from the quota of a book; returns the book, or None."""
+        now = time.monotonic()
+        with self.lock:
+            quota = self.quotas.get(book_id)
+            if quota is None or quota.available(now) < quantity:
+                return None
+            quota.sell(quantity, now)
+            self._record_sale(book_id, quantity, now)
+            self.counters['local_sales'] += 1
+            return quota.book()
+
+    def take_some(self, book_id, quantity):
+        """
+        Take up to quantity units from the quota of a book; returns the book
+        and the units taken, (None, 0) if none could be.
+        """
+        now = time.monotonic()
+        with self.lock:
+            quota = self.quotas.get(book_id)
+            units = min(quota.available(now), quantity) if quota is not None else 0
+            if not units:
+                return None, 0
+            quota.sell(units, now)
+            self._record_sale(book_id, units, now)
+            self.counters['local_sales'] += 1
+            return quota.book(), units
+
+    async def take_up_to(self, book_id, quantity):
+        """
+        Take up to quantity units from the quota of a book, as take_some, but
+        report the quota first if only its allowance is short. Can be awaited
+        on any event loop.
+        """
+        book, units = self.take_some(book_id, quantity)
+        with self.lock:
+            quota = self.quotas.get(book_id)
+            if units == quantity or quota is None or quota.units <= max(quota.allowance, 0):
+                return book, units
+            target, allowance, _ = self._target(book_id, time.monotonic())
+        # The renewal runs on the escrow client's loop, which owns its session
+        # and the quota locks; the caller may run on another loop
+        try:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                self.renew(book_id, target, max(allowance, quantity - units), quota),
+                self.client.loop))
+        except Exception as e:
+            # The units taken are still sold; the catalog server gets the rest
+            self.counters['lease_errors'] += 1
+            print(f"Stock lease of book {book_id} failed: {e}")
+            return book, units
+        more_book, more = self.take_some(book_id, quantity - units)
+        return more_book or book, units + more
+
+    def take_all(self, items):
+        """Take units for every (book_id, quantity) of a cart, or for none."""
+        now = time.monotonic()
+        with self.lock:
+            quotas = [self.quotas.get(book_id) for book_id, _ in items]
+            if not all(quota is not None and quota.available(now) >= quantity
+                       for quota, (_, quantity) in zip(quotas, items)):
+                return None
+            books = []
+            for quota, (book_id, quantity) in zip(quotas, items):
+                quota.sell(quantity, now)
+                self._record_sale(book_id, quantity, now)
+                books.append(quota.book(quantity))
+            self.counters['local_sales'] += 1
+            return books
+
+    def give_back(self, taken):
+        """Put back units taken for an order that could not be stored."""
+        with self.lock:
+            for book_id, units in taken:
+                quota = self.quotas.get(book_id)
+                if quota is not None and not quota.closed:
+                    quota.units += units
+                    quota.allowance += units
+                    quota.sold -= units
+
+    def record_sale(self, book_id, quantity):
+        """Count a sale reserved on the catalog server."""
+        with self.lock:
+            self._record_sale(book_id, quantity, time.monotonic())
+            self.counters['remote_sales'] += 1
+
+    def _record_sale(self, book_id, quantity, now):
+        window = self.sales.setdefault(book_id, deque())
+        window.append((now, quantity))
+        while window[0][0] < now - HOT_WINDOW:
+            window.popleft()
+
+    def _target(self, book_id, now):
+        # Units a lease of the book should hold, its allowance, and whether
+        # the book is hot
+        window = self.sales.get(book_id, ())
+        units = sum(quantity for moment, quantity in window if moment >= now - HOT_WINDOW)
+        target = min(max(int(units / HOT_WINDOW * REFILL_HORIZON), MIN_LEASE_UNITS),
+                     MAX_LEASE_UNITS)
+        allowance = min(max(int(units / HOT_WINDOW * ALLOWANCE_HORIZON), MIN_ALLOWANCE), target)
+        return target, allowance, units >= HOT_UNITS
+
+    async def maintain_forever(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                self.counters['lease_errors'] += 1
+                print(f"Stock escrow maintenance failed: {e}")
+            await asyncio.sleep(MAINTAIN_INTERVAL)
+
+    async def maintain(self):
+        """Acquire, refill, renew and return the quotas."""
+        if self.unreconciled is not None:
+            await self.reconcile()
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            for book_id in [book_id for book_id, window in self.sales.items()
+                            if window[-1][0] < now - HOT_WINDOW]:
+                del self.sales[book_id]
+            books = [(book_id, self.quotas.get(book_id), *self._target(book_id, now))
+                     for book_id in set(self.sales) | set(self.quotas)]
+
+        for book_id, quota, target, allowance, hot in books:
+            try:
+                if quota is None:
+                    if hot:
+                        await self.renew(book_id, target, allowance)
+                elif (quota.closed or now >= quota.deadline
+                      or now - quota.last_sale > COLD_AFTER):
+                    await self.give_up(quota)
+                elif (quota.units < target * REFILL_BELOW
+                      or quota.allowance < allowance * REFILL_BELOW
+                      or now > quota.renewed_at + quota.ttl / 2):
+                    await self.renew(book_id, target, allowance, quota)
+            except Exception as e:
+                self.counters['lease_errors'] += 1
+                print(f"Stock lease of book {book_id} failed: {e}")
+
+    async def reconcile(self):
+        """Return every lease left by the last run of this order server."""
+        status, body = await self.client.request(
+            'GET', '/leases', params={'holder': self.holder}, endpoint='GET /leases')
+        if status != 200:
+            self.counters['lease_errors'] += 1
+            return
+
+        for lease in body['leases']:
+            # Units leased but never added to the stock_quota table were not sold
+            remaining = self.unreconciled.get(lease['book_id'], lease['units'])
+            status, returned = await self.client.request(
+                'DELETE', f"/books/{lease['book_id']}/lease",
+                json={'holder': self.holder, 'remaining': remaining},
+                endpoint='DELETE /books/<id>/lease')
+            if status not in (200, 404):
+                self.counters['lease_errors'] += 1
+                return
+            self.counters['units_returned'] += returned.get('returned', 0)
+
+        await asyncio.wrap_future(self.storage.submit(
+            drop_quota, self.storage.db.session, self.model, None))
+        self.unreconciled = None
+
+    async def renew(self, book_id, target, allowance, quota=None):
+        """Acquire a lease of a book, or renew and refill the quota's."""
+        if quota is None:
+            await self._renew(book_id, target, allowance)
+            return
+        async with quota.renewing:
+            if not quota.closed:
+                await self._renew(book_id, target, allowance, quota)
+
+    async def _renew(self, book_id, target, allowance, quota=None):
+        payload = {'holder': self.holder, 'want': target, 'allowance': allowance}
+        sold = 0
+        if quota is not None:
+            with self.lock:
+                payload['remaining'], sold = quota.units, quota.sold
+                # If the answer is lost, the catalog server keeps this
+                # allowance while the quota keeps selling from the last one
+                payload['allowance'] = max(allowance, quota.allowance)
+        sent_at = time.monotonic()
+        status, body = await self.client.request(
+            'PUT', f'/books/{book_id}/lease', json=payload,
+            endpoint='PUT /books/<id>/lease')
+        if status == 409:
+            # The lease expired on the catalog server (and may have been
+            # reclaimed), or was acquired by a call whose quota was never
+            # stored (so nothing was sold from it)
+            await self.give_up(quota or Quota(book_id, MAX_LEASE_UNITS))
+            return
+        if status != 200:
+            self.counters['lease_errors'] += 1
+            return
+
+        # A new quota takes every unit of the lease: if the answer to an
+        # earlier acquisition was lost, the lease already holds units that
+        # would otherwise be reported as sold at the next renewal
+        book = body['books']
+        granted = body['units'] if quota is None else body['granted']
+        if granted:
+            await asyncio.wrap_future(self.storage.submit(
+                add_quota, self.storage.db.session, self.model, book_id, granted,
+                book['name'], book['price']))
+        with self.lock:
+            if quota is None:
+                if not body['units']:
+                    return
+                quota = self.quotas[book_id] = Quota(book_id)
+                self.counters['leases_acquired'] += 1
+            quota.units += granted
+            # The allowance counts from the units reported, not from now
+            quota.allowance = payload['allowance'] - (quota.sold - sold)
+            quota.name, quota.price, quota.count = book['name'], book['price'], book['count']
+            quota.ttl = body['ttl']
+            quota.renewed_at = sent_at
+            quota.deadline = sent_at + body['ttl'] - EXPIRY_MARGIN
+            self.counters['units_leased'] += granted
+
+    async def give_up(self, quota):
+        """Return the unsold units of a quota to the catalog server."""
+        with self.lock:
+            quota.closed = True
+            remaining = quota.units
+        status, body = await self.client.request(
+            'DELETE', f'/books/{quota.book_id}/lease',
+            json={'holder': self.holder, 'remaining': remaining},
+            endpoint='DELETE /books/<id>/lease')
+        if status not in (200, 404):
+            # Kept closed, and returned again in the next round
+            self.counters['lease_errors'] += 1
+            return
+
+        await asyncio.wrap_future(self.storage.submit(
+            drop_quota, self.storage.db.session, self.model, quota.book_id))
+        with self.lock:
+            self.quotas.pop(quota.book_id, None)
+            self.counters['units_returned'] += body.get('returned', 0)
+
+    def copies_left(self, book_id):
+        """
+        Copies of a book left as of its last lease answer (the catalog count
+        and the quota), or None without a quota.
+        """
+        with self.lock:
+            quota = self.quotas.get(book_id)
+            if quota is None or quota.closed or not quota.renewed_at:
+                return None
+            return quota.book()['count']
+
+    def stats(self):
+        """Counters and quotas, for the /escrow/stats endpoint."""
+        now = time.monotonic()
+        with self.lock:
+            quotas = [{
+                'book_id': quota.book_id,
+                'units': quota.units,
+                'allowance': quota.allowance,
+                'closed': quota.closed,
+                'seconds_left': round(max(quota.deadline - now, 0), 3),
+            } for quota in self.quotas.values()]
+            return dict(self.counters, holder=self.holder, quotas=quotas)
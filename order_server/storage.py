@@ -0,0 +1,279 @@
+# storage.py
+# SQLite storage layer shared by the book and order servers.
+#
+# - Every connection runs in WAL mode, so readers never block on the writer.
+# - GET endpoints read through a pool of query-only connections (read_session).
+# - All writes are sent to one dedicated writer thread (write), which runs them
+#   one after another in BEGIN IMMEDIATE transactions, so requests never
+#   compete for the database lock.
+# - With group_commit, the writer runs the writes queued within a few
+#   milliseconds in one transaction (each in its own savepoint), so one fsync
+#   makes a whole batch durable.
+# - run_migrations brings an existing database file up to the current schema,
+#   using PRAGMA user_version as the number of migrations already applied.
+# - EpochMillis stores datetimes as integers, a fraction of the size of text.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import TypeDecorator
+
+# PRAGMAs applied to every connection
+JOURNAL_MODE = 'WAL'
+SYNCHRONOUS = 'NORMAL'
+MMAP_SIZE = 256 * 1024 * 1024
+BUSY_TIMEOUT_MS = 10000
+
+# Number of pooled read-only connections (plus as many overflow connections)
+READ_POOL_SIZE = 8
+
+# Group commit: most writes per transaction, and how long the writer waits
+# for more writes after the first one of a batch (seconds). Every commit is
+# fsynced (synchronous=FULL), since a batch is acknowledged as durable.
+GROUP_COMMIT_MAX_BATCH = 256
+GROUP_COMMIT_DELAY = 0.002
+GROUP_COMMIT_SYNCHRONOUS = 'FULL'
+
+
+# SQL expression converting a DATETIME text column to EpochMillis, for migrations
+EPOCH_MILLIS_SQL = "CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class EpochMillis(TypeDecorator):
+    """Naive datetime stored as integer milliseconds since 1970-01-01 (6 bytes instead of 26)."""
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return (value - EPOCH) // timedelta(milliseconds=1)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return EPOCH + timedelta(milliseconds=value)
+
+
+# Function to apply the connection PRAGMAs
+def configure_connection(dbapi_connection, query_only=False, synchronous=SYNCHRONOUS):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode = {JOURNAL_MODE}')
+    cursor.execute(f'PRAGMA synchronous = {synchronous}')
+    cursor.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    cursor.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    if query_only:
+        cursor.execute('PRAGMA query_only = ON')
+    cursor.close()
+
+
+class SQLiteStorage:
+    """WAL-mode SQLite with pooled read connections and a single writer thread."""
+
+    def __init__(self, db, read_pool_size=READ_POOL_SIZE, group_commit=False,
+                 max_batch=GROUP_COMMIT_MAX_BATCH, max_delay=GROUP_COMMIT_DELAY):
+        self.db = db
+        self.read_pool_size = read_pool_size
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Writes and transactions committed by the writer thread
+        self.writes = 0
+        self.commits = 0
+        self.app = None
+        self.read_engine = None
+        self._read_sessions = None
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configure the app's engine and create the read pool. Call before db.create_all()."""
+        self.app = app
+        with app.app_context():
+            engine = self.db.engine
+
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            configure_connection(dbapi_connection, synchronous=(
+                GROUP_COMMIT_SYNCHRONOUS if self.group_commit else SYNCHRONOUS))
+            # Let SQLAlchemy emit BEGIN itself (see on_begin), pysqlite's own
+            # transaction handling would start deferred transactions
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def on_begin(connection):
+            # Take the write lock up front instead of upgrading a read lock later
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+        self.read_engine = create_engine(
+            engine.url,
+            pool_size=self.read_pool_size,
+            max_overflow=self.read_pool_size,
+            connect_args={'check_same_thread': False},
+        )
+
+        @event.listens_for(self.read_engine, 'connect')
+        def on_read_connect(dbapi_connection, connection_record):
+            configure_connection(dbapi_connection, query_only=True)
+
+        self._read_sessions = sessionmaker(
+            bind=self.read_engine, expire_on_commit=False)
+
+    @contextmanager
+    def read_session(self):
+        """Session on a pooled read-only connection, for GET endpoints."""
+        session = self._read_sessions()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def run_migrations(self, migrations):
+        """
+        Apply the migrations the database has not seen yet, in order.
+        migrations is the list of every migration ever released, each a
+        function taking the session; never reorder or remove one, only append.
+        Migration N runs in its own transaction together with setting
+        PRAGMA user_version to N, so an interrupted run resumes at N.
+        Tables created by db.create_all() already have the latest schema,
+        so migrations must be idempotent (e.g. CREATE INDEX IF NOT EXISTS).
+        Call at startup, after db.create_all(). Returns the migrations
+        applied by this call, for the caller to log.
+        """
+        applied_now = []
+        with self.app.app_context():
+            session = self.db.session
+            applied = session.execute(text('PRAGMA user_version')).scalar()
+            for version, migration in enumerate(migrations, 1):
+                if version <= applied:
+                    continue
+                try:
+                    migration(session)
+                    session.execute(text(f'PRAGMA user_version = {version}'))
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    raise
+                applied_now.append(migration)
+            session.close()
+        return applied_now
+
+    def vacuum(self):
+        """
+        Rebuild the database file, returning the pages freed by dropped tables
+        or deleted rows to the file system. Blocks every other connection
+        while it runs, so only call it at startup, e.g. after a migration
+        that rebuilt a table.
+        """
+        with self.app.app_context():
+            # VACUUM cannot run in a transaction; the raw connection is in
+            # autocommit mode (see on_connect)
+            connection = self.db.engine.raw_connection()
+            try:
+                connection.cursor().execute('VACUUM')
+            finally:
+                connection.close()
+
+    def write(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on the writer thread with db.session and commit.
+        Returns what fn returns, or raises what fn raised (after a rollback).
+        fn should return plain data, not ORM objects.
+        """
+        if threading.current_thread() is self._writer:
+            # Already on the writer thread, the caller's transaction is reused
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn like write() without waiting for it. Returns a
+        concurrent.futures.Future, e.g. for asyncio.wrap_future().
+        """
+        self._start_writer()
+        future = Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    def stats(self):
+        """Counters of the writer thread."""
+        return {
+            'group_commit': self.group_commit,
+            'writes': self.writes,
+            'commits': self.commits,
+            'writes_per_commit': round(self.writes / self.commits, 2) if self.commits else 0.0,
+        }
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name='sqlite-writer', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        with self.app.app_context():
+            while True:
+                if self.group_commit:
+                    self._commit_batch(self._next_batch())
+                    continue
+
+                fn, args, kwargs, future = self._queue.get()
+                try:
+                    result = fn(*args, **kwargs)
+                    self.db.session.commit()
+                    self.writes += 1
+                    self.commits += 1
+                    future.set_result(result)
+                except Exception as e:
+                    self.db.session.rollback()
+                    future.set_exception(e)
+                finally:
+                    self.db.session.close()
+
+    def _next_batch(self):
+        # The first queued write, then whatever arrives within max_delay,
+        # up to max_batch writes
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit_batch(self, batch):
+        # Each write runs in a savepoint, so a failed one is rolled back alone;
+        # the futures are resolved once the transaction has committed
+        session = self.db.session
+        done = []
+        try:
+            for fn, args, kwargs, future in batch:
+                try:
+                    with session.begin_nested():
+                        result = fn(*args, **kwargs)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    done.append((future, result))
+            session.commit()
+            self.writes += len(done)
+            self.commits += 1
+        except Exception as e:
+            session.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+        else:
+            for future, result in done:
+                future.set_result(result)
+        finally:
+            session.close()